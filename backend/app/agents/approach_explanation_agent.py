@@ -1,15 +1,18 @@
 import logging
-import json
-import re
 import html
 from typing import Dict, List, Any, Optional
 from pydantic import BaseModel, Field
 
-from app.utils.llm_utils import query_llm
+from app.utils.llm_utils import query_llm_structured
+from app.utils.json_decoder import StructuredOutputError
+from app.utils.llm_budgets import stage_budget
 from app.utils.sanitizer import process_inputs, extract_language_from_code, remove_java_comments
 
 logger = logging.getLogger(__name__)
 
+# Bump when the explanation prompt changes so cached responses are not reused
+APPROACH_EXPLANATION_PROMPT_VERSION = "approach-explanation-v2"
+
 class ApproachExplanation(BaseModel):
     """Schema for the code approach explanation"""
     approach_name: str = Field("Unknown approach", description="Brief name of the algorithm/approach")
@@ -54,16 +57,18 @@ class ApproachExplanationAgent:
             if problem_statement:
                 problem_section = f"PROBLEM STATEMENT:\n```\n{problem_statement}\n```\n"
             
+            budget = stage_budget("approach_explanation")
+            
             # JSON format template
-            json_format = """{
+            json_format = f"""{{
                 "approach_name": "Brief name of the algorithm/approach",
-                "explanation": "Detailed step-by-step explanation of the code",
-                "algorithm_details": "Description of the algorithm(s) used",
-                "time_complexity": "Big O analysis of time complexity",
-                "space_complexity": "Big O analysis of space complexity",
-                "issues_identified": ["List of issues without suggested fixes"],
+                "explanation": "Step-by-step explanation of the code (at most {budget.max_words} words)",
+                "algorithm_details": "One or two sentences on the algorithm(s) used",
+                "time_complexity": "Big O time complexity",
+                "space_complexity": "Big O space complexity",
+                "issues_identified": ["One short sentence per issue, without suggested fixes"],
                 "correct_implementation": true/false
-            }"""
+            }}"""
             
             # Create a prompt for approach explanation
             unescaped_code = remove_java_comments(unescaped_code)
@@ -96,37 +101,33 @@ class ApproachExplanationAgent:
             """
             
             # Query LLM for approach explanation
-            response = await query_llm(explanation_prompt, temperature=0.2)
-            
-            # Parse the response
             try:
-                # Try to extract JSON from the response
-                json_match = re.search(r'(\{.*\})', response, re.DOTALL)
-                if json_match:
-                    json_str = json_match.group(1)
-                    approach_explanation_dict = json.loads(json_str)
-                else:
-                    approach_explanation_dict = json.loads(response)
+                approach_explanation = await query_llm_structured(
+                    explanation_prompt,
+                    ApproachExplanation,
+                    temperature=0.2,
+                    max_tokens=budget.max_tokens,
+                    cache=True,
+                    template_version=APPROACH_EXPLANATION_PROMPT_VERSION,
+                    stage="approach_explanation"
+                )
                 
                 # Filter out any issues related to HTML entities
-                if "issues_identified" in approach_explanation_dict:
+                if "issues_identified" in approach_explanation.model_fields_set:
                     filtered_issues = [
-                        issue for issue in approach_explanation_dict["issues_identified"]
+                        issue for issue in approach_explanation.issues_identified
                         if not any(term in issue.lower() for term in ["html", "entity", "&lt;", "&gt;", "escaped"])
                     ]
-                    approach_explanation_dict["issues_identified"] = filtered_issues
+                    approach_explanation.issues_identified = filtered_issues
                     
                     # Update correct_implementation based on remaining issues
-                    approach_explanation_dict["correct_implementation"] = len(filtered_issues) == 0
-                
-                # Convert to Pydantic model
-                approach_explanation = ApproachExplanation(**approach_explanation_dict)
+                    approach_explanation.correct_implementation = len(filtered_issues) == 0
                 
                 logger.info(f"Generated approach explanation for: {approach_explanation.approach_name}")
                 return approach_explanation
                 
-            except json.JSONDecodeError:
-                logger.error(f"Failed to parse approach explanation response: {response}")
+            except StructuredOutputError as e:
+                logger.error(f"Failed to parse approach explanation response: {str(e)}")
                 # Fall back to a simpler format
                 return ApproachExplanation(
                     approach_name="Unknown approach",
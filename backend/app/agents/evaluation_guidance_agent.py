@@ -1,15 +1,87 @@
 import logging
-import json
-import re
 import os
 from typing import Dict, List, Any, Optional
 from pydantic import BaseModel, Field, validator
 
-from app.utils.llm_utils import query_llm
+from app.utils.llm_utils import query_llm_structured, prompt_token_budget
+from app.utils.json_decoder import StructuredOutputError
+from app.utils.llm_budgets import stage_budget
+from app.utils.prompt_builder import PromptBuilder
+from app.utils.prompt_templates import prompt_template, compact_json, TRUST_IMPLEMENTATION
 from app.utils.sanitizer import process_inputs
 
 logger = logging.getLogger(__name__)
 
+# Bump when the guidance prompt changes so cached responses are not reused
+GUIDANCE_PROMPT_VERSION = "guidance-v3"
+
+GUIDANCE_HEADER_TEMPLATE = prompt_template("guidance_header", """
+    You are an expert in algorithms and code evaluation. Your task is to create specific guidance for evaluating
+    student code submissions for a particular problem against a specific approach from the rubric.
+
+    PROBLEM STATEMENT:
+    ```
+    {problem_statement}
+    ```
+
+    SELECTED APPROACH: {approach_name}
+
+    APPROACH DESCRIPTION:
+    {explanation}
+
+    RUBRIC POINTS FOR THIS APPROACH:
+    {approach_rubric}
+    """)
+
+EDITORIAL_TEMPLATE = prompt_template("guidance_editorial", """
+    EDITORIAL SOLUTION:
+    ```
+    {editorial}
+    ```
+    """)
+
+CORRECT_EXAMPLE_TEMPLATE = prompt_template("guidance_correct_example", """
+    {heading}CORRECT EXAMPLE {number}:
+    ```
+    {code}
+    ```
+    """)
+
+ERROR_EXAMPLE_TEMPLATE = prompt_template("guidance_error_example", """
+    {heading}ERROR TYPE: {error_type}
+    CODE:
+    ```
+    {code}
+    ```
+    FEEDBACK:
+    {feedback}
+    """)
+
+GUIDANCE_INSTRUCTIONS_TEMPLATE = prompt_template("guidance_instructions", """
+    INSTRUCTIONS:
+    1. Create specialized guidance for evaluating code against this specific approach
+    2. Include implementation variations that are valid for this approach
+    3. Describe edge cases and boundary conditions that should be considered
+    4. Create 4-5 representative test cases with expected outputs for this approach
+    5. List common errors students make when implementing this approach
+
+    CRITICAL EVALUATION PRINCIPLES:
+    - {trust_implementation}
+    - Analyze the actual algorithm implementation pattern and logic flow rather than descriptions
+    - Check for actual time and space complexity based on implementation, not based on comments
+    - A correct implementation can use different styles and variable names but must follow the core algorithm pattern
+
+    Format your response as a JSON object with string values for all fields:
+    - algorithm_type: String naming the algorithm
+    - algorithm_guidance: Detailed text guidance for evaluation
+    - test_cases: Text description of representative test cases
+    - common_errors: Text description of common implementation mistakes
+    - key_implementation_patterns: Text description of correct implementation patterns
+    - misleading_patterns: Text description of patterns to ignore
+
+    Keep each field concise: at most {max_words} words per field.
+    """)
+
 class AlgorithmGuidance(BaseModel):
     """Schema for algorithm-specific evaluation guidance"""
     algorithm_type: str = Field("Unknown", description="The specific algorithm type used in this approach")
@@ -30,9 +102,9 @@ class AlgorithmGuidance(BaseModel):
         # If it's a list or dict, convert to a formatted string
         if isinstance(v, (list, dict)):
             try:
-                # Use json.dumps for dictionaries to preserve structure
+                # Serialize dictionaries compactly, they are embedded in prompts
                 if isinstance(v, dict):
-                    return json.dumps(v, indent=2)
+                    return compact_json(v)
                 
                 # For lists, join into a multi-line string
                 return "\n".join(str(item) for item in v)
@@ -50,6 +122,34 @@ class Examples(BaseModel):
     editorial: Optional[str] = None
     feedback: Dict[str, str] = {}
 
+def fallback_guidance(approach_name: str) -> AlgorithmGuidance:
+    """
+    Generic guidance used when algorithm-specific guidance cannot be generated
+    """
+    return AlgorithmGuidance(
+        algorithm_type=approach_name,
+        algorithm_guidance=f"""
+        When evaluating code for approach '{approach_name}', consider both explicit and implicit correctness.
+        Focus on whether the code implements the core algorithm pattern correctly, regardless of how it's described.
+        Analyze what the code actually does, not what comments claim it does.
+        Consider multiple valid implementation variations that achieve the same algorithmic goal.
+        """,
+        test_cases="No specific test cases provided.",
+        common_errors="No common errors identified.",
+        key_implementation_patterns=f"""
+        IMPORTANT: Focus on the actual code logic, not comments or variable names.
+        
+        For approach '{approach_name}':
+        1. Correct initialization of necessary variables and data structures
+        2. Proper implementation of the core algorithm logic
+        3. Appropriate handling of edge cases
+        4. Correct computation and return of results
+        
+        The code should be evaluated based on its actual behavior, not how it describes itself.
+        """,
+        misleading_patterns="No specific misleading patterns identified."
+    )
+
 class EvaluationGuidanceAgent:
     """
     Agent that generates algorithm-specific evaluation guidance and test cases
@@ -120,7 +220,8 @@ class EvaluationGuidanceAgent:
         self,
         problem_statement: str,
         extracted_rubric: Dict[str, Any],
-        problem_dir: Optional[str] = None
+        problem_dir: Optional[str] = None,
+        fallback: bool = True
     ) -> AlgorithmGuidance:
         """
         Generate algorithm-specific guidance and test cases for evaluating code
@@ -130,6 +231,7 @@ class EvaluationGuidanceAgent:
             problem_statement: The problem statement
             extracted_rubric: The approach extracted by the rubric_extractor_agent
             problem_dir: Optional path to directory with example solutions
+            fallback: Return generic guidance instead of raising when generation fails
             
         Returns:
             AlgorithmGuidance containing guidance and test cases
@@ -155,101 +257,63 @@ class EvaluationGuidanceAgent:
             if problem_dir and os.path.exists(problem_dir):
                 examples = await self.load_examples(problem_dir)
             
-            # Extract example information for the prompt
-            example_prompt = ""
+            budget = stage_budget("guidance")
+            builder = PromptBuilder(prompt_token_budget(max_tokens=budget.max_tokens))
+            
+            # Create a prompt for generating algorithm guidance
+            builder.add("guidance_header", GUIDANCE_HEADER_TEMPLATE.render(
+                problem_statement=clean_problem,
+                approach_name=approach_name,
+                explanation=explanation,
+                approach_rubric=approach_rubric.rstrip()
+            ), required=True)
+            
+            # Example information is the first thing trimmed when the prompt is too large
             if examples and examples.editorial:
-                example_prompt += f"""
-                EDITORIAL SOLUTION:
-                ```
-                {examples.editorial}
-                ```
-                """
+                builder.add("editorial", EDITORIAL_TEMPLATE.render(editorial=examples.editorial), priority=3)
             
             if examples and examples.correct:
-                example_prompt += "\nCORRECT SOLUTION EXAMPLES:\n"
                 # Limit to max 2 correct examples to keep prompt size reasonable
                 for i, example in enumerate(examples.correct[:2]):
-                    example_prompt += f"""
-                    CORRECT EXAMPLE {i+1}:
-                    ```
-                    {example["code"]}
-                    ```
-                    """
+                    builder.add(f"correct_example_{i+1}", CORRECT_EXAMPLE_TEMPLATE.render(
+                        heading="CORRECT SOLUTION EXAMPLES:\n" if i == 0 else "",
+                        number=i + 1,
+                        code=example["code"]
+                    ), priority=4 + i)
             
             if examples and examples.incorrect and examples.feedback:
-                example_prompt += "\nCOMMON ERRORS AND FEEDBACK:\n"
                 # Include 1-2 examples of incorrect solutions with feedback
-                for error_type, code in list(examples.incorrect.items())[:2]:
-                    if error_type in examples.feedback:
-                        example_prompt += f"""
-                        ERROR TYPE: {error_type}
-                        CODE:
-                        ```
-                        {code}
-                        ```
-                        FEEDBACK:
-                        {examples.feedback[error_type]}
-                        """
-            
-            # Create a prompt for generating algorithm guidance
-            guidance_prompt = f"""
-            You are an expert in algorithms and code evaluation. Your task is to create specific guidance for evaluating 
-            student code submissions for a particular problem against a specific approach from the rubric.
-            
-            PROBLEM STATEMENT:
-            ```
-            {clean_problem}
-            ```
-            
-            SELECTED APPROACH: {approach_name}
-            
-            APPROACH DESCRIPTION:
-            {explanation}
-            
-            RUBRIC POINTS FOR THIS APPROACH:
-            {approach_rubric}
-            
-            {example_prompt}
-            
-            INSTRUCTIONS:
-            1. Create specialized guidance for evaluating code against this specific approach
-            2. Include implementation variations that are valid for this approach
-            3. Describe edge cases and boundary conditions that should be considered
-            4. Create 4-5 representative test cases with expected outputs for this approach
-            5. List common errors students make when implementing this approach
-            
-            CRITICAL EVALUATION PRINCIPLES:
-            - Focus on what the code ACTUALLY DOES, not what comments claim it does
-            - Students may use misleading variable names or comments (intentionally or unintentionally)
-            - Analyze the actual algorithm implementation pattern and logic flow rather than descriptions
-            - Consider algorithmic correctness based on behavior, not naming conventions
-            - Check for actual time and space complexity based on implementation, not based on comments
-            - A correct implementation can use different styles and variable names but must follow the core algorithm pattern
+                error_examples = [
+                    (error_type, code) for error_type, code in list(examples.incorrect.items())[:2]
+                    if error_type in examples.feedback
+                ]
+                for i, (error_type, code) in enumerate(error_examples):
+                    builder.add(f"error_example_{i+1}", ERROR_EXAMPLE_TEMPLATE.render(
+                        heading="COMMON ERRORS AND FEEDBACK:\n" if i == 0 else "",
+                        error_type=error_type,
+                        code=code,
+                        feedback=examples.feedback[error_type]
+                    ), priority=4 + i)
             
-            Format your response as a JSON object with string values for all fields. 
-            Specifically:
-            - algorithm_type: String naming the algorithm
-            - algorithm_guidance: Detailed text guidance for evaluation
-            - test_cases: Text description of representative test cases
-            - common_errors: Text description of common implementation mistakes
-            - key_implementation_patterns: Text description of correct implementation patterns
-            - misleading_patterns: Text description of patterns to ignore
-            """
+            builder.add("guidance_instructions", GUIDANCE_INSTRUCTIONS_TEMPLATE.render(
+                trust_implementation=TRUST_IMPLEMENTATION,
+                max_words=budget.max_words
+            ), required=True)
+            guidance_prompt = builder.build()
             
             # Query LLM for algorithm guidance
-            response = await query_llm(guidance_prompt, temperature=0.3)
-            
-            # Parse the response
             try:
-                # Try to extract JSON from the response
-                json_match = re.search(r'(\{.*\})', response, re.DOTALL)
-                if json_match:
-                    json_str = json_match.group(1)
-                    guidance_dict = json.loads(json_str)
-                else:
-                    guidance_dict = json.loads(response)
+                algorithm_guidance = await query_llm_structured(
+                    guidance_prompt,
+                    AlgorithmGuidance,
+                    temperature=0.3,
+                    max_tokens=budget.max_tokens,
+                    cache=True,
+                    template_version=GUIDANCE_PROMPT_VERSION,
+                    stage="guidance"
+                )
                 
-                # Ensure all fields are strings with a fallback
+                # Ensure all fields have a fallback value
                 fields = [
                     'algorithm_type', 
                     'algorithm_guidance', 
@@ -260,66 +324,24 @@ class EvaluationGuidanceAgent:
                 ]
                 
                 for field in fields:
-                    if field not in guidance_dict or guidance_dict[field] is None:
+                    if not getattr(algorithm_guidance, field):
                         # Provide a default string value
-                        guidance_dict[field] = f"No specific {field} provided for {approach_name}"
+                        setattr(algorithm_guidance, field, f"No specific {field} provided for {approach_name}")
                 
-                # Create AlgorithmGuidance object
-                algorithm_guidance = AlgorithmGuidance(**guidance_dict)
                 logger.info(f"Generated evaluation guidance for algorithm type: {algorithm_guidance.algorithm_type}")
                 return algorithm_guidance
                 
-            except (json.JSONDecodeError, TypeError) as e:
-                logger.error(f"Failed to parse guidance response: {response}")
+            except StructuredOutputError as e:
+                logger.error(f"Failed to parse guidance response: {str(e)}")
+                if not fallback:
+                    raise
                 # Fallback to default guidance
-                return AlgorithmGuidance(
-                    algorithm_type=approach_name,
-                    algorithm_guidance=f"""
-                    When evaluating code for approach '{approach_name}', consider both explicit and implicit correctness.
-                    Focus on whether the code implements the core algorithm pattern correctly, regardless of how it's described.
-                    Analyze what the code actually does, not what comments claim it does.
-                    Consider multiple valid implementation variations that achieve the same algorithmic goal.
-                    """,
-                    test_cases="No specific test cases provided.",
-                    common_errors="No common errors identified.",
-                    key_implementation_patterns=f"""
-                    IMPORTANT: Focus on the actual code logic, not comments or variable names.
-                    
-                    For approach '{approach_name}':
-                    1. Correct initialization of necessary variables and data structures
-                    2. Proper implementation of the core algorithm logic
-                    3. Appropriate handling of edge cases
-                    4. Correct computation and return of results
-                    
-                    The code should be evaluated based on its actual behavior, not how it describes itself.
-                    """,
-                    misleading_patterns="No specific misleading patterns identified."
-                )
+                return fallback_guidance(approach_name)
                 
         except Exception as e:
             logger.error(f"Error generating evaluation guidance: {str(e)}", exc_info=True)
+            if not fallback:
+                raise
             # Return a basic fallback guidance
             approach_name = extracted_rubric.get("approach", "Unknown") if extracted_rubric else "Unknown"
-            return AlgorithmGuidance(
-                algorithm_type=approach_name,
-                algorithm_guidance=f"""
-                When evaluating code for approach '{approach_name}', consider both explicit and implicit correctness.
-                Focus on whether the code implements the core algorithm pattern correctly, regardless of how it's described.
-                Analyze what the code actually does, not what comments claim it does.
-                Consider multiple valid implementation variations that achieve the same algorithmic goal.
-                """,
-                test_cases="No specific test cases provided.",
-                common_errors="No common errors identified.",
-                key_implementation_patterns=f"""
-                IMPORTANT: Focus on the actual code logic, not comments or variable names.
-                
-                For approach '{approach_name}':
-                1. Correct initialization of necessary variables and data structures
-                2. Proper implementation of the core algorithm logic
-                3. Appropriate handling of edge cases
-                4. Correct computation and return of results
-                
-                The code should be evaluated based on its actual behavior, not how it describes itself.
-                """,
-                misleading_patterns="No specific misleading patterns identified."
-            )
\ No newline at end of file
+            return fallback_guidance(approach_name)
@@ -1,17 +1,68 @@
 import json
 import logging
-import re
 import asyncio
+import functools
 from typing import Dict, List, Any, Tuple, Optional
 from pydantic import BaseModel, Field
 
 from app.agents.approach_explanation_agent import ApproachExplanationAgent, ApproachExplanation
-from app.utils.rubric_parser import parse_rubric, get_approach_marks
-from app.utils.llm_utils import query_llm
-from app.utils.sanitizer import process_inputs, remove_java_comments
+from app.utils.rubric_parser import parse_rubric, get_approach_marks, format_approach_rubric
+from app.utils.llm_streaming import query_llm_fields
+from app.utils.llm_utils import cache_llm_response, structured_response_format
+from app.utils.llm_budgets import stage_budget
+from app.utils.prompt_templates import prompt_template
+from app.utils.prompt_builder import PromptParts, prompt_group
+from app.utils.sanitizer import secure_student_code, remove_java_comments, sanitize_problem_statement, sanitize_rubric
 
 logger = logging.getLogger(__name__)
-nl = "\n"
+# Bump when the approach matching prompt changes so cached responses are not reused
+APPROACH_MATCH_PROMPT_VERSION = "approach-match-v4"
+
+APPROACH_MATCH_TEMPLATE = prompt_template("approach_match", """
+    You are an expert code evaluator specializing in identifying programming approaches.
+
+    PROBLEM STATEMENT:
+    ```
+    {problem_statement}
+    ```
+
+    YOU ARE EVALUATING THE FOLLOWING APPROACH ONLY:
+    {approach_description}
+
+    {model_solution_section}INSTRUCTIONS:
+    1. Carefully analyze the student's solution (given at the end), focusing on the algorithm and implementation style
+    2. Determine how well it matches the specific approach described above
+    3. Consider algorithm characteristics like time complexity, space usage, and implementation pattern
+    4. Identify specific evidence in the code that supports or contradicts this approach
+    5. You are ONLY evaluating this ONE approach - you don't know about any other possible approaches
+    6. Be objective and thorough in your analysis
+
+    RESPONSE FORMAT:
+    Return a JSON object with the following structure:
+    {{"approach": "{approach_name}", "confidence": 0.0-1.0, "explanation": "One sentence (at most {max_words} words) citing the code evidence for this confidence level", "key_indicators": ["Up to 3 short code patterns that indicate this approach"]}}
+
+    The confidence score should reflect how likely it is that the student's solution follows this approach:
+    - 0.8-1.0: Strong match with clear evidence
+    - 0.5-0.8: Moderate match with some differences
+    - 0.3-0.5: Weak match with significant differences
+    - 0.0-0.3: Very poor match, fundamentally different approach
+
+    Only return the JSON object and nothing else.
+    """)
+
+STUDENT_SOLUTION_TEMPLATE = prompt_template("approach_match_student_solution", """
+    STUDENT SOLUTION (SANITIZED):
+    ```
+    {sanitized_solution_code}
+    ```
+    """)
+
+MODEL_SOLUTION_TEMPLATE = prompt_template("approach_match_model_solution", """
+    MODEL SOLUTION:
+    ```
+    {model_solution}
+    ```
+    """)
 
 class ApproachEvaluation(BaseModel):
     """Schema for approach evaluation result"""
@@ -37,6 +88,15 @@ class RubricExtractorAgent:
     based on student solution. Evaluates each approach in parallel without knowledge of other approaches.
     """
     
+    def __init__(self, approach_batcher=None):
+        """
+        Args:
+            approach_batcher: Optional ApproachMatchBatcher that matches the
+                solution together with other students' solutions; without one
+                each solution is matched with its own calls
+        """
+        self.approach_batcher = approach_batcher
+    
     def print_parsed_rubric(self, parsed_rubric: Dict[str, Any]) -> None:
         """
         Print the parsed rubric structure for debugging
@@ -66,37 +126,85 @@ class RubricExtractorAgent:
         Returns:
             ExtractedRubric containing the extracted rubric information
         """
-        # Process and sanitize inputs
-        solution_without_comments = remove_java_comments(solution_code)
+        clean_problem = sanitize_problem_statement(problem_statement)
+        parsed_rubric = parse_rubric(sanitize_rubric(rubric))
+        max_scores = {
+            approach: get_approach_marks(parsed_rubric, approach) for approach in parsed_rubric["approaches"]
+        }
+        matching = self.evaluate_approaches(clean_problem, parsed_rubric, solution_code, model_solution)
         
-        clean_problem, clean_rubric, clean_solution = process_inputs(
-            problem_statement, rubric, solution_without_comments
-        )
+        # If approach explanation is not provided, generate it alongside the approach matching
+        if approach_explanation is None:
+            approach_results, approach_explanation = await asyncio.gather(
+                matching,
+                self._explain_approach(secure_student_code(solution_code), clean_problem)
+            )
+        else:
+            approach_results = await matching
         
-        # Parse the rubric structure
-        parsed_rubric = parse_rubric(clean_rubric)
+        return self.select_approach(parsed_rubric, max_scores, approach_results, approach_explanation)
+    
+    async def _explain_approach(self, solution_code: str, problem_statement: str) -> Optional[ApproachExplanation]:
+        approach_explainer = ApproachExplanationAgent()
+        try:
+            approach_explanation = await approach_explainer.explain_approach(
+                solution_code, 
+                problem_statement
+            )
+            logger.info(f"Generated approach explanation: {approach_explanation.approach_name}")
+            return approach_explanation
+        except Exception as e:
+            logger.error(f"Error getting approach explanation: {str(e)}")
+            return None
+    
+    async def evaluate_approaches(
+        self,
+        problem_statement: str,
+        parsed_rubric: Dict[str, Any],
+        solution_code: str,
+        model_solution: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Evaluate every approach of the problem's rubric in parallel.
+        Independent of the approach explanation, so both can run concurrently.
         
-        # First, run the parallel approach evaluation
-        approach_results = await self._evaluate_approaches_in_parallel(
-            clean_problem, 
+        Args:
+            problem_statement: The sanitized problem statement
+            parsed_rubric: Parsed rubric structure
+            solution_code: The student's raw solution code
+            model_solution: Optional model solution provided by instructor
+            
+        Returns:
+            Evaluation result for each approach
+        """
+        # The solution is matched without its comments
+        return await self._evaluate_approaches_in_parallel(
+            problem_statement, 
             parsed_rubric, 
-            clean_solution,
+            remove_java_comments(solution_code),
             model_solution
         )
+    
+    def select_approach(
+        self,
+        parsed_rubric: Dict[str, Any],
+        max_scores: Dict[str, int],
+        approach_results: List[Dict[str, Any]],
+        approach_explanation: Optional[ApproachExplanation] = None
+    ) -> ExtractedRubric:
+        """
+        Select the best approach from the approach evaluations, augmented by the
+        approach explanation when one is available
         
-        # If approach explanation is not provided, generate it
-        if approach_explanation is None:
-            approach_explainer = ApproachExplanationAgent()
-            try:
-                approach_explanation = await approach_explainer.explain_approach(
-                    solution_code, 
-                    problem_statement
-                )
-                logger.info(f"Generated approach explanation: {approach_explanation.approach_name}")
-            except Exception as e:
-                logger.error(f"Error getting approach explanation: {str(e)}")
-                approach_explanation = None
-        
+        Args:
+            parsed_rubric: Parsed rubric structure
+            max_scores: Maximum score of each approach
+            approach_results: Approach evaluations from evaluate_approaches
+            approach_explanation: Optional approach explanation
+            
+        Returns:
+            ExtractedRubric containing the extracted rubric information
+        """
         # Augment approach results with explanation insights (if available)
         augmented_approach_results = []
         if approach_explanation:
@@ -120,7 +228,7 @@ class RubricExtractorAgent:
         explanation = best_approach["explanation"]
         
         logger.info(f"Selected best approach: {approach_name} with confidence {confidence}")
-        approach_max_score = get_approach_marks(parsed_rubric, approach_name)
+        approach_max_score = max_scores.get(approach_name, 0)
         logger.info(f"Approach {approach_name} has a maximum score of {approach_max_score}")
         
         # Convert approach evaluations to model instances
@@ -203,13 +311,76 @@ class RubricExtractorAgent:
         
         return augmented_results    
 
-    async def _evaluate_single_approach(
+    @staticmethod
+    def _describe_approach(approach_name: str, approach_details: Dict[str, Any]) -> str:
+        """
+        Describe an approach and its rubric points for the approach matching prompts
+        """
+        approach_description = f"{approach_name}: {approach_details['name']}\n"
+        for i, point in enumerate(approach_details["points"]):
+            approach_description += f"  {i+1}. {point['description']} [{point['marks']} marks]\n"
+        return approach_description.rstrip()
+
+    def _single_approach_prompt(
         self,
         problem_statement: str,
         approach_name: str,
         approach_details: Dict[str, Any],
         sanitized_solution_code: str,
         model_solution: Optional[str] = None
+    ) -> PromptParts:
+        """
+        Prompt for evaluating one approach against one solution; the approach
+        description forms a prefix shared by every student on the problem
+        """
+        return PromptParts(
+            APPROACH_MATCH_TEMPLATE.render(
+                problem_statement=problem_statement,
+                approach_description=self._describe_approach(approach_name, approach_details),
+                model_solution_section=MODEL_SOLUTION_TEMPLATE.render(model_solution=model_solution) + "\n\n" if model_solution else "",
+                approach_name=approach_name,
+                max_words=stage_budget("approach_match").max_words
+            ),
+            STUDENT_SOLUTION_TEMPLATE.render(sanitized_solution_code=sanitized_solution_code),
+            prompt_group(problem_statement)
+        )
+    
+    async def _cache_single_approach(
+        self,
+        problem_statement: str,
+        approach_name: str,
+        approach_details: Dict[str, Any],
+        sanitized_solution_code: str,
+        model_solution: Optional[str],
+        result: Dict[str, Any]
+    ) -> None:
+        """
+        Store a batched approach match as the response of the unbatched
+        request, so evaluating the solution alone later reuses it
+        """
+        await cache_llm_response(
+            self._single_approach_prompt(
+                problem_statement,
+                approach_name,
+                approach_details,
+                sanitized_solution_code,
+                model_solution
+            ),
+            json.dumps(result),
+            temperature=0.1,
+            max_tokens=stage_budget("approach_match").max_tokens,
+            template_version=APPROACH_MATCH_PROMPT_VERSION,
+            response_format=structured_response_format(ApproachEvaluation)
+        )
+    
+    async def _evaluate_single_approach(
+        self,
+        problem_statement: str,
+        approach_name: str,
+        approach_details: Dict[str, Any],
+        sanitized_solution_code: str,
+        model_solution: Optional[str] = None,
+        cache: bool = True
     ) -> Dict[str, Any]:
         """
         Evaluate a single approach against the student solution
@@ -220,73 +391,35 @@ class RubricExtractorAgent:
             approach_details: Details of the approach
             sanitized_solution_code: The sanitized student's solution code
             model_solution: Optional model solution
+            cache: Whether the match may be served from the response cache and
+                coalesced with identical requests; without it the LLM is always queried
             
         Returns:
             Evaluation result with confidence
         """
-        # Format approach description
-        approach_description = f"{approach_name}: {approach_details['name']}\n"
-        for i, point in enumerate(approach_details["points"]):
-            approach_description += f"  {i+1}. {point['description']} [{point['marks']} marks]\n"
-        
-        # Create prompt for evaluating this specific approach
-        evaluation_prompt = f"""
-        You are an expert code evaluator specializing in identifying programming approaches.
-
-        PROBLEM STATEMENT:
-        ```
-        {problem_statement}
-        ```
-
-        YOU ARE EVALUATING THE FOLLOWING APPROACH ONLY:
-        {approach_description}
-
-        STUDENT SOLUTION (SANITIZED):
-        ```
-        {sanitized_solution_code}
-        ```
-
-        {"MODEL SOLUTION:" + nl + "```" + nl + model_solution + nl + "```" + nl if model_solution else ""}
-
-        INSTRUCTIONS:
-        1. Analyze the student's solution carefully, focusing on the algorithm and implementation style
-        2. Determine how well it matches the specific approach described above
-        3. Consider algorithm characteristics like time complexity, space usage, and implementation pattern
-        4. Identify specific evidence in the code that supports or contradicts this approach
-        5. You are ONLY evaluating this ONE approach - you don't know about any other possible approaches
-        6. Be objective and thorough in your analysis
-
-        RESPONSE FORMAT:
-        Return a JSON object with the following structure:
-        {{
-            "approach": "{approach_name}",
-            "confidence": 0.0-1.0,
-            "explanation": "Detailed explanation with specific code evidence for why this confidence level was assigned",
-            "key_indicators": ["List of specific code patterns that indicate this approach"]
-        }}
-        
-        The confidence score should reflect how likely it is that the student's solution follows this approach:
-        - 0.8-1.0: Strong match with clear evidence
-        - 0.5-0.8: Moderate match with some differences
-        - 0.3-0.5: Weak match with significant differences
-        - 0.0-0.3: Very poor match, fundamentally different approach
-
-        Only return the JSON object and nothing else.
-        """
+        budget = stage_budget("approach_match")
+        evaluation_prompt = self._single_approach_prompt(
+            problem_statement,
+            approach_name,
+            approach_details,
+            sanitized_solution_code,
+            model_solution
+        )
         try:
-            # Query the LLM
-            response = await query_llm(evaluation_prompt, temperature=0.1)
-            
-            # Extract JSON from response
-            json_match = re.search(r'(\{.*\})', response, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(1)
-                result = json.loads(json_str)
-            else:
-                result = json.loads(response)
-            
-            # Ensure approach name is correct
-            result["approach"] = approach_name
+            # Stream the response and stop once the fields used for selection are complete
+            result = await query_llm_fields(
+                evaluation_prompt,
+                required_fields=("confidence", "explanation", "key_indicators"),
+                temperature=0.1,
+                max_tokens=budget.max_tokens,
+                cache=cache,
+                coalesce=cache,
+                template_version=APPROACH_MATCH_PROMPT_VERSION,
+                schema=ApproachEvaluation,
+                # Ensure approach name is correct
+                overrides={"approach": approach_name},
+                stage="approach_match"
+            )
             
             return result
             
@@ -303,37 +436,84 @@ class RubricExtractorAgent:
         self,
         problem_statement: str,
         parsed_rubric: Dict[str, Any],
-        sanitized_solution_code: str,
-        model_solution: Optional[str] = None
+        solution_code: str,
+        model_solution: Optional[str] = None,
+        batched: bool = True,
+        cache: bool = True
     ) -> List[Dict[str, Any]]:
         """
-        Evaluate all approaches in parallel
+        Evaluate all approaches in parallel; with batching enabled, each
+        approach is matched in one call together with other students'
+        solutions waiting for it
         
         Args:
             problem_statement: The problem statement
             parsed_rubric: Parsed rubric structure
-            sanitized_solution_code: The sanitized student's solution code
+            solution_code: The student's solution code without comments,
+                secured here and by the batcher
             model_solution: Optional model solution
+            batched: Whether the solution may be batched with other students',
+                if the agent has an approach batcher
+            cache: Whether matches may be served from the response cache
             
         Returns:
             List of evaluation results for each approach
         """
+        batcher = self.approach_batcher if batched else None
+        sanitized_solution_code = secure_student_code(solution_code)
         tasks = []
         
         # Create a task for each approach
         for approach_name, approach_details in parsed_rubric["approaches"].items():
-            task = self._evaluate_single_approach(
+            single = functools.partial(
+                self._evaluate_single_approach,
                 problem_statement,
                 approach_name,
                 approach_details,
                 sanitized_solution_code,
-                model_solution
+                model_solution,
+                cache=cache
             )
+            if batcher is not None:
+                task = batcher.evaluate(
+                    problem_statement,
+                    approach_name,
+                    self._describe_approach(approach_name, approach_details),
+                    solution_code,
+                    single,
+                    model_solution=model_solution,
+                    cache_result=functools.partial(
+                        self._cache_single_approach,
+                        problem_statement,
+                        approach_name,
+                        approach_details,
+                        sanitized_solution_code,
+                        model_solution
+                    )
+                )
+            else:
+                task = single()
             tasks.append(task)
         
         # Run all tasks in parallel
         results = await asyncio.gather(*tasks)
         
+        # Sample students to classify again unbatched, measuring what batching costs in agreement.
+        # The batched results were cached as the unbatched responses, so the shadow bypasses the cache.
+        if batcher is not None and batcher.should_shadow():
+            batcher.schedule_shadow(
+                [dict(result) for result in results],
+                functools.partial(
+                    self._evaluate_approaches_in_parallel,
+                    problem_statement,
+                    parsed_rubric,
+                    solution_code,
+                    model_solution,
+                    batched=False,
+                    cache=False
+                )
+            )
+        
         return results
     
     def _select_best_approach(
@@ -391,12 +571,4 @@ class RubricExtractorAgent:
         Returns:
             Formatted rubric text for evaluation
         """
-        # Format standard rubric
-        approach = extracted_rubric.approach
-        rubric_info = extracted_rubric.rubric
-        result = [f"# {approach}: {rubric_info['name']}"]
-        
-        for i, point in enumerate(rubric_info["points"]):
-            result.append(f"{i+1}. {point['description']} [{point['marks']} marks]")
-        
-        return "\n".join(result)
\ No newline at end of file
+        return format_approach_rubric(extracted_rubric.approach, extracted_rubric.rubric)
@@ -1,10 +1,14 @@
 from fastapi import APIRouter
 from app.api.auth_api import router as auth_router
 from app.api.evaluation_api import router as evaluation_router
+from app.api.metrics_api import router as metrics_router
+from app.api.problem_api import router as problem_router
 # Main API router that includes all other routers
 api_router = APIRouter()
 
 # Include all API routers here
 api_router.include_router(auth_router)
 api_router.include_router(evaluation_router)
+api_router.include_router(metrics_router)
+api_router.include_router(problem_router)
 
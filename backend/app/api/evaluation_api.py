@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
 from typing import Optional, Dict, Any
 from pydantic import BaseModel
@@ -12,10 +12,13 @@ handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s -
 logger.addHandler(handler)
 from app.db.database import get_db
 from app.db.models import Problem, Submission, EvaluationStatus, User, EvaluationDetail
-from app.services.evaluation_service import EvaluationService, EvaluationRequest, EvaluationResponse
+from app.services.evaluation_service import EvaluationResponse, EVALUATION_MODES
+from app.services.evaluation_jobs import evaluation_job_queue, EVALUATION_DISPATCH
+from app.services.evaluation_executor import evaluation_executor, EvaluationTask, ExecutorSaturated, flow_key
 from app.services.llm_client_service import LLMClientService
+from app.services.feedback_service import feedback_service
 from app.utils.security import check_for_injection
-from app.api.auth_api import get_current_user
+from app.api.auth_api import get_current_user, get_current_admin
 
 # Create router
 router = APIRouter(prefix="/evaluation", tags=["Evaluation"])
@@ -34,88 +37,74 @@ class SubmissionResponse(BaseModel):
     submission_id: int
     status: str
     message: str
+    queue_position: Optional[int] = None  # Evaluations ahead of this one in the in-process executor
 
 # Initialize services
-evaluation_service = EvaluationService()
 llm_client_service = LLMClientService()
 
-# Helper function to update submission status and score
-async def _update_submission_status(
-    db: Session, 
-    submission_id: int, 
-    status: EvaluationStatus, 
-    score: Optional[float] = None,
-    error: Optional[str] = None
-):
-    submission = db.query(Submission).filter(Submission.id == submission_id).first()
-    if submission:
-        submission.evaluation_status = status
-        if score is not None:
-            submission.total_score = score
-        db.commit()
-        
-# Background task for asynchronous evaluation
-async def _process_evaluation(
-    submission_id: int,
-    problem_id: int,
-    code: str,
-    language: str,
-    db: Session
-):
+def _check_admission(user_id: Optional[int], problem_id: Optional[int] = None, regrade: bool = False):
+    """
+    Refuse new evaluations with 429 while the in-process executor is saturated,
+    or while the user already has their share of it waiting
+    """
+    if EVALUATION_DISPATCH == "queue":
+        return
     try:
-        # Update status to 'processing'
-        await _update_submission_status(db, submission_id, EvaluationStatus.pending)
-        
-        # Get problem from database
-        problem = db.query(Problem).filter(Problem.id == problem_id).first()
-        if not problem:
-            await _update_submission_status(db, submission_id, EvaluationStatus.error)
-            return
-        
-        # Prepare evaluation request
-        eval_request = EvaluationRequest(
-            problem_statement=problem.problem_description,
-            rubric=problem.rubric,
-            student_code=code,
-            language=language
+        evaluation_executor.check_admission(flow_key(user_id, problem_id, regrade))
+    except ExecutorSaturated as e:
+        if e.per_user:
+            detail = f"You already have {e.queue_length} submissions waiting for evaluation. Retry in {e.retry_after} seconds"
+        else:
+            detail = f"Evaluation queue is full ({e.queue_length} submissions waiting). Retry in {e.retry_after} seconds"
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=detail,
+            headers={"Retry-After": str(e.retry_after), "X-Queue-Length": str(e.queue_length)}
         )
-        
-        # Perform evaluation
-        result = await evaluation_service.evaluate_submission(eval_request)
-        
-        # Update submission with results
-        submission = db.query(Submission).filter(Submission.id == submission_id).first()
-        if submission:
-            submission.evaluation_status = EvaluationStatus.completed
-            submission.total_score = result.score
-            
-            # Save detailed evaluation results
-            for point_id, feedback_item in result.feedback.items():
-                detail = EvaluationDetail(
-                    submission_id=submission_id,
-                    criterion_index=int(point_id),
-                    max_score=feedback_item.max_points,
-                    score_obtained=feedback_item.points_awarded,
-                    feedback=feedback_item.feedback
-                )
-                db.add(detail)
-            
-            db.commit()
-            
-    except Exception as e:
-        # Update status to 'error' on exception
-        await _update_submission_status(db, submission_id, EvaluationStatus.error)
-        logger.error(f"Error in evaluation process: {str(e)}", exc_info=True)
+
+def _dispatch_evaluation(
+    db: Session,
+    submission: Submission,
+    regrade: bool = False,
+    evaluation_mode: Optional[str] = None
+) -> Optional[int]:
+    """
+    Hand a submission to the configured dispatcher: a worker process through
+    the job queue, or the in-process executor
+
+    Returns:
+        Position in the executor's waiting queue, None for the job queue
+    """
+    if EVALUATION_DISPATCH == "queue":
+        evaluation_job_queue.enqueue(
+            db,
+            submission.id,
+            user_id=submission.user_id,
+            regrade=regrade,
+            evaluation_mode=evaluation_mode
+        )
+        return None
+    
+    # The executor opens its own session; the request's session is closed with the request
+    return evaluation_executor.submit(EvaluationTask(
+        submission_id=submission.id,
+        problem_id=submission.problem_id,
+        code=submission.code,
+        language=submission.language,
+        user_id=submission.user_id,
+        regrade=regrade,
+        evaluation_mode=evaluation_mode
+    ))
 
 @router.post("/submit", response_model=SubmissionResponse)
 async def submit_code(
     request: SubmissionRequest,
-    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """
-    Submit code for evaluation
+    Submit code for evaluation; refused with 429 and a Retry-After header
+    while the evaluation queue is full
     """
     # Check if problem exists
     problem = db.query(Problem).filter(Problem.id == request.problem_id).first()
@@ -133,6 +122,9 @@ async def submit_code(
             detail=f"Security check failed: {', '.join(issues)}"
         )
     
+    # Refuse before storing anything when the submission could not be queued
+    _check_admission(current_user.id, request.problem_id)
+    
     # Create submission record
     submission = Submission(
         user_id=current_user.id,
@@ -146,20 +138,54 @@ async def submit_code(
     db.commit()
     db.refresh(submission)
     
-    # Queue evaluation as background task
-    background_tasks.add_task(
-        _process_evaluation,
-        submission.id,
-        request.problem_id,
-        request.code,
-        request.language,
-        db
+    # Queue evaluation
+    queue_position = _dispatch_evaluation(db, submission)
+    
+    return SubmissionResponse(
+        submission_id=submission.id,
+        status="pending",
+        message="Submission received and queued for evaluation",
+        queue_position=queue_position
     )
+
+@router.post("/regrade/{submission_id}", response_model=SubmissionResponse)
+async def regrade_submission(
+    submission_id: int,
+    evaluation_mode: Optional[str] = None,
+    current_user: User = Depends(get_current_admin),
+    db: Session = Depends(get_db)
+):
+    """
+    Re-evaluate a submission, bypassing stored evaluation results, optionally
+    in another evaluation mode than the problem's
+    """
+    if evaluation_mode is not None and evaluation_mode not in EVALUATION_MODES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown evaluation mode. Use one of: {', '.join(EVALUATION_MODES)}"
+        )
+    
+    submission = db.query(Submission).filter(Submission.id == submission_id).first()
+    
+    if not submission:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Submission not found"
+        )
+    
+    _check_admission(submission.user_id, submission.problem_id, regrade=True)
+    
+    submission.evaluation_status = EvaluationStatus.pending
+    db.commit()
+    
+    # Queue evaluation
+    queue_position = _dispatch_evaluation(db, submission, regrade=True, evaluation_mode=evaluation_mode)
     
     return SubmissionResponse(
         submission_id=submission.id,
         status="pending",
-        message="Submission received and queued for evaluation"
+        message="Submission queued for regrading",
+        queue_position=queue_position
     )
 
 @router.get("/status/{submission_id}")
@@ -187,7 +213,8 @@ async def check_evaluation_status(
         return {
             "submission_id": submission.id,
             "status": "pending",
-            "message": "Evaluation in progress"
+            "message": "Evaluation in progress",
+            "queue_position": evaluation_executor.position(submission.id)
         }
     elif submission.evaluation_status == EvaluationStatus.completed:
         return {
@@ -206,11 +233,14 @@ async def check_evaluation_status(
 @router.get("/results/{submission_id}", response_model=EvaluationResponse)
 async def get_evaluation_results(
     submission_id: int,
+    include_feedback: bool = True,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """
-    Get detailed evaluation results for a submission
+    Get detailed evaluation results for a submission. The narrative feedback
+    is generated in the background on the first request that includes it,
+    which reports it as "generating"; later requests return the stored feedback.
     """
     # Check if submission exists and belongs to user
     submission = db.query(Submission).filter(
@@ -248,10 +278,16 @@ async def get_evaluation_results(
     # Calculate max score from details
     max_score = sum(detail.max_score for detail in details)
     
+    overall_feedback, feedback_status = None, None
+    if include_feedback:
+        overall_feedback, feedback_status = await feedback_service.request_feedback(submission_id)
+    
     return EvaluationResponse(
         score=submission.total_score,
         max_score=max_score,
         feedback=feedback_dict,
+        overall_feedback=overall_feedback,
+        feedback_status=feedback_status,
         error=None
     )
 
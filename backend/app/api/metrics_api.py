@@ -0,0 +1,135 @@
+import json
+from fastapi import APIRouter, Depends
+from sqlalchemy.orm import Session
+from typing import Dict, Any, Optional
+
+from app.db.database import get_db
+from app.db.models import User, WorkerStatus
+from app.api.auth_api import get_current_admin
+from app.utils.llm_utils import (
+    llm_scheduler,
+    llm_cache,
+    llm_single_flight,
+    llm_hedge_stats,
+    llm_circuit_breakers,
+    structured_output_stats
+)
+from app.utils.llm_streaming import streaming_stats
+from app.utils.llm_budgets import llm_token_usage, llm_prompt_cache
+from app.utils.prompt_builder import prompt_budget_stats
+from app.utils.prompt_templates import template_savings_report
+from app.utils.stage_graph import stage_timing_stats
+from app.services.guidance_service import guidance_store
+from app.services.problem_artifacts import problem_artifact_store
+from app.services.result_cache import evaluation_result_cache
+from app.services.near_duplicate_service import near_duplicate_index
+from app.services.pointwise_service import pointwise_evaluator
+from app.services.feedback_service import feedback_service
+from app.services.approach_batcher import approach_match_batcher
+from app.services.evaluation_jobs import evaluation_job_queue, EVALUATION_DISPATCH
+from app.services.evaluation_executor import evaluation_executor
+
+# Create router
+router = APIRouter(prefix="/metrics", tags=["Metrics"])
+
+@router.get("/llm")
+async def get_llm_metrics(
+    current_user: User = Depends(get_current_admin)
+) -> Dict[str, Any]:
+    """
+    Get LLM client, evaluation pipeline and grading cache metrics
+    """
+    return {
+        "scheduler": llm_scheduler.get_metrics(),
+        "cache": llm_cache.get_metrics(),
+        "coalescing": llm_single_flight.get_metrics(),
+        "hedging": llm_hedge_stats.get_metrics(),
+        "circuit_breakers": llm_circuit_breakers.get_metrics(),
+        "streaming": streaming_stats.get_metrics(),
+        "structured_output": dict(structured_output_stats),
+        "token_usage": llm_token_usage.get_metrics(),
+        "prompt_cache": llm_prompt_cache.get_metrics(),
+        "prompt_budget": prompt_budget_stats.get_metrics(),
+        "prompt_templates": template_savings_report(),
+        "pipeline_stages": stage_timing_stats.get_metrics(),
+        "guidance": guidance_store.get_metrics(),
+        "problem_artifacts": problem_artifact_store.get_metrics(),
+        "evaluation_results": evaluation_result_cache.get_metrics(),
+        "near_duplicates": near_duplicate_index.get_metrics(),
+        "pointwise": pointwise_evaluator.get_metrics(),
+        "feedback": feedback_service.get_metrics(),
+        "approach_batching": approach_match_batcher.get_metrics()
+    }
+
+@router.delete("/llm/cache")
+async def invalidate_llm_cache(
+    template_version: Optional[str] = None,
+    current_user: User = Depends(get_current_admin)
+) -> Dict[str, Any]:
+    """
+    Invalidate cached LLM responses for one prompt-template version, or all of them
+    """
+    await llm_cache.invalidate(template_version=template_version)
+    return {
+        "message": "LLM response cache invalidated",
+        "template_version": template_version
+    }
+
+@router.delete("/evaluation/cache")
+async def invalidate_evaluation_cache(
+    pipeline_version: Optional[str] = None,
+    current_user: User = Depends(get_current_admin)
+) -> Dict[str, Any]:
+    """
+    Invalidate stored evaluation results for one pipeline version, or all of them
+    """
+    await evaluation_result_cache.invalidate(pipeline_version)
+    return {
+        "message": "Evaluation result cache invalidated",
+        "pipeline_version": pipeline_version
+    }
+
+@router.get("/evaluation/jobs")
+async def get_evaluation_job_metrics(
+    current_user: User = Depends(get_current_admin)
+) -> Dict[str, Any]:
+    """
+    Get the dispatch mode, the number of evaluation jobs in each state and
+    the in-process executor's slots and waiting queue
+    """
+    return {
+        **evaluation_job_queue.get_metrics(),
+        "executor": evaluation_executor.get_metrics()
+    }
+
+@router.get("/evaluation/queues")
+async def get_evaluation_queue_lengths(
+    current_user: User = Depends(get_current_admin)
+) -> Dict[str, Any]:
+    """
+    Get queued and running evaluations per user, in the job queue and the
+    in-process executor, longest queue first
+    """
+    return {
+        "dispatch": EVALUATION_DISPATCH,
+        "job_queue": evaluation_job_queue.get_queue_lengths(),
+        "executor": evaluation_executor.get_queue_lengths()
+    }
+
+@router.get("/evaluation/workers")
+async def get_evaluation_worker_metrics(
+    current_user: User = Depends(get_current_admin),
+    db: Session = Depends(get_db)
+) -> Dict[str, Any]:
+    """
+    Get the metrics last reported by each evaluation worker: jobs run and
+    problem-affinity batch sizes with the prompt cache hits they produce
+    """
+    workers = db.query(WorkerStatus).order_by(WorkerStatus.updated_at.desc()).all()
+    return {
+        worker.worker_id: {
+            "updated_at": worker.updated_at,
+            **json.loads(worker.metrics)
+        }
+        for worker in workers
+    }
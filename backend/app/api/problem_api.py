@@ -0,0 +1,177 @@
+from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks
+from sqlalchemy.orm import Session
+from typing import Optional, List, Dict, Any
+from pydantic import BaseModel
+import logging
+
+from app.db.database import get_db
+from app.db.models import Problem, Submission, User, ProblemSettings
+from app.api.auth_api import get_current_admin
+from app.services.guidance_service import guidance_store
+from app.services.problem_artifacts import problem_artifact_store
+from app.services.near_duplicate_service import near_duplicate_index, NEAR_DUPLICATE_CLUSTER_THRESHOLD
+from app.services.evaluation_service import EVALUATION_MODES
+
+logger = logging.getLogger(__name__)
+
+# Create router
+router = APIRouter(prefix="/problems", tags=["Problems"])
+
+# Request models
+class ProblemCreateRequest(BaseModel):
+    title: str
+    problem_description: str
+    rubric: str
+    topic: Optional[str] = None
+    editorial: Optional[str] = None
+    evaluation_mode: Optional[str] = None  # One of EVALUATION_MODES, defaults to EVALUATION_MODE
+
+class ProblemUpdateRequest(BaseModel):
+    title: Optional[str] = None
+    problem_description: Optional[str] = None
+    rubric: Optional[str] = None
+    topic: Optional[str] = None
+    editorial: Optional[str] = None
+    evaluation_mode: Optional[str] = None
+
+# Response models
+class ProblemResponse(BaseModel):
+    problem_id: int
+    title: str
+    topic: Optional[str] = None
+    evaluation_mode: Optional[str] = None
+    guidance_scheduled: bool
+
+def _validate_evaluation_mode(evaluation_mode: Optional[str]) -> None:
+    if evaluation_mode is not None and evaluation_mode not in EVALUATION_MODES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown evaluation mode. Use one of: {', '.join(EVALUATION_MODES)}"
+        )
+
+def _get_settings(db: Session, problem_id: int) -> Optional[ProblemSettings]:
+    return db.query(ProblemSettings).filter(ProblemSettings.problem_id == problem_id).first()
+
+@router.post("", response_model=ProblemResponse, status_code=status.HTTP_201_CREATED)
+async def create_problem(
+    request: ProblemCreateRequest,
+    background_tasks: BackgroundTasks,
+    current_user: User = Depends(get_current_admin),
+    db: Session = Depends(get_db)
+):
+    """
+    Create a problem, build its artifacts and precompute its evaluation
+    guidance in the background
+    """
+    _validate_evaluation_mode(request.evaluation_mode)
+    
+    problem = Problem(**request.dict(exclude={"evaluation_mode"}))
+    db.add(problem)
+    db.commit()
+    db.refresh(problem)
+    
+    if request.evaluation_mode is not None:
+        db.add(ProblemSettings(problem_id=problem.id, evaluation_mode=request.evaluation_mode))
+        db.commit()
+
+    problem_artifact_store.refresh(problem.problem_description, problem.rubric, problem.id)
+    background_tasks.add_task(guidance_store.precompute, problem.id)
+
+    return ProblemResponse(
+        problem_id=problem.id,
+        title=problem.title,
+        topic=problem.topic,
+        evaluation_mode=request.evaluation_mode,
+        guidance_scheduled=True
+    )
+
+@router.put("/{problem_id}", response_model=ProblemResponse)
+async def update_problem(
+    problem_id: int,
+    request: ProblemUpdateRequest,
+    background_tasks: BackgroundTasks,
+    current_user: User = Depends(get_current_admin),
+    db: Session = Depends(get_db)
+):
+    """
+    Update a problem; when its statement or rubric changes, its artifacts are
+    rebuilt and its evaluation guidance is regenerated in the background.
+    Changing the evaluation mode affects later evaluations only.
+    """
+    problem = db.query(Problem).filter(Problem.id == problem_id).first()
+    if not problem:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Problem not found"
+        )
+
+    changes = request.dict(exclude_unset=True)
+    settings = _get_settings(db, problem_id)
+    if "evaluation_mode" in changes:
+        evaluation_mode = changes.pop("evaluation_mode")
+        _validate_evaluation_mode(evaluation_mode)
+        if settings is None:
+            settings = ProblemSettings(problem_id=problem_id)
+            db.add(settings)
+        settings.evaluation_mode = evaluation_mode
+    
+    content_changed = any(
+        field in changes and changes[field] != getattr(problem, field)
+        for field in ("problem_description", "rubric")
+    )
+    for field, value in changes.items():
+        setattr(problem, field, value)
+    db.commit()
+
+    if content_changed:
+        problem_artifact_store.refresh(problem.problem_description, problem.rubric, problem.id)
+        guidance_store.invalidate(problem.id)
+        background_tasks.add_task(guidance_store.precompute, problem.id)
+
+    return ProblemResponse(
+        problem_id=problem.id,
+        title=problem.title,
+        topic=problem.topic,
+        evaluation_mode=settings.evaluation_mode if settings else None,
+        guidance_scheduled=content_changed
+    )
+
+@router.get("/{problem_id}/similar/{submission_id}")
+async def get_similar_submissions(
+    problem_id: int,
+    submission_id: int,
+    threshold: float = NEAR_DUPLICATE_CLUSTER_THRESHOLD,
+    limit: int = 10,
+    current_user: User = Depends(get_current_admin),
+    db: Session = Depends(get_db)
+) -> List[Dict[str, Any]]:
+    """
+    Find graded submissions to a problem that are near-duplicates of a submission
+    """
+    signature = near_duplicate_index.submission_signature(problem_id, submission_id)
+    if signature is None:
+        submission = db.query(Submission).filter(
+            Submission.id == submission_id,
+            Submission.problem_id == problem_id
+        ).first()
+        if not submission:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Submission not found"
+            )
+        signature = near_duplicate_index.signature(submission.code, submission.language)
+
+    return near_duplicate_index.neighbors(problem_id, signature, threshold, limit, exclude=submission_id)
+
+@router.get("/{problem_id}/clusters")
+async def get_submission_clusters(
+    problem_id: int,
+    threshold: float = NEAR_DUPLICATE_CLUSTER_THRESHOLD,
+    min_size: int = 3,
+    current_user: User = Depends(get_current_admin)
+) -> List[Dict[str, Any]]:
+    """
+    Get clusters of near-duplicate submissions to a problem; clusters spanning
+    several users are flagged as suspicious
+    """
+    return near_duplicate_index.clusters(problem_id, threshold, min_size)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, Float, ForeignKey, DateTime, Enum, Boolean
+from sqlalchemy import Column, Integer, String, Text, Float, ForeignKey, DateTime, Enum, Boolean, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
@@ -60,6 +60,32 @@ class ExampleFeedback(Base):
     # Relationships
     problem = relationship("Problem", back_populates="example_feedbacks")
 
+class ProblemGuidance(Base):
+    __tablename__ = "problem_guidance"
+    __table_args__ = (
+        UniqueConstraint("problem_id", "approach", "rubric_version", name="uq_problem_guidance_version"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    problem_id = Column(Integer, ForeignKey("problems.id", ondelete="CASCADE"), nullable=False, index=True)
+    approach = Column(String, nullable=False)  # Rubric approach key, e.g. "Solution 1"
+    rubric_version = Column(String, nullable=False)  # Hash of problem text, rubric and guidance prompt version
+    guidance = Column(Text, nullable=False)  # AlgorithmGuidance as JSON
+    created_at = Column(DateTime, default=func.now(), nullable=False)
+
+    # Relationships
+    problem = relationship("Problem")
+
+class ProblemSettings(Base):
+    __tablename__ = "problem_settings"
+
+    problem_id = Column(Integer, ForeignKey("problems.id", ondelete="CASCADE"), primary_key=True)
+    evaluation_mode = Column(String, nullable=True)  # multi_agent, fused; NULL uses the EVALUATION_MODE default
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now(), nullable=False)
+
+    # Relationships
+    problem = relationship("Problem")
+
 class EvaluationStatus(enum.Enum):
     pending = "pending"
     completed = "completed"
@@ -94,4 +120,48 @@ class EvaluationDetail(Base):
     feedback = Column(Text, nullable=True)
     
     # Relationships
-    submission = relationship("Submission", back_populates="evaluation_details")
\ No newline at end of file
+    submission = relationship("Submission", back_populates="evaluation_details")
+
+class JobStatus(enum.Enum):
+    queued = "queued"
+    running = "running"
+    completed = "completed"
+    failed = "failed"
+
+class EvaluationJob(Base):
+    __tablename__ = "evaluation_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    submission_id = Column(Integer, ForeignKey("submissions.id", ondelete="CASCADE"), nullable=False, index=True)
+    user_id = Column(Integer, nullable=True)
+    regrade = Column(Boolean, default=False, nullable=False)
+    evaluation_mode = Column(String, nullable=True)  # Overrides the problem's mode for this job
+    status = Column(Enum(JobStatus), default=JobStatus.queued, nullable=False, index=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    max_attempts = Column(Integer, default=3, nullable=False)
+    available_at = Column(DateTime, default=func.now(), nullable=False, index=True)  # Not claimed before this, for retry backoff
+    worker_id = Column(String, nullable=True)  # Worker holding the job while running
+    heartbeat_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=func.now(), nullable=False)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now(), nullable=False)
+
+    # Relationships
+    submission = relationship("Submission")
+
+class SubmissionFeedback(Base):
+    __tablename__ = "submission_feedback"
+
+    submission_id = Column(Integer, ForeignKey("submissions.id", ondelete="CASCADE"), primary_key=True)
+    feedback = Column(Text, nullable=False)  # Narrative feedback, generated on first request
+    created_at = Column(DateTime, default=func.now(), nullable=False)
+
+    # Relationships
+    submission = relationship("Submission")
+
+class WorkerStatus(Base):
+    __tablename__ = "worker_status"
+
+    worker_id = Column(String, primary_key=True)
+    metrics = Column(Text, nullable=False)  # Worker metrics as JSON, written periodically by the worker
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now(), nullable=False)
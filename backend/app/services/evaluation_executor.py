@@ -0,0 +1,339 @@
+import os
+import math
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Dict, Any, Optional, Set, Tuple, Hashable
+from pydantic import BaseModel
+from dotenv import load_dotenv
+
+from app.db.database import SessionLocal
+from app.services.evaluation_jobs import process_evaluation
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# In-process executor configuration; keep max in-flight below the database pool size
+EXECUTOR_MAX_IN_FLIGHT = int(os.getenv("EXECUTOR_MAX_IN_FLIGHT", "4"))
+EXECUTOR_MAX_QUEUED = int(os.getenv("EXECUTOR_MAX_QUEUED", "100"))
+# Assumed evaluation duration in seconds until one has been measured
+EXECUTOR_INITIAL_DURATION = float(os.getenv("EXECUTOR_INITIAL_DURATION", "30"))
+# Fair share: evaluations of one user (or one user and problem) form a flow
+EXECUTOR_FAIR_SHARE_BY_PROBLEM = os.getenv("EXECUTOR_FAIR_SHARE_BY_PROBLEM", "false").lower() == "true"
+EXECUTOR_MAX_IN_FLIGHT_PER_USER = int(os.getenv("EXECUTOR_MAX_IN_FLIGHT_PER_USER", "1"))
+EXECUTOR_MAX_QUEUED_PER_USER = int(os.getenv("EXECUTOR_MAX_QUEUED_PER_USER", "10"))
+EXECUTOR_USER_WEIGHT = float(os.getenv("EXECUTOR_USER_WEIGHT", "1.0"))
+# Regrades of all users share one flow with this weight
+EXECUTOR_REGRADE_WEIGHT = float(os.getenv("EXECUTOR_REGRADE_WEIGHT", "0.5"))
+
+class EvaluationTask(BaseModel):
+    """An evaluation waiting for or holding an executor slot"""
+    submission_id: int
+    problem_id: int
+    code: str
+    language: str
+    user_id: Optional[int] = None
+    regrade: bool = False
+    evaluation_mode: Optional[str] = None
+
+class ExecutorSaturated(Exception):
+    """Raised when the executor's waiting queue, or a user's share of it, is full"""
+
+    def __init__(self, retry_after: int, queue_length: int, per_user: bool = False):
+        super().__init__(f"Evaluation queue is full ({queue_length} waiting)")
+        self.retry_after = retry_after
+        self.queue_length = queue_length
+        self.per_user = per_user
+
+class _Flow:
+    """Waiting evaluations of one user, with their virtual finish tags"""
+
+    def __init__(self, weight: float):
+        self.weight = weight
+        self.waiting: Deque[Tuple[float, EvaluationTask, float]] = deque()
+        self.in_flight = 0
+        self.last_finish = 0.0
+
+def flow_key(user_id: Optional[int], problem_id: Optional[int] = None, regrade: bool = False) -> Hashable:
+    """
+    Fair-share flow of an evaluation: its user, optionally split by problem;
+    regrades form a flow of their own
+    """
+    if regrade:
+        return "regrade"
+    if EXECUTOR_FAIR_SHARE_BY_PROBLEM:
+        return f"user:{user_id}:problem:{problem_id}"
+    return f"user:{user_id}"
+
+class EvaluationExecutor:
+    """
+    Runs evaluations inside the API process with bounded concurrency and
+    weighted fair queuing between users
+
+    At most max_in_flight evaluations run at once, each with a database
+    session of its own that is closed when it finishes; up to max_queued
+    more wait. Beyond that, submissions are refused with a retry hint
+    instead of being buffered, so memory and connection-pool usage stay
+    bounded whatever the burst.
+
+    Waiting evaluations are grouped into flows, one per user. Each evaluation
+    gets a virtual finish tag, max(virtual time, the flow's previous tag)
+    plus 1 / weight, and the free slot goes to the smallest tag among flows
+    below their in-flight limit. A user submitting in a loop therefore only
+    delays their own evaluations: everyone else's next evaluation is
+    tagged ahead of the backlog. Each flow may also hold only a bounded
+    share of the waiting queue.
+
+    A submission is evaluated at most once at a time. Submitting it again
+    while it waits updates the waiting evaluation; a regrade submitted while
+    it runs is held as a single follow-up that is queued once the running
+    evaluation finishes.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = EXECUTOR_MAX_IN_FLIGHT,
+        max_queued: int = EXECUTOR_MAX_QUEUED,
+        max_in_flight_per_user: int = EXECUTOR_MAX_IN_FLIGHT_PER_USER,
+        max_queued_per_user: int = EXECUTOR_MAX_QUEUED_PER_USER
+    ):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queued = max(0, max_queued)
+        self.max_in_flight_per_user = max(1, max_in_flight_per_user)
+        self.max_queued_per_user = max(1, max_queued_per_user)
+        self._flows: Dict[Hashable, _Flow] = {}
+        self._virtual_time = 0.0
+        self._running: Set[asyncio.Task] = set()
+        self._running_submissions: Set[int] = set()
+        self._follow_ups: Dict[int, EvaluationTask] = {}
+        self._avg_duration = EXECUTOR_INITIAL_DURATION
+        self._time_to_grade: Deque[float] = deque(maxlen=1000)
+
+        # Metrics
+        self.accepted = 0
+        self.rejected = 0
+        self.rejected_per_user = 0
+        self.completed = 0
+        self.max_queue_length = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._running)
+
+    @property
+    def queue_length(self) -> int:
+        return sum(len(flow.waiting) for flow in self._flows.values())
+
+    def retry_after(self) -> int:
+        """
+        Seconds until a waiting slot is likely to free up
+        """
+        return max(1, math.ceil(self._avg_duration / self.max_in_flight))
+
+    def check_admission(self, key: Optional[Hashable] = None) -> None:
+        """
+        Raise ExecutorSaturated if a new evaluation would not be accepted
+
+        Args:
+            key: The evaluation's flow, to also check its share of the queue
+        """
+        queue_length = self.queue_length
+        flow = self._flows.get(key) if key is not None else None
+        # Per-user limits can keep evaluations waiting while global slots are free, so the
+        # queue limit applies to every evaluation that would not start right away
+        starts_now = self.in_flight < self.max_in_flight and (
+            flow is None or (not flow.waiting and flow.in_flight < self.max_in_flight_per_user)
+        )
+        if queue_length >= self.max_queued and not starts_now:
+            self.rejected += 1
+            raise ExecutorSaturated(self.retry_after(), queue_length)
+
+        if flow is not None and len(flow.waiting) >= self.max_queued_per_user:
+            self.rejected_per_user += 1
+            # The flow's next evaluation starts after its in-flight ones finish
+            retry_after = max(1, math.ceil(self._avg_duration / self.max_in_flight_per_user))
+            raise ExecutorSaturated(retry_after, len(flow.waiting), per_user=True)
+
+    def submit(self, task: EvaluationTask) -> int:
+        """
+        Start an evaluation, or queue it when all slots are busy
+
+        Args:
+            task: The evaluation to run
+
+        Returns:
+            Position among waiting evaluations, 0 if it started right away or
+            the submission is already being evaluated
+
+        Raises:
+            ExecutorSaturated: If the waiting queue or the user's share of it is full
+        """
+        waiting = self._waiting_task(task.submission_id)
+        if waiting is not None:
+            waiting.regrade = waiting.regrade or task.regrade
+            waiting.evaluation_mode = task.evaluation_mode
+            return self.position(task.submission_id) or 0
+
+        running = task.submission_id in self._running_submissions
+        if running and not task.regrade:
+            return 0
+
+        key = flow_key(task.user_id, task.problem_id, task.regrade)
+        self.check_admission(key)
+        self.accepted += 1
+
+        if running:
+            follow_up = self._follow_ups.setdefault(task.submission_id, task)
+            follow_up.evaluation_mode = task.evaluation_mode
+            return 0
+
+        self._enqueue(key, task)
+        self._dispatch()
+        return self.position(task.submission_id) or 0
+
+    def _waiting_task(self, submission_id: int) -> Optional[EvaluationTask]:
+        for flow in self._flows.values():
+            for _, task, _ in flow.waiting:
+                if task.submission_id == submission_id:
+                    return task
+        return None
+
+    def _enqueue(self, key: Hashable, task: EvaluationTask) -> None:
+        flow = self._flows.get(key)
+        if flow is None:
+            flow = self._flows[key] = _Flow(EXECUTOR_REGRADE_WEIGHT if task.regrade else EXECUTOR_USER_WEIGHT)
+        finish = max(self._virtual_time, flow.last_finish) + 1.0 / flow.weight
+        flow.last_finish = finish
+        flow.waiting.append((finish, task, time.monotonic()))
+        self.max_queue_length = max(self.max_queue_length, self.queue_length)
+
+    def position(self, submission_id: int) -> Optional[int]:
+        """
+        Position of a submission among waiting evaluations in dispatch order,
+        starting at 1; 0 while it runs and None if the executor does not hold it
+        """
+        if submission_id in self._running_submissions:
+            return 0
+        for flow in self._flows.values():
+            for finish, task, _ in flow.waiting:
+                if task.submission_id == submission_id:
+                    ahead = sum(
+                        1
+                        for other in self._flows.values()
+                        for other_finish, _, _ in other.waiting
+                        if other_finish < finish
+                    )
+                    return ahead + 1
+        return None
+
+    def _next_flow(self) -> Optional[Hashable]:
+        best_key, best_finish = None, None
+        for key, flow in self._flows.items():
+            if not flow.waiting or flow.in_flight >= self.max_in_flight_per_user:
+                continue
+            finish = flow.waiting[0][0]
+            if best_finish is None or finish < best_finish:
+                best_key, best_finish = key, finish
+        return best_key
+
+    def _dispatch(self) -> None:
+        while self.in_flight < self.max_in_flight:
+            key = self._next_flow()
+            if key is None:
+                return
+            flow = self._flows[key]
+            finish, task, enqueued_at = flow.waiting.popleft()
+            self._virtual_time = max(self._virtual_time, finish - 1.0 / flow.weight)
+            flow.in_flight += 1
+            self._running_submissions.add(task.submission_id)
+            running = asyncio.create_task(self._run(key, task, enqueued_at))
+            self._running.add(running)
+            running.add_done_callback(self._finish)
+
+    def _finish(self, running: asyncio.Task) -> None:
+        self._running.discard(running)
+        self._dispatch()
+
+    async def _run(self, key: Hashable, task: EvaluationTask, enqueued_at: float) -> None:
+        started = time.monotonic()
+        db = SessionLocal()
+        try:
+            await process_evaluation(
+                task.submission_id,
+                task.problem_id,
+                task.code,
+                task.language,
+                db,
+                regrade=task.regrade,
+                user_id=task.user_id,
+                evaluation_mode=task.evaluation_mode
+            )
+        except Exception as e:
+            logger.error(f"Unhandled error evaluating submission {task.submission_id}: {str(e)}", exc_info=True)
+        finally:
+            db.close()
+            self._running_submissions.discard(task.submission_id)
+            flow = self._flows[key]
+            flow.in_flight -= 1
+            if not flow.waiting and not flow.in_flight:
+                del self._flows[key]
+            # Queued now and started by _finish once this task's slot is released
+            follow_up = self._follow_ups.pop(task.submission_id, None)
+            if follow_up is not None:
+                self._enqueue(flow_key(follow_up.user_id, follow_up.problem_id, follow_up.regrade), follow_up)
+            self.completed += 1
+            finished = time.monotonic()
+            self._time_to_grade.append(finished - enqueued_at)
+            # Moving average of evaluation time, for the retry hint
+            self._avg_duration = 0.8 * self._avg_duration + 0.2 * (finished - started)
+
+    async def shutdown(self) -> None:
+        """
+        Drop waiting evaluations and follow-ups and wait for running ones to
+        finish; dropped submissions stay pending
+        """
+        queue_length = self.queue_length + len(self._follow_ups)
+        if queue_length:
+            logger.warning(f"Dropping {queue_length} waiting evaluations on shutdown")
+            for flow in self._flows.values():
+                flow.waiting.clear()
+            self._follow_ups.clear()
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+
+    def get_queue_lengths(self) -> Dict[str, Dict[str, int]]:
+        """
+        Waiting and running evaluations per flow, longest queue first
+        """
+        lengths = {
+            str(key): {"queued": len(flow.waiting), "in_flight": flow.in_flight}
+            for key, flow in self._flows.items()
+        }
+        return dict(sorted(lengths.items(), key=lambda item: item[1]["queued"], reverse=True))
+
+    def get_metrics(self) -> Dict[str, Any]:
+        times = sorted(self._time_to_grade)
+        return {
+            "max_in_flight": self.max_in_flight,
+            "max_queued": self.max_queued,
+            "max_in_flight_per_user": self.max_in_flight_per_user,
+            "max_queued_per_user": self.max_queued_per_user,
+            "in_flight": self.in_flight,
+            "queue_length": self.queue_length,
+            "max_queue_length": self.max_queue_length,
+            "follow_ups": len(self._follow_ups),
+            "flows": len(self._flows),
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "rejected_per_user": self.rejected_per_user,
+            "completed": self.completed,
+            "avg_duration_seconds": self._avg_duration,
+            "retry_after_seconds": self.retry_after(),
+            "p50_time_to_grade_seconds": times[len(times) // 2] if times else 0.0,
+            "p95_time_to_grade_seconds": times[min(len(times) - 1, int(len(times) * 0.95))] if times else 0.0
+        }
+
+evaluation_executor = EvaluationExecutor()
@@ -0,0 +1,488 @@
+import os
+import logging
+import datetime
+from typing import Dict, Any, Optional
+from pydantic import BaseModel
+from sqlalchemy import exists, func
+from sqlalchemy.orm import Session, aliased
+from dotenv import load_dotenv
+
+from app.db.database import SessionLocal
+from app.db.models import (
+    Problem,
+    Submission,
+    EvaluationStatus,
+    EvaluationDetail,
+    ProblemSettings,
+    SubmissionFeedback,
+    EvaluationJob,
+    JobStatus
+)
+from app.services.evaluation_service import EvaluationService, EvaluationRequest
+from app.services.feedback_service import feedback_service
+from app.utils.llm_resilience import RetryPolicy
+from app.utils.llm_scheduler import Priority, priority_scope
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# How submissions are graded: "background" runs the evaluation inside the API
+# process, "queue" stores a job that a worker process (python -m app.workers) claims
+EVALUATION_DISPATCH = os.getenv("EVALUATION_DISPATCH", "background")
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_BASE_DELAY = float(os.getenv("JOB_RETRY_BASE_DELAY", "30"))
+JOB_RETRY_MAX_DELAY = float(os.getenv("JOB_RETRY_MAX_DELAY", "600"))
+# A running job whose heartbeat is older than this is considered abandoned
+JOB_STALE_AFTER = float(os.getenv("JOB_STALE_AFTER", "120"))
+# Jobs of one user running at once across all workers; 0 disables the limit
+JOB_MAX_RUNNING_PER_USER = int(os.getenv("JOB_MAX_RUNNING_PER_USER", "1"))
+
+evaluation_service = EvaluationService()
+
+class EvaluationJobError(Exception):
+    """Raised when a queued evaluation fails in a way worth retrying"""
+    pass
+
+async def update_submission_status(
+    db: Session,
+    submission_id: int,
+    status: EvaluationStatus,
+    score: Optional[float] = None,
+    error: Optional[str] = None
+):
+    submission = db.query(Submission).filter(Submission.id == submission_id).first()
+    if submission:
+        submission.evaluation_status = status
+        if score is not None:
+            submission.total_score = score
+        db.commit()
+
+async def process_evaluation(
+    submission_id: int,
+    problem_id: int,
+    code: str,
+    language: str,
+    db: Session,
+    regrade: bool = False,
+    user_id: Optional[int] = None,
+    evaluation_mode: Optional[str] = None,
+    retryable: bool = False
+):
+    """
+    Evaluate a submission and store its score and evaluation details
+
+    Args:
+        submission_id: Submission ID
+        problem_id: Problem the submission answers
+        code: The student's code
+        language: Programming language of the code
+        db: Database session owned by the caller
+        regrade: Bypass stored results and grade at regrade priority
+        user_id: Submitting user
+        evaluation_mode: Mode overriding the problem's configured mode
+        retryable: Raise instead of recording a failed evaluation, so that the
+            caller can retry it; used by the job queue
+    """
+    try:
+        # Update status to 'processing'
+        await update_submission_status(db, submission_id, EvaluationStatus.pending)
+
+        # Get problem from database
+        problem = db.query(Problem).filter(Problem.id == problem_id).first()
+        if not problem:
+            await update_submission_status(db, submission_id, EvaluationStatus.error)
+            return
+
+        # A mode chosen for this evaluation overrides the problem's configured mode
+        if evaluation_mode is None:
+            settings = db.query(ProblemSettings).filter(ProblemSettings.problem_id == problem_id).first()
+            evaluation_mode = settings.evaluation_mode if settings else None
+
+        # Prepare evaluation request
+        eval_request = EvaluationRequest(
+            problem_statement=problem.problem_description,
+            rubric=problem.rubric,
+            student_code=code,
+            language=language,
+            problem_id=problem_id,
+            submission_id=submission_id,
+            user_id=user_id,
+            bypass_cache=regrade,
+            evaluation_mode=evaluation_mode
+        )
+
+        # Perform evaluation; regrades yield to interactive submissions
+        with priority_scope(Priority.regrade if regrade else Priority.interactive):
+            result = await evaluation_service.evaluate_submission(eval_request)
+
+        if result.error and retryable:
+            raise EvaluationJobError(result.error)
+
+        # Update submission with results
+        submission = db.query(Submission).filter(Submission.id == submission_id).first()
+        if submission:
+            # Replace the details and feedback of an earlier evaluation
+            db.query(EvaluationDetail).filter(
+                EvaluationDetail.submission_id == submission_id
+            ).delete(synchronize_session=False)
+            db.query(SubmissionFeedback).filter(
+                SubmissionFeedback.submission_id == submission_id
+            ).delete(synchronize_session=False)
+
+            submission.evaluation_status = EvaluationStatus.completed
+            submission.total_score = result.score
+
+            # Save detailed evaluation results
+            for point_id, feedback_item in result.feedback.items():
+                detail = EvaluationDetail(
+                    submission_id=submission_id,
+                    criterion_index=int(point_id),
+                    max_score=feedback_item.max_points,
+                    score_obtained=feedback_item.points_awarded,
+                    feedback=feedback_item.feedback
+                )
+                db.add(detail)
+
+            db.commit()
+
+            # Narrative feedback is generated when first requested, or earlier when the system is idle
+            feedback_service.schedule_prefetch(submission_id)
+
+    except Exception as e:
+        db.rollback()
+        if retryable:
+            logger.warning(f"Evaluation of submission {submission_id} failed: {str(e)}")
+            raise
+        # Update status to 'error' on exception
+        await update_submission_status(db, submission_id, EvaluationStatus.error)
+        logger.error(f"Error in evaluation process: {str(e)}", exc_info=True)
+
+class ClaimedJob(BaseModel):
+    """A job claimed by a worker, with everything needed to run it"""
+    job_id: int
+    submission_id: int
+    problem_id: int
+    code: str
+    language: str
+    user_id: Optional[int] = None
+    regrade: bool = False
+    evaluation_mode: Optional[str] = None
+    attempts: int
+    max_attempts: int
+
+class EvaluationJobQueue:
+    """
+    Durable queue of evaluations in the evaluation_jobs table
+
+    API processes enqueue jobs; worker processes claim them with
+    SELECT ... FOR UPDATE SKIP LOCKED, so any number of workers on any
+    number of nodes can poll the table without claiming a job twice.
+    Running jobs are heartbeated; a job whose worker stopped heartbeating is
+    requeued, and failed jobs are retried with exponential backoff until
+    their attempts run out. All timestamps come from the database clock, so
+    nodes with skewed clocks agree on them.
+
+    Claims are fair between users: the next job comes from the user with the
+    fewest jobs running, and users at their running limit are skipped, so
+    one user's backlog cannot hold every worker. Among equally loaded users,
+    problems another worker is already running are claimed last, so each
+    problem's jobs tend to gather on one worker; workers batching a problem
+    claim its jobs directly by problem ID.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = JOB_MAX_ATTEMPTS,
+        stale_after: float = JOB_STALE_AFTER,
+        max_running_per_user: int = JOB_MAX_RUNNING_PER_USER,
+        requeue_orphans: bool = EVALUATION_DISPATCH == "queue"
+    ):
+        self.max_attempts = max_attempts
+        self.stale_after = stale_after
+        self.max_running_per_user = max_running_per_user
+        # Pending submissions without a job are only orphans when the queue dispatches every
+        # evaluation; otherwise an API process may still be grading them in-process
+        self.requeue_orphans = requeue_orphans
+        self.retry_policy = RetryPolicy(base_delay=JOB_RETRY_BASE_DELAY, max_delay=JOB_RETRY_MAX_DELAY)
+
+    def enqueue(
+        self,
+        db: Session,
+        submission_id: int,
+        user_id: Optional[int] = None,
+        regrade: bool = False,
+        evaluation_mode: Optional[str] = None
+    ) -> EvaluationJob:
+        """
+        Queue an evaluation in the caller's session; a job already waiting for
+        the submission is updated instead of adding another
+
+        While the submission's evaluation is running, a regrade is queued as a
+        single follow-up job that is claimed once the running one finishes;
+        any other request is already served by the running job.
+
+        Returns:
+            The queued job, or the running job if no follow-up is needed
+        """
+        # Concurrent enqueues for a submission without jobs would lock no job rows, serialize on the submission
+        db.query(Submission.id).filter(Submission.id == submission_id).with_for_update().first()
+        jobs = db.query(EvaluationJob).filter(
+            EvaluationJob.submission_id == submission_id,
+            EvaluationJob.status.in_([JobStatus.queued, JobStatus.running])
+        ).with_for_update().all()
+        job = next((job for job in jobs if job.status == JobStatus.queued), None)
+        running = next((job for job in jobs if job.status == JobStatus.running), None)
+        if job is None and running is not None and not regrade:
+            db.commit()
+            return running
+        if job is None:
+            job = EvaluationJob(
+                submission_id=submission_id,
+                user_id=user_id,
+                max_attempts=self.max_attempts,
+                attempts=0
+            )
+            db.add(job)
+        job.regrade = job.regrade or regrade
+        job.evaluation_mode = evaluation_mode
+        job.available_at = func.now()
+        db.commit()
+        return job
+
+    def claim(self, worker_id: str, problem_id: Optional[int] = None) -> Optional[ClaimedJob]:
+        """
+        Claim the oldest due job of the user with the fewest jobs running,
+        preferring problems no other worker is running
+
+        Args:
+            worker_id: Identity of the claiming worker
+            problem_id: Only claim a job for this problem
+
+        Returns:
+            The claimed job, or None if no job is due
+        """
+        db = SessionLocal()
+        try:
+            running = aliased(EvaluationJob)
+            user_running = db.query(func.count(running.id)).filter(
+                running.user_id == EvaluationJob.user_id,
+                running.status == JobStatus.running
+            ).correlate(EvaluationJob).scalar_subquery()
+
+            # A follow-up job waits until the submission's running job finishes
+            same_submission = aliased(EvaluationJob)
+            submission_running = db.query(same_submission.id).filter(
+                same_submission.submission_id == EvaluationJob.submission_id,
+                same_submission.status == JobStatus.running
+            ).correlate(EvaluationJob).exists()
+
+            query = db.query(EvaluationJob).join(
+                Submission, Submission.id == EvaluationJob.submission_id
+            ).filter(
+                EvaluationJob.status == JobStatus.queued,
+                EvaluationJob.available_at <= func.now(),
+                ~submission_running
+            )
+            if self.max_running_per_user > 0:
+                # Soft limit: concurrent claims by several workers may overshoot it briefly
+                query = query.filter(user_running < self.max_running_per_user)
+
+            if problem_id is not None:
+                query = query.filter(Submission.problem_id == problem_id)
+                ordering = (user_running, EvaluationJob.available_at, EvaluationJob.id)
+            else:
+                other_job = aliased(EvaluationJob)
+                other_submission = aliased(Submission)
+                running_elsewhere = db.query(other_job.id).join(
+                    other_submission, other_submission.id == other_job.submission_id
+                ).filter(
+                    other_job.status == JobStatus.running,
+                    other_job.worker_id != worker_id,
+                    other_submission.problem_id == Submission.problem_id
+                ).correlate(Submission).exists()
+                ordering = (user_running, running_elsewhere, EvaluationJob.available_at, EvaluationJob.id)
+
+            job = query.order_by(*ordering).with_for_update(of=EvaluationJob, skip_locked=True).first()
+            if job is None:
+                db.rollback()
+                return None
+
+            job.status = JobStatus.running
+            job.worker_id = worker_id
+            job.attempts += 1
+            job.heartbeat_at = func.now()
+            submission = job.submission
+            claimed = ClaimedJob(
+                job_id=job.id,
+                submission_id=submission.id,
+                problem_id=submission.problem_id,
+                code=submission.code,
+                language=submission.language,
+                user_id=job.user_id,
+                regrade=job.regrade,
+                evaluation_mode=job.evaluation_mode,
+                attempts=job.attempts,
+                max_attempts=job.max_attempts
+            )
+            db.commit()
+            return claimed
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _update_owned(self, db: Session, job_id: int, worker_id: str) -> Optional[EvaluationJob]:
+        # A job requeued as stale may already belong to another worker
+        return db.query(EvaluationJob).filter(
+            EvaluationJob.id == job_id,
+            EvaluationJob.worker_id == worker_id,
+            EvaluationJob.status == JobStatus.running
+        ).with_for_update().first()
+
+    def heartbeat(self, job_id: int, worker_id: str) -> bool:
+        """
+        Record that a worker is still running a job
+
+        Returns:
+            False if the job no longer belongs to the worker
+        """
+        db = SessionLocal()
+        try:
+            job = self._update_owned(db, job_id, worker_id)
+            if job is None:
+                db.rollback()
+                return False
+            job.heartbeat_at = func.now()
+            db.commit()
+            return True
+        finally:
+            db.close()
+
+    def complete(self, job_id: int, worker_id: str) -> None:
+        db = SessionLocal()
+        try:
+            job = self._update_owned(db, job_id, worker_id)
+            if job is not None:
+                job.status = JobStatus.completed
+                job.last_error = None
+            db.commit()
+        finally:
+            db.close()
+
+    def fail(self, job_id: int, worker_id: str, error: str) -> None:
+        """
+        Retry a failed job after a backoff, or give up on it and mark its
+        submission as errored once its attempts are used up
+        """
+        db = SessionLocal()
+        try:
+            job = self._update_owned(db, job_id, worker_id)
+            if job is None:
+                db.rollback()
+                return
+            self._retry_or_fail(db, job, error)
+            db.commit()
+        finally:
+            db.close()
+
+    def _retry_or_fail(self, db: Session, job: EvaluationJob, error: str) -> None:
+        job.last_error = error
+        job.worker_id = None
+        if job.attempts >= job.max_attempts:
+            job.status = JobStatus.failed
+            db.query(Submission).filter(Submission.id == job.submission_id).update(
+                {Submission.evaluation_status: EvaluationStatus.error},
+                synchronize_session=False
+            )
+            logger.error(f"Evaluation job {job.id} for submission {job.submission_id} failed after {job.attempts} attempts: {error}")
+            return
+
+        delay = self.retry_policy.backoff(job.attempts - 1)
+        job.status = JobStatus.queued
+        job.available_at = func.now() + datetime.timedelta(seconds=delay)
+        logger.warning(f"Evaluation job {job.id} attempt {job.attempts} failed, retrying in {delay:.0f}s: {error}")
+
+    def recover(self) -> Dict[str, int]:
+        """
+        Requeue jobs abandoned by crashed workers, and with queue dispatch,
+        queue jobs for pending submissions that have none, e.g. when an API
+        node stopped between storing a submission and enqueuing it
+
+        Returns:
+            Number of stale jobs requeued or failed, and of orphaned submissions queued
+        """
+        db = SessionLocal()
+        try:
+            stale_before = func.now() - datetime.timedelta(seconds=self.stale_after)
+            stale_jobs = db.query(EvaluationJob).filter(
+                EvaluationJob.status == JobStatus.running,
+                EvaluationJob.heartbeat_at < stale_before
+            ).with_for_update(skip_locked=True).all()
+            for job in stale_jobs:
+                self._retry_or_fail(db, job, f"Worker {job.worker_id} stopped heartbeating")
+
+            has_active_job = exists().where(
+                EvaluationJob.submission_id == Submission.id,
+                EvaluationJob.status.in_([JobStatus.queued, JobStatus.running])
+            )
+            orphans = []
+            if self.requeue_orphans:
+                # Locked like enqueue, so a concurrent enqueue finds the job instead of adding another
+                orphans = db.query(Submission).filter(
+                    Submission.evaluation_status == EvaluationStatus.pending,
+                    Submission.submission_time < stale_before,
+                    ~has_active_job
+                ).with_for_update(skip_locked=True).all()
+            for submission in orphans:
+                db.add(EvaluationJob(
+                    submission_id=submission.id,
+                    user_id=submission.user_id,
+                    max_attempts=self.max_attempts,
+                    attempts=0
+                ))
+
+            db.commit()
+            if stale_jobs or orphans:
+                logger.info(f"Recovered {len(stale_jobs)} stale jobs and {len(orphans)} pending submissions")
+            return {"stale_jobs": len(stale_jobs), "orphaned_submissions": len(orphans)}
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def get_metrics(self) -> Dict[str, Any]:
+        db = SessionLocal()
+        try:
+            counts = dict(
+                db.query(EvaluationJob.status, func.count(EvaluationJob.id)).group_by(EvaluationJob.status).all()
+            )
+            return {
+                "dispatch": EVALUATION_DISPATCH,
+                "max_running_per_user": self.max_running_per_user,
+                **{status.name: counts.get(status, 0) for status in JobStatus}
+            }
+        finally:
+            db.close()
+
+    def get_queue_lengths(self) -> Dict[str, Dict[str, int]]:
+        """
+        Queued and running jobs per user, longest queue first
+        """
+        db = SessionLocal()
+        try:
+            rows = db.query(EvaluationJob.user_id, EvaluationJob.status, func.count(EvaluationJob.id)).filter(
+                EvaluationJob.status.in_([JobStatus.queued, JobStatus.running])
+            ).group_by(EvaluationJob.user_id, EvaluationJob.status).all()
+            lengths: Dict[str, Dict[str, int]] = {}
+            for user_id, job_status, count in rows:
+                entry = lengths.setdefault(f"user:{user_id}", {"queued": 0, "running": 0})
+                entry[job_status.name] = count
+            return dict(sorted(lengths.items(), key=lambda item: item[1]["queued"], reverse=True))
+        finally:
+            db.close()
+
+evaluation_job_queue = EvaluationJobQueue()
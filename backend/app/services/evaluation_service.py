@@ -3,22 +3,33 @@ import logging
 from typing import Dict, List, Tuple, Any, Optional
 from pydantic import BaseModel, Field
 
-from app.agents.rubric_extractor_agent import RubricExtractorAgent
+from app.agents.rubric_extractor_agent import RubricExtractorAgent, ExtractedRubric
 from app.agents.evaluation_guidance_agent import EvaluationGuidanceAgent
 from app.agents.approach_explanation_agent import ApproachExplanationAgent, ApproachExplanation
 
-from app.utils.rubric_parser import parse_rubric, get_total_marks, identify_best_approach
+from app.utils.rubric_parser import get_total_marks, identify_best_approach
 from app.utils.security import check_for_injection, detection_based_check, create_security_wrapper
-from app.utils.sanitizer import process_inputs
-from app.utils.llm_utils import query_llm
+from app.utils.sanitizer import secure_student_code
+from app.utils.stage_graph import StageGraph
 
 from app.services.llm_client_service import LLMClientService
+from app.services.guidance_service import guidance_store
+from app.services.problem_artifacts import problem_artifact_store, ProblemArtifacts
+from app.services.result_cache import evaluation_result_cache
+from app.services.near_duplicate_service import near_duplicate_index, NEAR_DUPLICATE_ENABLED
+from app.services.pointwise_service import pointwise_evaluator
+from app.services.approach_batcher import approach_match_batcher
 from dotenv import load_dotenv
 load_dotenv()
 import os
 SECURITY_CHECK_ENABLED = os.getenv("SECURITY_CHECK_ENABLED", "true").lower() == "true"
 DETECTION_CHECKS_ENABLED = os.getenv("DETECTION_CHECKS_ENABLED", "true").lower() == "true"
 
+# multi_agent: approach explanation, approach matching, guidance and grading as separate calls
+# fused: approach identification and grading in one call against all rubric approaches
+EVALUATION_MODES = ("multi_agent", "fused")
+EVALUATION_MODE = os.getenv("EVALUATION_MODE", "multi_agent")
+
 logger = logging.getLogger(__name__)
 
 # Models
@@ -31,6 +42,8 @@ class EvaluationResponse(BaseModel):
     score: int = 0
     max_score: int = 0
     feedback: Dict[str, FeedbackItem] = {}
+    overall_feedback: Optional[str] = None  # Narrative feedback, only filled in by the results endpoint
+    feedback_status: Optional[str] = None  # "completed", "generating" or "unavailable", set with overall_feedback
     error: Optional[str] = None
 
 class EvaluationRequest(BaseModel):
@@ -40,6 +53,11 @@ class EvaluationRequest(BaseModel):
     model_solution: Optional[str] = None
     problem_dir: Optional[str] = None
     language: str = "java"
+    problem_id: Optional[int] = None
+    submission_id: Optional[int] = None
+    user_id: Optional[int] = None
+    bypass_cache: bool = False  # Re-run the pipeline even if a result is stored, e.g. for regrades
+    evaluation_mode: Optional[str] = None  # One of EVALUATION_MODES, defaults to EVALUATION_MODE
 
 class EvaluationService:
     """
@@ -48,9 +66,14 @@ class EvaluationService:
     """
     
     def __init__(self):
-        self.rubric_extractor = RubricExtractorAgent()
+        self.rubric_extractor = RubricExtractorAgent(approach_batcher=approach_match_batcher)
         self.approach_explainer = ApproachExplanationAgent()
         self.guidance_agent = EvaluationGuidanceAgent()
+        self.guidance_store = guidance_store
+        self.artifact_store = problem_artifact_store
+        self.result_cache = evaluation_result_cache
+        self.near_duplicates = near_duplicate_index
+        self.pointwise_evaluator = pointwise_evaluator
         self.llm_client = LLMClientService()
         
     async def complete_rubric_evaluation(self, request: EvaluationRequest) -> Dict[str, Any]:
@@ -63,20 +86,18 @@ class EvaluationService:
         Returns:
             Evaluation results
         """
-        # Process and sanitize inputs
-        problem, rubric_text, code = process_inputs(
+        # Sanitized and parsed once per problem version
+        artifacts = self.artifact_store.get(
             request.problem_statement,
             request.rubric,
-            request.student_code
+            problem_id=request.problem_id
         )
-        
-        # Parse the rubric
-        parsed_rubric = parse_rubric(rubric_text)
+        code = secure_student_code(request.student_code)
         
         # Create a secure prompt for the LLM
         prompt = await self.llm_client.construct_evaluation_prompt(
-            problem,
-            rubric_text,
+            artifacts.clean_problem,
+            artifacts.clean_rubric,
             code,
             model_solution=request.model_solution
         )
@@ -84,11 +105,8 @@ class EvaluationService:
         # Secure the prompt
         secured_prompt = create_security_wrapper(prompt)
         
-        # Query the LLM
-        response_text = await query_llm(secured_prompt)
-        
-        # Parse the response
-        evaluation = self.llm_client.parse_llm_response(response_text)
+        # Query the LLM and parse the response, budgeting for the largest approach
+        evaluation = await self.llm_client.evaluate_with_prompt(secured_prompt, artifacts.max_criteria)
         
         return evaluation
 
@@ -100,17 +118,18 @@ class EvaluationService:
             request: Evaluation request containing problem, rubric, and code
             
         Returns:
-            Evaluation results with per-point scores
+            Evaluation results with per-point scores; narrative feedback is
+            generated on demand by the feedback service
         """
-        # Process and sanitize inputs
-        problem, rubric_text, code = process_inputs(
+        # Sanitized and parsed once per problem version
+        artifacts = self.artifact_store.get(
             request.problem_statement,
             request.rubric,
-            request.student_code
+            problem_id=request.problem_id
         )
-        
-        # Parse the rubric
-        parsed_rubric = parse_rubric(rubric_text)
+        problem = artifacts.clean_problem
+        parsed_rubric = artifacts.parsed_rubric
+        code = secure_student_code(request.student_code)
         
         # Identify the best approach (or try all if needed)
         best_approach = identify_best_approach(parsed_rubric)
@@ -120,38 +139,42 @@ class EvaluationService:
             "approach_used": best_approach,
             "evaluation": {},
             "total_score": 0,
-            "max_possible_score": get_total_marks(parsed_rubric),
-            "feedback": ""
+            "max_possible_score": get_total_marks(parsed_rubric)
         }
         
-        # Evaluate each point individually
-        for point in approach_points:
-            point_id = point["id"]
-            description = point["description"]
-            max_marks = point["marks"]
-            
-            # Use the LLM client service to generate criterion evaluation
-            point_evaluation = await self.llm_client.generate_criterion_evaluation(
-                problem, 
-                description, 
-                max_marks, 
-                code
-            )
-            
-            # Add to results
-            results["evaluation"][point_id] = point_evaluation
-            results["total_score"] += point_evaluation.get("marks_awarded", 0)
-        
-        # Generate overall feedback
-        results["feedback"] = await self.llm_client.generate_feedback_summary(
+        # Evaluate the points concurrently, packed and reused per the evaluator's configuration
+        criteria = [
+            {"id": point["id"], "description": point["description"], "marks": point["marks"]}
+            for point in approach_points
+        ]
+        results["evaluation"], results["criterion_latency"] = await self.pointwise_evaluator.evaluate(
             problem,
-            results["evaluation"],
-            results["total_score"],
-            results["max_possible_score"]
+            criteria,
+            code,
+            raw_code=request.student_code,
+            language=request.language
+        )
+        results["total_score"] = sum(
+            point_evaluation.get("marks_awarded", 0) for point_evaluation in results["evaluation"].values()
         )
         
         return results
 
+    def resolve_mode(self, evaluation_mode: Optional[str] = None) -> str:
+        """
+        Get the evaluation mode to use, defaulting to EVALUATION_MODE
+        
+        Args:
+            evaluation_mode: Mode requested for the submission or configured for its problem
+            
+        Returns:
+            One of EVALUATION_MODES
+        """
+        mode = evaluation_mode or EVALUATION_MODE
+        if mode not in EVALUATION_MODES:
+            raise ValueError(f"Unknown evaluation mode: {mode}")
+        return mode
+
     async def evaluate_submission(self, request: EvaluationRequest) -> EvaluationResponse:
         """
         Main function to evaluate a submission using the appropriate technique
@@ -164,67 +187,168 @@ class EvaluationService:
             Evaluation response with score and feedback
         """
         try:
-            # Process inputs for better handling
-            problem, rubric_text, code = process_inputs(
+            mode = self.resolve_mode(request.evaluation_mode)
+            
+            # The problem is sanitized, parsed and formatted once per version;
+            # only the student code is processed per submission
+            artifacts = self.artifact_store.get(
                 request.problem_statement,
                 request.rubric,
-                request.student_code
+                problem_id=request.problem_id
+            )
+            
+            # Identical or trivially different code for the same problem version gets the stored result
+            cache_key = self.result_cache.make_key(
+                artifacts,
+                request.student_code,
+                request.language,
+                model_solution=request.model_solution,
+                problem_dir=request.problem_dir,
+                evaluation_mode=mode
+            )
+            
+            # Stored submissions are indexed for near-duplicate lookup
+            signature = None
+            if NEAR_DUPLICATE_ENABLED and request.problem_id is not None and request.submission_id is not None:
+                signature = self.near_duplicates.signature(request.student_code, request.language)
+            
+            cached_result = await self.result_cache.get(cache_key, bypass=request.bypass_cache)
+            if cached_result is not None:
+                logger.info("Serving stored evaluation result for matching code fingerprint")
+                if signature is not None:
+                    self.near_duplicates.add(request.problem_id, request.submission_id, signature, request.user_id)
+                return EvaluationResponse(**cached_result)
+            
+            code = secure_student_code(request.student_code)
+            
+            if mode == "fused":
+                approach, evaluation = await self._evaluate_fused(request, artifacts, code)
+            else:
+                # A close enough near-duplicate lends its approach classification, except on regrades
+                near_duplicate = None
+                if signature is not None and not request.bypass_cache:
+                    near_duplicate = self.near_duplicates.find_classified(
+                        request.problem_id,
+                        signature,
+                        artifacts.version,
+                        exclude=request.submission_id
+                    )
+                approach, evaluation = await self._evaluate_multi_agent(request, artifacts, code, near_duplicate)
+            
+            response = self._build_response(artifacts, approach, evaluation)
+            
+            # Only complete gradings are reused
+            if not evaluation.get("error"):
+                await self.result_cache.set(cache_key, response.dict())
+                if signature is not None:
+                    self.near_duplicates.add(
+                        request.problem_id,
+                        request.submission_id,
+                        signature,
+                        request.user_id,
+                        approach=approach,
+                        problem_version=artifacts.version
+                    )
+            
+            return response
+            
+        except Exception as e:
+            logger.error(f"Error evaluating submission: {str(e)}", exc_info=True)
+            return EvaluationResponse(
+                score=0,
+                max_score=0,
+                feedback={},
+                error=f"An error occurred during evaluation: {str(e)}"
             )
+
+    async def _evaluate_multi_agent(
+        self,
+        request: EvaluationRequest,
+        artifacts: ProblemArtifacts,
+        code: str,
+        near_duplicate: Optional[Dict[str, Any]] = None
+    ) -> Tuple[str, Dict[str, Any]]:
+        """
+        Identify the approach with the explanation and approach matching agents,
+        then grade it with its precomputed guidance
+        
+        Args:
+            request: Evaluation request with problem, rubric, and code
+            artifacts: The problem's artifacts
+            code: The secured student code
+            near_duplicate: Optional near-duplicate whose approach classification is reused
             
-            # First, generate the approach explanation
+        Returns:
+            The selected approach and the parsed evaluation
+        """
+        async def explain() -> Optional[ApproachExplanation]:
             try:
                 approach_explanation = await self.approach_explainer.explain_approach(
                     code,
-                    problem  # Pass problem statement for context
+                    artifacts.clean_problem  # Pass problem statement for context
                 )
                 logger.info(f"Generated approach explanation: {approach_explanation.approach_name}")
+                return approach_explanation
             except Exception as e:
                 logger.error(f"Error getting approach explanation: {str(e)}")
-                approach_explanation = None
-            
-            # Extract the appropriate rubric based on the solution
-            extracted_rubric = await self.rubric_extractor.extract_rubric_for_solution(
-                problem,
-                rubric_text,
-                code,
-                request.model_solution,
-                approach_explanation  # Pass the approach explanation
+                return None
+        
+        async def match_approaches() -> List[Dict[str, Any]]:
+            if near_duplicate is not None:
+                logger.info(
+                    f"Reusing approach {near_duplicate['approach']} of near-duplicate submission "
+                    f"{near_duplicate['submission_id']} (similarity {near_duplicate['similarity']:.2f})"
+                )
+                return [{
+                    "approach": near_duplicate["approach"],
+                    "confidence": near_duplicate["similarity"],
+                    "explanation": f"Same approach as a near-duplicate submission (similarity {near_duplicate['similarity']:.2f})",
+                    "key_indicators": []
+                }]
+            return await self.rubric_extractor.evaluate_approaches(
+                artifacts.clean_problem,
+                artifacts.parsed_rubric,
+                request.student_code,
+                request.model_solution
+            )
+        
+        async def select(
+            explanation: Optional[ApproachExplanation],
+            approach_match: List[Dict[str, Any]]
+        ) -> ExtractedRubric:
+            extracted_rubric = self.rubric_extractor.select_approach(
+                artifacts.parsed_rubric,
+                artifacts.max_scores,
+                approach_match,
+                explanation  # Augment the matching with the approach explanation
             )
-            
-            # Get the correctly formatted rubric for evaluation
-            formatted_rubric = await self.rubric_extractor.format_rubric_for_evaluation(extracted_rubric)
-            
-            # Format the approach explanation for the evaluator
-            formatted_approach_explanation = self.approach_explainer.format_approach_explanation(approach_explanation) if approach_explanation else ""
-            
             # Log the extracted approach and max score
             logger.info(f"Using approach: {extracted_rubric.approach} with max score: {extracted_rubric.max_score}")
-            
-            # Store the rubric points for reference to get correct max_points later
-            rubric_points = {}
-            if extracted_rubric.is_custom:
-                for i, point in enumerate(extracted_rubric.rubric["points"]):
-                    rubric_points[str(i+1)] = point["marks"]
-            else:
-                for i, point in enumerate(extracted_rubric.rubric["points"]):
-                    rubric_points[str(i+1)] = point["marks"]
-            
-            logger.info(f"Rubric points mapping: {rubric_points}")
-            
-            # Generate algorithm-specific guidance using the extracted approach
-            algorithm_guidance = await self.guidance_agent.generate_evaluation_guidance(
-                problem,
-                extracted_rubric.dict(),  # Convert to dict for the agent
+            return extracted_rubric
+        
+        async def guide(selection: ExtractedRubric):
+            # Algorithm-specific guidance for the extracted approach, precomputed per problem
+            return await self.guidance_store.get_guidance(
+                artifacts,
+                selection.approach,
                 problem_dir=request.problem_dir
             )
-
+        
+        async def grade(
+            explanation: Optional[ApproachExplanation],
+            selection: ExtractedRubric,
+            guidance
+        ) -> Dict[str, Any]:
+            # Format the approach explanation for the evaluator
+            formatted_approach_explanation = self.approach_explainer.format_approach_explanation(explanation) if explanation else ""
+            
             # Use the LLM client to construct an evaluation prompt
             evaluation_prompt = await self.llm_client.construct_evaluation_prompt(
-                problem,
-                formatted_rubric,
+                artifacts.clean_problem,
+                artifacts.formatted_rubrics[selection.approach],
                 code,
                 model_solution=request.model_solution,
-                algorithm_guidance=algorithm_guidance.dict() if algorithm_guidance else None,
+                algorithm_guidance=guidance.dict() if guidance else None,
                 approach_explanation=formatted_approach_explanation,
                 problem_dir=request.problem_dir
             )
@@ -233,43 +357,137 @@ class EvaluationService:
             secured_evaluation_prompt = create_security_wrapper(evaluation_prompt)
             
             # Use the LLM client's evaluate_with_prompt method
-            evaluation = await self.llm_client.evaluate_with_prompt(secured_evaluation_prompt)
+            return await self.llm_client.evaluate_with_prompt(
+                secured_evaluation_prompt,
+                num_criteria=len(selection.rubric["points"])
+            )
+        
+        # Approach explanation and approach matching are independent; guidance
+        # starts as soon as the approach is selected
+        stages = (
+            StageGraph("evaluate_submission")
+            .add("explanation", explain)
+            .add("approach_match", match_approaches)
+            .add("selection", select, depends_on=["explanation", "approach_match"])
+            .add("guidance", guide, depends_on=["selection"])
+            .add("grade", grade, depends_on=["explanation", "selection", "guidance"])
+        )
+        results = await stages.run()
+        return results["selection"].approach, results["grade"]
+
+    async def _evaluate_fused(
+        self,
+        request: EvaluationRequest,
+        artifacts: ProblemArtifacts,
+        code: str
+    ) -> Tuple[str, Dict[str, Any]]:
+        """
+        Identify the approach and grade it in a single LLM call against the
+        formatted rubrics of all approaches
+        
+        Args:
+            request: Evaluation request with problem, rubric, and code
+            artifacts: The problem's artifacts
+            code: The secured student code
             
-            # Convert the evaluation to a structured response
-            feedback_dict = {}
-            total_score = 0
+        Returns:
+            The identified approach and the parsed evaluation
+        """
+        evaluation_prompt = await self.llm_client.construct_fused_evaluation_prompt(
+            artifacts.clean_problem,
+            artifacts.formatted_rubrics,
+            code,
+            model_solution=request.model_solution
+        )
+        secured_evaluation_prompt = create_security_wrapper(evaluation_prompt)
+        
+        # Budget for the largest approach, the choice is only known afterwards
+        evaluation = await self.llm_client.evaluate_fused(
+            secured_evaluation_prompt,
+            num_criteria=artifacts.max_criteria
+        )
+        
+        approach = self._match_approach_name(artifacts, evaluation.get("approach_used", ""))
+        logger.info(
+            f"Fused evaluation identified approach {approach} "
+            f"(reported {evaluation.get('approach_used')!r}, confidence {evaluation.get('approach_confidence', 0.0)})"
+        )
+        
+        # Points graded against another approach's numbering are dropped
+        points = artifacts.rubric_points[approach]
+        evaluation["evaluation"] = {
+            point_id: point_eval
+            for point_id, point_eval in evaluation.get("evaluation", {}).items()
+            if point_id in points
+        }
+        return approach, evaluation
+
+    def _match_approach_name(self, artifacts: ProblemArtifacts, reported: str) -> str:
+        """
+        Map the approach reported by the model to a rubric approach key
+        
+        The key ("Solution 2") or the approach's name may be reported, possibly
+        with extra text; anything unrecognized falls back to the best approach.
+        """
+        approaches = artifacts.parsed_rubric["approaches"]
+        if reported in approaches:
+            return reported
+        
+        reported_lower = reported.lower()
+        # Longest keys first, so "Solution 1" does not match "Solution 10"
+        for approach in sorted(approaches, key=len, reverse=True):
+            if approach.lower() in reported_lower:
+                return approach
+        for approach, approach_rubric in approaches.items():
+            name = approach_rubric.get("name", "").lower()
+            if name and (name in reported_lower or reported_lower in name):
+                return approach
+        
+        best_approach = identify_best_approach(artifacts.parsed_rubric)
+        logger.warning(f"Unrecognized approach {reported!r} in fused evaluation, using {best_approach}")
+        return best_approach
+
+    def _build_response(
+        self,
+        artifacts: ProblemArtifacts,
+        approach: str,
+        evaluation: Dict[str, Any]
+    ) -> EvaluationResponse:
+        """
+        Convert a parsed evaluation of an approach to an EvaluationResponse,
+        scored against the rubric's marks rather than the model's
+        """
+        # Use the rubric points to get correct max_points later
+        rubric_points = artifacts.rubric_points[approach]
+        
+        logger.info(f"Rubric points mapping: {rubric_points}")
+        
+        # Convert the evaluation to a structured response
+        feedback_dict = {}
+        total_score = 0
+        
+        for point_id, point_eval in evaluation.get("evaluation", {}).items():
+            # Get max_points from the parsed rubric instead of the LLM evaluation
+            max_points = rubric_points.get(point_id, 1)  # Default to 1 if not found
             
-            for point_id, point_eval in evaluation.get("evaluation", {}).items():
-                # Get max_points from the parsed rubric instead of the LLM evaluation
-                max_points = rubric_points.get(point_id, 1)  # Default to 1 if not found
-                
-                # Ensure points_awarded never exceeds max_points
-                points_awarded = min(point_eval.get("marks_awarded", 0), max_points)
-                
-                feedback_dict[point_id] = FeedbackItem(
-                    points_awarded=points_awarded,
-                    max_points=max_points,
-                    feedback=point_eval.get("justification", "")
-                )
-                
-                total_score += points_awarded
+            # Ensure points_awarded never exceeds max_points
+            points_awarded = min(point_eval.get("marks_awarded", 0), max_points)
             
-            # Create response object
-            return EvaluationResponse(
-                score=total_score,
-                max_score=extracted_rubric.max_score,
-                feedback=feedback_dict,
-                error=None
+            feedback_dict[point_id] = FeedbackItem(
+                points_awarded=points_awarded,
+                max_points=max_points,
+                feedback=point_eval.get("justification", "")
             )
             
-        except Exception as e:
-            logger.error(f"Error evaluating submission: {str(e)}", exc_info=True)
-            return EvaluationResponse(
-                score=0,
-                max_score=0,
-                feedback={},
-                error=f"An error occurred during evaluation: {str(e)}"
-            )
+            total_score += points_awarded
+        
+        # Create response object
+        return EvaluationResponse(
+            score=total_score,
+            max_score=artifacts.max_scores.get(approach, 0),
+            feedback=feedback_dict,
+            error=None
+        )
             
     async def security_check(self, code: str) -> Dict[str, Any]:
         """
@@ -0,0 +1,240 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from typing import Dict, List, Any, Optional, Tuple
+from dotenv import load_dotenv
+
+from app.db.database import SessionLocal
+from app.db.models import Submission, EvaluationDetail, EvaluationStatus, SubmissionFeedback
+from app.services.llm_client_service import LLMClientService
+from app.services.problem_artifacts import problem_artifact_store
+from app.utils.llm_scheduler import Priority, priority_scope
+from app.utils.llm_utils import llm_scheduler
+from app.utils.single_flight import SingleFlight
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Narrative feedback configuration
+FEEDBACK_PREFETCH_ENABLED = os.getenv("FEEDBACK_PREFETCH_ENABLED", "false").lower() == "true"
+# Seconds between checks whether the LLM scheduler is idle
+FEEDBACK_PREFETCH_POLL_INTERVAL = float(os.getenv("FEEDBACK_PREFETCH_POLL_INTERVAL", "5"))
+# Seconds a prefetch waits for an idle scheduler before giving up
+FEEDBACK_PREFETCH_MAX_WAIT = float(os.getenv("FEEDBACK_PREFETCH_MAX_WAIT", "600"))
+
+def grade_version(submission: Submission, details: List[EvaluationDetail]) -> str:
+    """
+    Version of a submission's grade, changes whenever it is regraded with a
+    different score, criterion score or justification
+    """
+    material = [str(submission.total_score)] + [
+        f"{detail.criterion_index}\x00{detail.score_obtained}\x00{detail.max_score}\x00{detail.feedback}"
+        for detail in details
+    ]
+    return hashlib.sha256("\x01".join(material).encode("utf-8")).hexdigest()[:16]
+
+class FeedbackService:
+    """
+    Narrative feedback for graded submissions, generated lazily
+
+    Grading only produces scores and per-criterion justifications. The
+    summary prose is generated in the background the first time a student
+    asks for it, stored in the submission_feedback table and served from
+    there afterwards. When prefetching is enabled, it is also generated at
+    background priority once the LLM scheduler has nothing queued.
+    Feedback generated for a grade that has since been replaced by a
+    regrade is discarded instead of stored.
+    """
+
+    def __init__(self):
+        self.llm_client = LLMClientService()
+        self.artifact_store = problem_artifact_store
+        self._single_flight = SingleFlight()
+        self._prefetching: Dict[int, asyncio.Task] = {}
+        self._generating: Dict[int, asyncio.Task] = {}
+
+        # Metrics
+        self.stored_hits = 0
+        self.generated = 0
+        self.prefetched = 0
+        self.prefetch_expired = 0
+        self.stale_discarded = 0
+        self.failures = 0
+        self.generation_seconds = 0.0
+
+    def _db_load(self, submission_id: int) -> Optional[Dict[str, Any]]:
+        db = SessionLocal()
+        try:
+            submission = db.query(Submission).filter(Submission.id == submission_id).first()
+            if not submission or submission.evaluation_status != EvaluationStatus.completed:
+                return None
+
+            stored = db.query(SubmissionFeedback).filter(SubmissionFeedback.submission_id == submission_id).first()
+            if stored:
+                return {"feedback": stored.feedback}
+
+            details = db.query(EvaluationDetail).filter(
+                EvaluationDetail.submission_id == submission_id
+            ).order_by(EvaluationDetail.criterion_index).all()
+            return {
+                "feedback": None,
+                "grade_version": grade_version(submission, details),
+                "problem_id": submission.problem_id,
+                "problem_statement": submission.problem.problem_description,
+                "rubric": submission.problem.rubric,
+                "total_score": submission.total_score or 0,
+                "max_score": sum(detail.max_score for detail in details),
+                "evaluation": {
+                    str(detail.criterion_index): {
+                        "marks_awarded": detail.score_obtained,
+                        "max_marks": detail.max_score,
+                        "justification": detail.feedback
+                    }
+                    for detail in details
+                }
+            }
+        finally:
+            db.close()
+
+    def _db_set(self, submission_id: int, feedback: str, version: str) -> bool:
+        db = SessionLocal()
+        try:
+            # Lock the submission so a regrade cannot commit between the check and the write
+            submission = db.query(Submission).filter(Submission.id == submission_id).with_for_update().first()
+            if not submission or submission.evaluation_status != EvaluationStatus.completed:
+                return False
+            details = db.query(EvaluationDetail).filter(
+                EvaluationDetail.submission_id == submission_id
+            ).order_by(EvaluationDetail.criterion_index).all()
+            if grade_version(submission, details) != version:
+                return False
+
+            db.merge(SubmissionFeedback(submission_id=submission_id, feedback=feedback))
+            db.commit()
+            return True
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def _generate(self, submission_id: int, context: Dict[str, Any]) -> Optional[str]:
+        artifacts = self.artifact_store.get(
+            context["problem_statement"],
+            context["rubric"],
+            problem_id=context["problem_id"]
+        )
+        started = time.perf_counter()
+        feedback = await self.llm_client.generate_feedback_summary(
+            artifacts.clean_problem,
+            context["evaluation"],
+            context["total_score"],
+            context["max_score"]
+        )
+        self.generation_seconds += time.perf_counter() - started
+        if not await asyncio.to_thread(self._db_set, submission_id, feedback, context["grade_version"]):
+            # Regraded while the feedback was generated; it describes the old grade
+            self.stale_discarded += 1
+            logger.info(f"Discarded feedback for submission {submission_id}, regraded during generation")
+            return None
+        self.generated += 1
+        return feedback
+
+    async def get_feedback(self, submission_id: int) -> Optional[str]:
+        """
+        Get a graded submission's narrative feedback, generating and storing it
+        on first use; concurrent requests for a submission share one generation
+
+        Args:
+            submission_id: Submission ID
+
+        Returns:
+            The feedback, or None if the submission is not graded, was
+            regraded during generation or generation failed
+        """
+        context = await asyncio.to_thread(self._db_load, submission_id)
+        if context is None:
+            return None
+        if context["feedback"] is not None:
+            self.stored_hits += 1
+            return context["feedback"]
+
+        try:
+            return await self._single_flight.do(
+                f"feedback:{submission_id}:{context['grade_version']}",
+                lambda: self._generate(submission_id, context)
+            )
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"Error generating feedback for submission {submission_id}: {str(e)}")
+            return None
+
+    async def request_feedback(self, submission_id: int) -> Tuple[Optional[str], str]:
+        """
+        Get a graded submission's stored narrative feedback without waiting for
+        the LLM; if none is stored yet, start generating it in the background
+
+        Args:
+            submission_id: Submission ID
+
+        Returns:
+            The feedback if stored, and its status: "completed", "generating",
+            or "unavailable" if the submission is not graded
+        """
+        context = await asyncio.to_thread(self._db_load, submission_id)
+        if context is None:
+            return None, "unavailable"
+        if context["feedback"] is not None:
+            self.stored_hits += 1
+            return context["feedback"], "completed"
+
+        if submission_id not in self._generating:
+            task = asyncio.create_task(self.get_feedback(submission_id))
+            self._generating[submission_id] = task
+            task.add_done_callback(lambda _: self._generating.pop(submission_id, None))
+        return None, "generating"
+
+    async def _prefetch(self, submission_id: int) -> None:
+        try:
+            waited = 0.0
+            while not llm_scheduler.is_idle():
+                if waited >= FEEDBACK_PREFETCH_MAX_WAIT:
+                    self.prefetch_expired += 1
+                    return
+                await asyncio.sleep(FEEDBACK_PREFETCH_POLL_INTERVAL)
+                waited += FEEDBACK_PREFETCH_POLL_INTERVAL
+
+            with priority_scope(Priority.background):
+                if await self.get_feedback(submission_id) is not None:
+                    self.prefetched += 1
+        finally:
+            self._prefetching.pop(submission_id, None)
+
+    def schedule_prefetch(self, submission_id: int) -> None:
+        """
+        Generate a submission's feedback in the background once the LLM
+        scheduler is idle, if prefetching is enabled
+        """
+        if not FEEDBACK_PREFETCH_ENABLED or submission_id in self._prefetching:
+            return
+        self._prefetching[submission_id] = asyncio.create_task(self._prefetch(submission_id))
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "prefetch_enabled": FEEDBACK_PREFETCH_ENABLED,
+            "stored_hits": self.stored_hits,
+            "generated": self.generated,
+            "prefetched": self.prefetched,
+            "prefetch_pending": len(self._prefetching),
+            "generating": len(self._generating),
+            "prefetch_expired": self.prefetch_expired,
+            "stale_discarded": self.stale_discarded,
+            "failures": self.failures,
+            "avg_generation_seconds": self.generation_seconds / self.generated if self.generated else 0.0
+        }
+
+feedback_service = FeedbackService()
@@ -0,0 +1,273 @@
+import json
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+from app.agents.evaluation_guidance_agent import (
+    EvaluationGuidanceAgent,
+    AlgorithmGuidance,
+    GUIDANCE_PROMPT_VERSION,
+    fallback_guidance
+)
+from app.db.database import SessionLocal
+from app.db.models import Problem, ProblemGuidance
+from app.services.problem_artifacts import ProblemArtifacts, problem_artifact_store
+from app.utils.single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+def guidance_rubric_version(artifacts: ProblemArtifacts, problem_dir: Optional[str] = None) -> str:
+    """
+    Version of the guidance for a problem: changes whenever the problem text,
+    the rubric, the example corpus location or the guidance prompt changes
+
+    Args:
+        artifacts: The problem's artifacts
+        problem_dir: Optional path to directory with example solutions
+
+    Returns:
+        Short hex digest
+    """
+    material = "\x00".join([GUIDANCE_PROMPT_VERSION, artifacts.version, problem_dir or ""])
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()[:16]
+
+class GuidanceStore:
+    """
+    Evaluation guidance materialized per (problem, approach, rubric version)
+
+    Guidance depends only on the problem, the rubric approach and the example
+    corpus, never on the student's code. It is generated eagerly when a problem
+    is written, stored in the problem_guidance table and served from a bounded
+    in-process cache while grading; a miss regenerates it once, however many
+    submissions are waiting for it.
+    """
+
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max_entries
+        self.guidance_agent = EvaluationGuidanceAgent()
+        self._memory: "OrderedDict[Tuple[Optional[int], str, str], AlgorithmGuidance]" = OrderedDict()
+        self._single_flight = SingleFlight()
+
+        # Metrics
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.generated = 0
+        self.precomputed = 0
+        self.failures = 0
+
+    def _remember(self, key: Tuple[Optional[int], str, str], guidance: AlgorithmGuidance) -> None:
+        self._memory[key] = guidance
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _db_get(self, problem_id: int, approach: str, version: str) -> Optional[AlgorithmGuidance]:
+        db = SessionLocal()
+        try:
+            row = db.query(ProblemGuidance).filter(
+                ProblemGuidance.problem_id == problem_id,
+                ProblemGuidance.approach == approach,
+                ProblemGuidance.rubric_version == version
+            ).first()
+            return AlgorithmGuidance(**json.loads(row.guidance)) if row else None
+        finally:
+            db.close()
+
+    def _db_set(self, problem_id: int, approach: str, version: str, guidance: AlgorithmGuidance) -> None:
+        db = SessionLocal()
+        try:
+            row = db.query(ProblemGuidance).filter(
+                ProblemGuidance.problem_id == problem_id,
+                ProblemGuidance.approach == approach,
+                ProblemGuidance.rubric_version == version
+            ).first()
+            if row is None:
+                row = ProblemGuidance(problem_id=problem_id, approach=approach, rubric_version=version)
+                db.add(row)
+            row.guidance = json.dumps(guidance.dict())
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _db_load_problem(self, problem_id: int) -> Optional[Tuple[str, str]]:
+        db = SessionLocal()
+        try:
+            problem = db.query(Problem).filter(Problem.id == problem_id).first()
+            return (problem.problem_description, problem.rubric) if problem else None
+        finally:
+            db.close()
+
+    def _db_prune(self, problem_id: int, version: str) -> int:
+        db = SessionLocal()
+        try:
+            removed = db.query(ProblemGuidance).filter(
+                ProblemGuidance.problem_id == problem_id,
+                ProblemGuidance.rubric_version != version
+            ).delete(synchronize_session=False)
+            db.commit()
+            return removed
+        finally:
+            db.close()
+
+    async def _generate(
+        self,
+        problem_statement: str,
+        approach: str,
+        approach_rubric: Dict[str, Any],
+        problem_dir: Optional[str]
+    ) -> AlgorithmGuidance:
+        # The rubric's own description of the approach keeps the prompt student-independent
+        return await self.guidance_agent.generate_evaluation_guidance(
+            problem_statement,
+            {
+                "approach": approach,
+                "explanation": approach_rubric.get("name", ""),
+                "rubric": approach_rubric
+            },
+            problem_dir=problem_dir,
+            fallback=False
+        )
+
+    async def _load_or_generate(
+        self,
+        key: Tuple[Optional[int], str, str],
+        problem_statement: str,
+        approach_rubric: Dict[str, Any],
+        problem_dir: Optional[str]
+    ) -> AlgorithmGuidance:
+        problem_id, approach, version = key
+
+        if problem_id is not None:
+            try:
+                stored = await asyncio.to_thread(self._db_get, problem_id, approach, version)
+            except Exception as e:
+                logger.error(f"Error reading stored guidance: {str(e)}")
+                stored = None
+            if stored is not None:
+                self.db_hits += 1
+                self._remember(key, stored)
+                return stored
+
+        try:
+            guidance = await self._generate(problem_statement, approach, approach_rubric, problem_dir)
+        except Exception as e:
+            # Generic guidance is served but never stored, so the next submission retries
+            self.failures += 1
+            logger.error(f"Falling back to generic guidance for {approach}: {str(e)}")
+            return fallback_guidance(approach)
+
+        self.generated += 1
+        self._remember(key, guidance)
+        if problem_id is not None:
+            try:
+                await asyncio.to_thread(self._db_set, problem_id, approach, version, guidance)
+            except Exception as e:
+                logger.error(f"Error storing guidance: {str(e)}")
+        return guidance
+
+    async def get_guidance(
+        self,
+        artifacts: ProblemArtifacts,
+        approach: str,
+        problem_dir: Optional[str] = None
+    ) -> AlgorithmGuidance:
+        """
+        Get the evaluation guidance for a rubric approach, generating it on a miss
+
+        Args:
+            artifacts: The problem's artifacts; without a problem ID guidance is only cached in memory
+            approach: Selected rubric approach key
+            problem_dir: Optional path to directory with example solutions
+
+        Returns:
+            AlgorithmGuidance for the approach
+        """
+        version = guidance_rubric_version(artifacts, problem_dir)
+        key = (artifacts.problem_id, approach, version)
+
+        guidance = self._memory.get(key)
+        if guidance is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return guidance
+
+        approach_rubric = artifacts.parsed_rubric["approaches"][approach]
+        return await self._single_flight.do(
+            f"{artifacts.problem_id}:{approach}:{version}",
+            lambda: self._load_or_generate(key, artifacts.problem_statement, approach_rubric, problem_dir)
+        )
+
+    async def precompute(self, problem_id: int, problem_dir: Optional[str] = None) -> int:
+        """
+        Generate and store guidance for every approach of a problem's rubric,
+        removing guidance stored for earlier versions of the problem
+
+        Args:
+            problem_id: Problem ID
+            problem_dir: Optional path to directory with example solutions
+
+        Returns:
+            Number of approaches with stored guidance
+        """
+        try:
+            problem = await asyncio.to_thread(self._db_load_problem, problem_id)
+            if problem is None:
+                logger.warning(f"Cannot precompute guidance: problem {problem_id} not found")
+                return 0
+            artifacts = problem_artifact_store.get(*problem, problem_id=problem_id)
+            problem_statement = artifacts.problem_statement
+            version = guidance_rubric_version(artifacts, problem_dir)
+
+            async def precompute_approach(approach: str, approach_rubric: Dict[str, Any]) -> bool:
+                key = (problem_id, approach, version)
+                try:
+                    guidance = await self._generate(problem_statement, approach, approach_rubric, problem_dir)
+                except Exception as e:
+                    self.failures += 1
+                    logger.error(f"Error precomputing guidance for problem {problem_id}, {approach}: {str(e)}")
+                    return False
+                await asyncio.to_thread(self._db_set, problem_id, approach, version, guidance)
+                self._remember(key, guidance)
+                return True
+
+            stored = await asyncio.gather(*[
+                precompute_approach(approach, approach_rubric)
+                for approach, approach_rubric in artifacts.parsed_rubric["approaches"].items()
+            ])
+            removed = await asyncio.to_thread(self._db_prune, problem_id, version)
+
+            self.precomputed += sum(stored)
+            logger.info(
+                f"Precomputed guidance for problem {problem_id}: {sum(stored)}/{len(stored)} approaches, "
+                f"{removed} outdated entries removed"
+            )
+            return sum(stored)
+        except Exception as e:
+            logger.error(f"Error precomputing guidance for problem {problem_id}: {str(e)}", exc_info=True)
+            return 0
+
+    def invalidate(self, problem_id: int) -> None:
+        """
+        Drop cached guidance of a problem from memory
+        """
+        for key in [key for key in self._memory if key[0] == problem_id]:
+            del self._memory[key]
+
+    def get_metrics(self) -> Dict[str, Any]:
+        lookups = self.memory_hits + self.db_hits + self.generated + self.failures
+        return {
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "generated": self.generated,
+            "precomputed": self.precomputed,
+            "failures": self.failures,
+            "hit_rate": (self.memory_hits + self.db_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory)
+        }
+
+guidance_store = GuidanceStore()
@@ -1,8 +1,7 @@
-import json
 import logging
-import re
 from typing import Dict, List, Any, Optional, Union
 import os
+from pydantic import BaseModel
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -16,10 +15,233 @@ TEMPERATURE = float(os.getenv("TEMPERATURE", "0.2"))
 MAX_TOKENS = int(os.getenv("MAX_TOKENS", "4000"))
 REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "300"))
 
-from app.utils.llm_utils import query_llm
+from app.utils.llm_utils import query_llm, query_llm_structured, prompt_token_budget
+from app.utils.json_decoder import decode_json, StructuredOutputError
+from app.utils.llm_budgets import stage_budget
+from app.utils.prompt_builder import PromptBuilder, PromptParts, prompt_group
+from app.utils.prompt_templates import prompt_template, compact_text, compact_json, TRUST_IMPLEMENTATION
 
 logger = logging.getLogger(__name__)
 
+# Bump when the evaluation prompt changes so cached evaluation results are not reused
+EVALUATION_PROMPT_VERSION = "evaluation-v2"
+FUSED_EVALUATION_PROMPT_VERSION = "fused-evaluation-v2"
+CRITERION_PROMPT_VERSION = "criterion-v1"
+
+class CriterionEvaluation(BaseModel):
+    """Schema for the evaluation of a single rubric criterion"""
+    satisfied: bool = False
+    justification: str = ""
+    marks_awarded: int = 0
+
+class CriteriaEvaluation(BaseModel):
+    """Schema for the evaluation of several rubric criteria in one response"""
+    evaluation: Dict[str, CriterionEvaluation] = {}
+
+class RubricEvaluation(BaseModel):
+    """Schema for a complete rubric evaluation"""
+    approach_used: str = "unknown"
+    evaluation: Dict[str, CriterionEvaluation] = {}
+    total_score: int = 0
+    max_possible_score: int = 0
+
+class FusedEvaluation(BaseModel):
+    """Schema for an approach classification and rubric evaluation made in one call"""
+    approach_used: str = "unknown"
+    approach_confidence: float = 0.0
+    approach_summary: str = ""
+    evaluation: Dict[str, CriterionEvaluation] = {}
+    total_score: int = 0
+    max_possible_score: int = 0
+
+# Evaluation prompt sections, assembled by construct_evaluation_prompt
+EVALUATION_HEADER_TEMPLATE = prompt_template("evaluation_header", """
+    You are a code evaluator with expertise in algorithms and programming languages.
+    Evaluate the code fairly and objectively, considering all valid implementation approaches.
+    """)
+
+PROBLEM_TEMPLATE = prompt_template("evaluation_problem", """
+    PROBLEM STATEMENT:
+    ```
+    {problem_statement}
+    ```
+    """)
+
+GUIDANCE_TEMPLATE = prompt_template("evaluation_guidance", """
+    ALGORITHM-SPECIFIC GUIDANCE FOR {algorithm_type}:
+    {algorithm_guidance}
+
+    KEY IMPLEMENTATION PATTERNS TO LOOK FOR:
+    {key_patterns}
+
+    MISLEADING PATTERNS TO IGNORE:
+    {misleading_patterns}
+    """)
+
+COMMON_ERRORS_TEMPLATE = prompt_template("evaluation_common_errors", """
+    COMMON ERRORS TO WATCH FOR:
+    {common_errors}
+    """)
+
+TEST_CASES_TEMPLATE = prompt_template("evaluation_test_cases", """
+    TEST CASES FOR VERIFICATION:
+    {test_cases}
+    """)
+
+GENERAL_GUIDANCE_TEMPLATE = prompt_template("evaluation_general_guidance", """
+    ALGORITHM EVALUATION GUIDANCE:
+    - When evaluating algorithms, consider both explicit and implicit correctness
+    - Many algorithms have multiple valid implementations that use different patterns
+    - For search algorithms, pay attention to boundary conditions and edge cases
+    - Consider the overall logic and structure of the solution, not just specific lines
+    - A solution may be correct even if it implements the algorithm differently from what you expect
+    - Focus on whether the solution produces correct results for all possible inputs
+    """)
+
+APPROACH_EXPLANATION_TEMPLATE = prompt_template("evaluation_approach_explanation", """
+    {approach_explanation}
+
+    NOTE: The above analysis provides insight into the student's implementation approach
+    and identifies any issues without suggesting fixes. Use this information to better
+    understand what the student has attempted, but ensure your evaluation is based on
+    the actual code and the rubric criteria.
+    """)
+
+RUBRIC_TEMPLATE = prompt_template("evaluation_rubric", """
+    RUBRIC:
+    ```
+    {rubric}
+    ```
+    """)
+
+MODEL_SOLUTION_TEMPLATE = prompt_template("evaluation_model_solution", """
+    MODEL SOLUTION:
+    ```
+    {model_solution}
+    ```
+    """)
+
+STUDENT_CODE_TEMPLATE = prompt_template("evaluation_student_code", """
+    STUDENT CODE:
+    ```
+    {student_code}
+    ```
+    """)
+
+EVALUATION_INSTRUCTIONS_TEMPLATE = prompt_template("evaluation_instructions", """
+    EVALUATION INSTRUCTIONS:
+    1. Evaluate the student code against each point in the rubric
+    2. For each rubric point, determine if it is satisfied by the implementation
+    3. Provide a brief, specific justification for each evaluation
+    4. Consider ALL valid algorithmic approaches for solving this problem - there's often more than one correct way
+    5. Calculate the total score based on marks awarded for each rubric point
+    6. Focus on algorithmic correctness rather than syntax or style unless the rubric specifies otherwise
+    7. Verify the code using the test cases provided above, if any
+    8. Mark the student's code based on what it DOES, not what you think the intention was
+    9. If the implementation is correct but different from what you expected, it should still receive full marks
+    10. The student's code (and an analysis of its approach, if available) follows at the end of this prompt
+
+    CRITICAL: {trust_implementation}
+
+    Return your evaluation as a JSON object with the following structure:
+    {{
+        "approach_used": "Which approach the student used (e.g., Solution 1, Solution 2, etc.)",
+        "evaluation": {{
+            "1": {{"satisfied": true/false, "justification": "At most {max_words} words citing specific details from the code", "marks_awarded": marks_value}},
+            "2": {{ ... }},
+            ...
+        }},
+        "total_score": sum_of_marks,
+        "max_possible_score": max_marks
+    }}
+    """)
+
+FUSED_RUBRICS_TEMPLATE = prompt_template("fused_evaluation_rubrics", """
+    RUBRIC APPROACHES:
+    The rubric has one set of criteria per valid approach. Grade the student only
+    against the approach their code actually follows.
+    ```
+    {rubrics}
+    ```
+    """)
+
+FUSED_EVALUATION_INSTRUCTIONS_TEMPLATE = prompt_template("fused_evaluation_instructions", """
+    EVALUATION INSTRUCTIONS:
+    1. Identify which of the rubric approaches ({approach_names}) the student's code follows
+    2. If the code fits no approach well, choose the closest one and say so in the approach summary
+    3. Evaluate the student code against each point of the chosen approach only, numbered from 1
+    4. For each rubric point, determine if it is satisfied by the implementation
+    5. Provide a brief, specific justification for each evaluation
+    6. Calculate the total score based on marks awarded for each rubric point
+    7. Focus on algorithmic correctness rather than syntax or style unless the rubric specifies otherwise
+    8. Mark the student's code based on what it DOES, not what you think the intention was
+    9. If the implementation is correct but different from what you expected, it should still receive full marks
+    10. The student's code follows at the end of this prompt
+
+    CRITICAL: {trust_implementation}
+
+    Return your evaluation as a JSON object with the following structure:
+    {{
+        "approach_used": "Exact name of the chosen approach, one of: {approach_names}",
+        "approach_confidence": 0.0 to 1.0,
+        "approach_summary": "At most {max_words} words on how the code implements the chosen approach",
+        "evaluation": {{
+            "1": {{"satisfied": true/false, "justification": "At most {max_words} words citing specific details from the code", "marks_awarded": marks_value}},
+            "2": {{ ... }},
+            ...
+        }},
+        "total_score": sum_of_marks,
+        "max_possible_score": max_marks_of_the_chosen_approach
+    }}
+    """)
+
+CRITERION_TEMPLATE = prompt_template("criterion_evaluation", """
+    You are evaluating a student's code submission against a specific criterion.
+
+    PROBLEM:
+    {problem_statement}
+
+    CRITERION: {criterion_description} [{max_marks} mark(s)]
+
+    Evaluate if the student's code, which follows, satisfies this SPECIFIC criterion ONLY.
+    Respond with a JSON object with the following structure:
+    {{"satisfied": true/false, "justification": "Brief explanation (at most {max_words} words)", "marks_awarded": marks_value (0 to {max_marks})}}
+
+    Only return the JSON object, nothing else.
+    """)
+
+CRITERIA_TEMPLATE = prompt_template("criteria_evaluation", """
+    You are evaluating a student's code submission against specific criteria.
+
+    PROBLEM:
+    {problem_statement}
+
+    CRITERIA:
+    {criteria}
+
+    Evaluate each criterion independently: decide whether the student's code, which
+    follows, satisfies that criterion ONLY.
+    Respond with a JSON object with the following structure, with one entry per criterion ID:
+    {{"evaluation": {{"criterion_id": {{"satisfied": true/false, "justification": "Brief explanation (at most {max_words} words)", "marks_awarded": marks_value (0 to the criterion's marks)}}, ...}}}}
+
+    Only return the JSON object, nothing else.
+    """)
+
+FEEDBACK_SUMMARY_TEMPLATE = prompt_template("feedback_summary", """
+    Based on the evaluation results below, provide a concise summary feedback
+    for the student's code submission.
+
+    PROBLEM:
+    {problem_statement}
+
+    EVALUATION RESULTS:
+    {evaluation_results}
+
+    TOTAL SCORE: {total_score} / {max_score}
+
+    Provide helpful, constructive feedback in 3-5 sentences.
+    """)
+
 class LLMClientService:
     """
     Service for interacting with LLM models for code evaluation purposes,
@@ -34,11 +256,21 @@ class LLMClientService:
         model_solution: Optional[str] = None,
         algorithm_guidance: Optional[Dict[str, Any]] = None,
         approach_explanation: Optional[str] = None,
-        problem_dir: Optional[str] = None
-    ) -> str:
+        problem_dir: Optional[str] = None,
+        token_budget: Optional[int] = None
+    ) -> PromptParts:
         """
         Construct a secure prompt for code evaluation with algorithm-specific guidance
         
+        The prompt is assembled from prioritized sections so that it always fits
+        the model's prompt budget: test cases and other supplementary guidance are
+        trimmed first, and the rubric, student code and instructions last.
+        Everything that is the same for all students on a problem (instructions,
+        problem, rubric, guidance) forms a static prefix that providers can cache;
+        the approach explanation and student code follow it.
+        The prompt is meant to be wrapped with create_security_wrapper, which
+        carries the role and embedded-instruction directives.
+        
         Args:
             problem_statement: The problem statement
             rubric: The evaluation rubric
@@ -47,139 +279,109 @@ class LLMClientService:
             algorithm_guidance: Optional algorithm guidance from the guidance agent
             approach_explanation: Optional detailed explanation of student's approach
             problem_dir: Optional path to directory with example solutions
+            token_budget: Optional prompt budget in estimated tokens, defaults to the
+                budget of the default model
             
         Returns:
-            Evaluation prompt for the LLM
-        """
-        # Create a general algorithm guidance as fallback
-        general_guidance = """
-        ALGORITHM EVALUATION GUIDANCE:
-        - When evaluating algorithms, consider both explicit and implicit correctness
-        - Many algorithms have multiple valid implementations that use different patterns
-        - For search algorithms, pay attention to boundary conditions and edge cases
-        - Consider the overall logic and structure of the solution, not just specific lines
-        - A solution may be correct even if it implements the algorithm differently from what you expect
-        - Focus on whether the solution produces correct results for all possible inputs
+            Evaluation prompt for the LLM, split into static prefix and student suffix
         """
+        builder = PromptBuilder(token_budget or prompt_token_budget())
         
-        # Initialize specific_guidance
-        specific_guidance = general_guidance
+        # Static prefix
+        builder.add("header", EVALUATION_HEADER_TEMPLATE.render(), required=True, static=True)
+        builder.add("problem", PROBLEM_TEMPLATE.render(problem_statement=problem_statement), priority=1, static=True)
+        builder.add("rubric", RUBRIC_TEMPLATE.render(rubric=rubric), required=True, static=True)
         
         # Use provided algorithm_guidance if available
         if algorithm_guidance:
             algorithm_type = algorithm_guidance.get("algorithm_type", "general")
-            algorithm_guidance_text = algorithm_guidance.get("algorithm_guidance", "")
-            test_cases = algorithm_guidance.get("test_cases", "")
-            common_errors = algorithm_guidance.get("common_errors", "")
-            key_patterns = algorithm_guidance.get("key_implementation_patterns", "")
-            misleading_patterns = algorithm_guidance.get("misleading_patterns", "")
-            
-            specific_guidance = f"""
-            ALGORITHM-SPECIFIC GUIDANCE FOR {algorithm_type.upper()}:
-            {algorithm_guidance_text}
-            
-            KEY IMPLEMENTATION PATTERNS TO LOOK FOR:
-            {key_patterns}
-            
-            MISLEADING PATTERNS TO IGNORE:
-            {misleading_patterns}
             
-            COMMON ERRORS TO WATCH FOR:
-            {common_errors}
-            
-            TEST CASES FOR VERIFICATION:
-            {test_cases}
-            """
+            builder.add("guidance", GUIDANCE_TEMPLATE.render(
+                algorithm_type=algorithm_type.upper(),
+                algorithm_guidance=algorithm_guidance.get("algorithm_guidance", ""),
+                key_patterns=algorithm_guidance.get("key_implementation_patterns", ""),
+                misleading_patterns=algorithm_guidance.get("misleading_patterns", "")
+            ), priority=2, static=True)
+            builder.add("guidance_common_errors", COMMON_ERRORS_TEMPLATE.render(
+                common_errors=algorithm_guidance.get("common_errors", "")
+            ), priority=3, static=True)
+            builder.add("guidance_test_cases", TEST_CASES_TEMPLATE.render(
+                test_cases=algorithm_guidance.get("test_cases", "")
+            ), priority=4, static=True)
             
             logger.info(f"Using provided guidance for algorithm type: {algorithm_type}")
+        else:
+            # Use the general algorithm guidance as fallback
+            builder.add("guidance", GENERAL_GUIDANCE_TEMPLATE.render(), priority=2, static=True)
         
-        # Include approach explanation if available
-        student_approach_section = ""
-        if approach_explanation:
-            student_approach_section = f"""
-            {approach_explanation}
-            
-            NOTE: The above analysis provides insight into the student's implementation approach 
-            and identifies any issues without suggesting fixes. Use this information to better 
-            understand what the student has attempted, but ensure your evaluation is based on 
-            the actual code and the rubric criteria.
-            """
-        
-        prompt = f"""
-        You are a secure code evaluator with expertise in algorithms and programming languages.
-        Your task is to evaluate student code based SOLELY on the provided rubric.
-        Evaluate the code fairly and objectively, considering all valid implementation approaches.
+        if model_solution:
+            builder.add("model_solution", MODEL_SOLUTION_TEMPLATE.render(model_solution=model_solution), priority=3, static=True)
         
-        PROBLEM STATEMENT:
-        ```
-        {problem_statement}
-        ```
+        builder.add("instructions", EVALUATION_INSTRUCTIONS_TEMPLATE.render(
+            trust_implementation=TRUST_IMPLEMENTATION,
+            max_words=stage_budget("evaluation").max_words
+        ), required=True, static=True)
         
-        {specific_guidance}
+        # Student-specific suffix
+        if approach_explanation:
+            builder.add("approach_explanation", APPROACH_EXPLANATION_TEMPLATE.render(
+                approach_explanation=compact_text(approach_explanation)
+            ), priority=3)
         
-        {student_approach_section}
+        builder.add("student_code", STUDENT_CODE_TEMPLATE.render(student_code=student_code), required=True, keep="middle")
         
-        RUBRIC:
-        ```
-        {rubric}
-        ```
+        return builder.build_parts(prompt_group(problem_statement))
+
+    async def construct_fused_evaluation_prompt(
+        self,
+        problem_statement: str,
+        formatted_rubrics: Dict[str, str],
+        student_code: str,
+        model_solution: Optional[str] = None,
+        token_budget: Optional[int] = None
+    ) -> PromptParts:
         """
+        Construct a prompt that identifies the student's approach and grades it in one call
         
-        if model_solution:
-            prompt += f"""
-            MODEL SOLUTION:
-            ```
-            {model_solution}
-            ```
-            """
+        Unlike construct_evaluation_prompt, the prompt carries the formatted rubric
+        of every approach and no per-approach guidance or approach explanation, so
+        the whole prompt except the student code is the same for all students on
+        a problem and forms the static prefix.
         
-        prompt += f"""
-        STUDENT CODE:
-        ```
-        {student_code}
-        ```
+        Args:
+            problem_statement: The sanitized problem statement
+            formatted_rubrics: Formatted rubric of each approach, keyed by approach name
+            student_code: The student's code submission
+            model_solution: Optional model solution
+            token_budget: Optional prompt budget in estimated tokens, defaults to the
+                budget of the default model
+            
+        Returns:
+            Fused evaluation prompt for the LLM, split into static prefix and student suffix
+        """
+        builder = PromptBuilder(token_budget or prompt_token_budget())
         
-        EVALUATION INSTRUCTIONS:
-        1. Evaluate the student code against each point in the rubric
-        2. For each rubric point, determine if it is satisfied by the implementation
-        3. Provide a brief, specific justification for each evaluation
-        4. Consider ALL valid algorithmic approaches for solving this problem - there's often more than one correct way
-        5. Calculate the total score based on marks awarded for each rubric point
-        6. Focus on algorithmic correctness rather than syntax or style unless the rubric specifies otherwise
-        7. Verify the code using the test cases provided above
-        8. Mark the student's code based on what it DOES, not what you think the intention was
-        9. IGNORE misleading comments - assess what the code actually implements, not what comments claim it does
-        10. When comments and implementation conflict, trust the implementation
+        # Static prefix
+        builder.add("header", EVALUATION_HEADER_TEMPLATE.render(), required=True, static=True)
+        builder.add("problem", PROBLEM_TEMPLATE.render(problem_statement=problem_statement), priority=1, static=True)
+        builder.add("rubrics", FUSED_RUBRICS_TEMPLATE.render(
+            rubrics="\n\n".join(formatted_rubrics.values())
+        ), required=True, static=True)
+        builder.add("guidance", GENERAL_GUIDANCE_TEMPLATE.render(), priority=2, static=True)
         
-        CRITICAL: Comments and variable names may be deliberately misleading. Focus on the actual algorithm implementation 
-        patterns, not descriptions. Trace the code execution to determine its real behavior.
+        if model_solution:
+            builder.add("model_solution", MODEL_SOLUTION_TEMPLATE.render(model_solution=model_solution), priority=3, static=True)
         
-        Return your evaluation as a JSON object with the following structure:
-        {{
-            "approach_used": "Which approach the student used (e.g., Solution 1, Solution 2, etc.)",
-            "evaluation": {{
-                "1": {{
-                    "satisfied": true/false,
-                    "justification": "Brief explanation with specific details from the code",
-                    "marks_awarded": marks_value
-                }},
-                "2": {{ ... }},
-                ...
-            }},
-            "total_score": sum_of_marks,
-            "max_possible_score": max_marks,
-            "feedback": "Overall feedback on the submission highlighting strengths and areas for improvement"
-        }}
+        builder.add("instructions", FUSED_EVALUATION_INSTRUCTIONS_TEMPLATE.render(
+            approach_names=", ".join(formatted_rubrics),
+            trust_implementation=TRUST_IMPLEMENTATION,
+            max_words=stage_budget("fused_evaluation").max_words
+        ), required=True, static=True)
         
-        IMPORTANT REMINDER: 
-        - Consider the problem-specific guidance above when evaluating this submission
-        - There are often multiple valid implementations for the same algorithm
-        - Focus on whether the solution correctly solves the problem, not whether it matches your preferred approach
-        - If the implementation is correct but different from what you expected, it should still receive full marks
-        - Comments and variable names may intentionally misrepresent the code's behavior - always analyze the actual logic
-        """
+        # Student-specific suffix
+        builder.add("student_code", STUDENT_CODE_TEMPLATE.render(student_code=student_code), required=True, keep="middle")
         
-        return prompt
+        return builder.build_parts(prompt_group(problem_statement))
 
     def parse_llm_response(self, response_text: str) -> Dict[str, Any]:
         """
@@ -192,14 +394,7 @@ class LLMClientService:
             Parsed response as a dictionary
         """
         try:
-            # Try to extract JSON from the response
-            json_match = re.search(r'```json\s*(.*?)\s*```', response_text, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(1)
-                return json.loads(json_str)
-            
-            # If no JSON code block, try to parse the entire response
-            return json.loads(response_text)
+            return decode_json(response_text)
         except Exception as e:
             logger.error(f"Error parsing LLM response: {str(e)}", exc_info=True)
             logger.debug(f"Raw response: {response_text}")
@@ -210,26 +405,29 @@ class LLMClientService:
                 "approach_used": "unknown",
                 "evaluation": {},
                 "total_score": 0,
-                "max_possible_score": 0,
-                "feedback": "Error processing evaluation"
+                "max_possible_score": 0
             }
             
-    async def evaluate_with_prompt(self, prompt: str) -> Dict[str, Any]:
+    async def evaluate_with_prompt(self, prompt: Union[str, PromptParts], num_criteria: int = 0) -> Dict[str, Any]:
         """
         Send a prompt to the LLM and parse the response
         
         Args:
-            prompt: The evaluation prompt to send
+            prompt: The evaluation prompt to send, optionally split into static prefix and suffix
+            num_criteria: Number of rubric points to evaluate, sizes the output budget
             
         Returns:
             Parsed evaluation results
         """
         try:
-            # Query the LLM
-            response_text = await query_llm(prompt)
-            
-            # Parse the response
-            return self.parse_llm_response(response_text)
+            # Query the LLM for a response matching the evaluation schema
+            evaluation = await query_llm_structured(
+                prompt,
+                RubricEvaluation,
+                max_tokens=stage_budget("evaluation").tokens_for(num_criteria),
+                stage="evaluation"
+            )
+            return evaluation.model_dump()
         except Exception as e:
             logger.error(f"Error in LLM evaluation: {str(e)}", exc_info=True)
             return {
@@ -237,8 +435,38 @@ class LLMClientService:
                 "approach_used": "unknown",
                 "evaluation": {},
                 "total_score": 0,
-                "max_possible_score": 0,
-                "feedback": "An error occurred during evaluation"
+                "max_possible_score": 0
+            }
+            
+    async def evaluate_fused(self, prompt: Union[str, PromptParts], num_criteria: int = 0) -> Dict[str, Any]:
+        """
+        Send a fused evaluation prompt to the LLM and parse the response
+        
+        Args:
+            prompt: The fused evaluation prompt, optionally split into static prefix and suffix
+            num_criteria: Number of points of the largest approach, sizes the output budget
+            
+        Returns:
+            Parsed approach classification and evaluation results
+        """
+        try:
+            evaluation = await query_llm_structured(
+                prompt,
+                FusedEvaluation,
+                max_tokens=stage_budget("fused_evaluation").tokens_for(num_criteria),
+                stage="fused_evaluation"
+            )
+            return evaluation.model_dump()
+        except Exception as e:
+            logger.error(f"Error in fused LLM evaluation: {str(e)}", exc_info=True)
+            return {
+                "error": f"Error during LLM evaluation: {str(e)}",
+                "approach_used": "unknown",
+                "approach_confidence": 0.0,
+                "approach_summary": "",
+                "evaluation": {},
+                "total_score": 0,
+                "max_possible_score": 0
             }
             
     async def generate_criterion_evaluation(
@@ -260,46 +488,90 @@ class LLMClientService:
         Returns:
             Evaluation results for the specific criterion
         """
-        # Format the prompt for this specific criterion
-        point_prompt = f"""
-        You are evaluating a student's code submission against a specific criterion.
+        budget = stage_budget("criterion")
         
-        PROBLEM:
-        {problem_statement}
-        
-        CRITERION: {criterion_description} [{max_marks} mark(s)]
-        
-        STUDENT CODE:
-        ```
-        {student_code}
-        ```
-        
-        Evaluate if the student's code satisfies this SPECIFIC criterion ONLY.
-        Respond with a JSON object with the following structure:
-        {{
-            "satisfied": true/false,
-            "justification": "Brief explanation",
-            "marks_awarded": marks_value (0 to {max_marks})
-        }}
-        
-        Only return the JSON object, nothing else.
-        """
-        
-        # Query the LLM
-        response_text = await query_llm(point_prompt)
+        # Format the prompt for this specific criterion
+        point_prompt = PromptParts(
+            CRITERION_TEMPLATE.render(
+                problem_statement=problem_statement,
+                criterion_description=criterion_description,
+                max_marks=max_marks,
+                max_words=budget.max_words
+            ),
+            STUDENT_CODE_TEMPLATE.render(student_code=student_code),
+            prompt_group(problem_statement)
+        )
         
         try:
-            # Parse the response
-            return json.loads(response_text)
-        except json.JSONDecodeError:
-            logger.error(f"Failed to parse criterion evaluation response: {response_text}")
+            # Query the LLM for a response matching the criterion schema
+            evaluation = await query_llm_structured(
+                point_prompt,
+                CriterionEvaluation,
+                max_tokens=budget.max_tokens,
+                stage="criterion"
+            )
+            return evaluation.model_dump()
+        except StructuredOutputError as e:
+            logger.error(f"Failed to parse criterion evaluation response: {str(e)}")
             # Create a default failed evaluation
             return {
                 "satisfied": False,
                 "justification": "Failed to evaluate this criterion",
-                "marks_awarded": 0
+                "marks_awarded": 0,
+                "error": str(e)
             }
             
+    async def generate_criteria_evaluation(
+        self,
+        problem_statement: str,
+        criteria: List[Dict[str, Any]],
+        student_code: str
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Generate evaluations for several criteria in one call
+        
+        Args:
+            problem_statement: The problem statement
+            criteria: Criteria with "id", "description" and "marks"
+            student_code: The student's code submission
+            
+        Returns:
+            Evaluation results keyed by criterion ID; criteria missing from the
+            response, or all of them if it cannot be parsed, are left out
+        """
+        budget = stage_budget("criteria")
+        
+        criteria_prompt = PromptParts(
+            CRITERIA_TEMPLATE.render(
+                problem_statement=problem_statement,
+                criteria="\n".join(
+                    f"{criterion['id']}. {criterion['description']} [{criterion['marks']} mark(s)]"
+                    for criterion in criteria
+                ),
+                max_words=budget.max_words
+            ),
+            STUDENT_CODE_TEMPLATE.render(student_code=student_code),
+            prompt_group(problem_statement)
+        )
+        
+        try:
+            evaluation = await query_llm_structured(
+                criteria_prompt,
+                CriteriaEvaluation,
+                max_tokens=budget.tokens_for(len(criteria)),
+                stage="criteria"
+            )
+        except StructuredOutputError as e:
+            logger.error(f"Failed to parse criteria evaluation response: {str(e)}")
+            return {}
+        
+        criterion_ids = {criterion["id"] for criterion in criteria}
+        return {
+            criterion_id: criterion_evaluation.model_dump()
+            for criterion_id, criterion_evaluation in evaluation.evaluation.items()
+            if criterion_id in criterion_ids
+        }
+            
     async def generate_feedback_summary(
         self,
         problem_statement: str,
@@ -319,20 +591,16 @@ class LLMClientService:
         Returns:
             Summary feedback text
         """
-        feedback_prompt = f"""
-        Based on the evaluation results below, provide a concise summary feedback 
-        for the student's code submission.
-        
-        PROBLEM:
-        {problem_statement}
-        
-        EVALUATION RESULTS:
-        {json.dumps(evaluation_results, indent=2)}
-        
-        TOTAL SCORE: {total_score} / {max_score}
-        
-        Provide helpful, constructive feedback in 3-5 sentences.
-        """
-        
-        feedback_response = await query_llm(feedback_prompt)
+        feedback_prompt = FEEDBACK_SUMMARY_TEMPLATE.render(
+            problem_statement=problem_statement,
+            evaluation_results=compact_json(evaluation_results),
+            total_score=total_score,
+            max_score=max_score
+        )
+        
+        feedback_response = await query_llm(
+            feedback_prompt,
+            max_tokens=stage_budget("feedback_summary").max_tokens,
+            stage="feedback_summary"
+        )
         return feedback_response.strip()
\ No newline at end of file
@@ -0,0 +1,272 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, List, Any, Optional, Tuple
+from dotenv import load_dotenv
+
+from app.db.database import SessionLocal
+from app.db.models import Submission, EvaluationStatus
+from app.utils.minhash import MinHasher, LSHIndex, Signature, code_shingles
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Near-duplicate index configuration
+NEAR_DUPLICATE_ENABLED = os.getenv("NEAR_DUPLICATE_ENABLED", "true").lower() == "true"
+NEAR_DUPLICATE_NUM_PERM = int(os.getenv("NEAR_DUPLICATE_NUM_PERM", "64"))
+NEAR_DUPLICATE_BANDS = int(os.getenv("NEAR_DUPLICATE_BANDS", "16"))
+# Similarity above which a neighbor's approach classification is reused
+NEAR_DUPLICATE_REUSE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_REUSE_THRESHOLD", "0.9"))
+# Similarity above which submissions are grouped into a cluster
+NEAR_DUPLICATE_CLUSTER_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_CLUSTER_THRESHOLD", "0.8"))
+
+class IndexedSubmission:
+    """What the index remembers about a graded submission"""
+
+    def __init__(
+        self,
+        submission_id: int,
+        user_id: Optional[int],
+        approach: Optional[str] = None,
+        problem_version: Optional[str] = None
+    ):
+        self.submission_id = submission_id
+        self.user_id = user_id
+        self.approach = approach
+        self.problem_version = problem_version
+
+class NearDuplicateIndex:
+    """
+    MinHash/LSH index of graded submissions, one LSH index per problem
+
+    Submissions are added one at a time as they are graded, so the index never
+    needs a full rebuild; at startup it is filled from the stored submissions.
+    Lookups only compare signatures and make no LLM calls. Evaluations use it
+    to reuse the approach classification of a near-duplicate, and admins use
+    it to find clusters of near-identical code from different students.
+    """
+
+    def __init__(self, num_perm: int = NEAR_DUPLICATE_NUM_PERM, bands: int = NEAR_DUPLICATE_BANDS):
+        self.num_perm = num_perm
+        self.bands = bands
+        self.hasher = MinHasher(num_perm)
+        self._indexes: Dict[int, LSHIndex] = {}
+        self._entries: Dict[int, Dict[int, IndexedSubmission]] = {}
+
+        # Metrics
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.max_query_seconds = 0.0
+        self.reused_classifications = 0
+
+    def signature(self, code: str, language: str = "java") -> Signature:
+        """
+        MinHash signature of a submission's normalized code
+        """
+        return self.hasher.signature(code_shingles(code, language))
+
+    def add(
+        self,
+        problem_id: int,
+        submission_id: int,
+        signature: Signature,
+        user_id: Optional[int] = None,
+        approach: Optional[str] = None,
+        problem_version: Optional[str] = None
+    ) -> None:
+        """
+        Index a graded submission, replacing an earlier entry for it
+
+        Args:
+            problem_id: Problem the submission answers
+            submission_id: Submission ID
+            signature: Signature from signature()
+            user_id: Submitting user
+            approach: Rubric approach the submission was classified as, if known
+            problem_version: Problem content hash the classification was made against
+        """
+        index = self._indexes.get(problem_id)
+        if index is None:
+            index = self._indexes[problem_id] = LSHIndex(self.num_perm, self.bands)
+            self._entries[problem_id] = {}
+        index.add(submission_id, signature)
+        self._entries[problem_id][submission_id] = IndexedSubmission(submission_id, user_id, approach, problem_version)
+
+    def neighbors(
+        self,
+        problem_id: int,
+        signature: Signature,
+        threshold: float = NEAR_DUPLICATE_CLUSTER_THRESHOLD,
+        limit: int = 10,
+        exclude: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Find graded submissions to a problem similar to the given signature
+
+        Args:
+            problem_id: Problem ID
+            signature: Signature from signature()
+            threshold: Minimum estimated similarity
+            limit: Maximum number of neighbors
+            exclude: Submission to leave out, e.g. the one being looked up
+
+        Returns:
+            Neighbors with submission ID, user ID, approach and similarity, most similar first
+        """
+        index = self._indexes.get(problem_id)
+        if index is None:
+            return []
+
+        started = time.perf_counter()
+        matches = index.query(signature, threshold, limit, exclude)
+        elapsed = time.perf_counter() - started
+        self.queries += 1
+        self.query_seconds += elapsed
+        self.max_query_seconds = max(self.max_query_seconds, elapsed)
+
+        entries = self._entries[problem_id]
+        return [
+            {
+                "submission_id": submission_id,
+                "user_id": entries[submission_id].user_id,
+                "approach": entries[submission_id].approach,
+                "similarity": similarity
+            }
+            for submission_id, similarity in matches
+        ]
+
+    def find_classified(
+        self,
+        problem_id: int,
+        signature: Signature,
+        problem_version: str,
+        threshold: float = NEAR_DUPLICATE_REUSE_THRESHOLD,
+        exclude: Optional[int] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Find the most similar near-duplicate whose approach classification can be
+        reused, i.e. one classified against the same problem version
+
+        Returns:
+            The neighbor, or None
+        """
+        entries = self._entries.get(problem_id, {})
+        for neighbor in self.neighbors(problem_id, signature, threshold, exclude=exclude):
+            entry = entries[neighbor["submission_id"]]
+            if entry.approach and entry.problem_version == problem_version:
+                self.reused_classifications += 1
+                return neighbor
+        return None
+
+    def submission_signature(self, problem_id: int, submission_id: int) -> Optional[Signature]:
+        index = self._indexes.get(problem_id)
+        return index.signature(submission_id) if index is not None else None
+
+    def clusters(
+        self,
+        problem_id: int,
+        threshold: float = NEAR_DUPLICATE_CLUSTER_THRESHOLD,
+        min_size: int = 3
+    ) -> List[Dict[str, Any]]:
+        """
+        Group a problem's submissions into clusters of near-duplicates
+
+        A cluster is suspicious when its submissions come from more than one user;
+        repeated submissions by the same student are expected.
+
+        Args:
+            problem_id: Problem ID
+            threshold: Minimum similarity linking two submissions
+            min_size: Smallest cluster reported
+
+        Returns:
+            Clusters, largest first, with their submissions, users and a suspicious flag
+        """
+        index = self._indexes.get(problem_id)
+        if index is None:
+            return []
+
+        parent: Dict[int, int] = {key: key for key in index.keys()}
+
+        def find(key: int) -> int:
+            while parent[key] != key:
+                parent[key] = parent[parent[key]]
+                key = parent[key]
+            return key
+
+        for key in index.keys():
+            for neighbor, _ in index.query(index.signature(key), threshold, limit=len(index), exclude=key):
+                parent[find(neighbor)] = find(key)
+
+        groups: Dict[int, List[int]] = {}
+        for key in index.keys():
+            groups.setdefault(find(key), []).append(key)
+
+        entries = self._entries[problem_id]
+        clusters = []
+        for members in groups.values():
+            if len(members) < min_size:
+                continue
+            user_ids = sorted({entries[key].user_id for key in members if entries[key].user_id is not None})
+            clusters.append({
+                "submission_ids": sorted(members),
+                "user_ids": user_ids,
+                "size": len(members),
+                "suspicious": len(user_ids) > 1
+            })
+        clusters.sort(key=lambda cluster: cluster["size"], reverse=True)
+        return clusters
+
+    def _load_submissions(self) -> List[Tuple[int, int, int, Signature]]:
+        db = SessionLocal()
+        try:
+            submissions = db.query(Submission).filter(
+                Submission.evaluation_status == EvaluationStatus.completed
+            ).all()
+            return [
+                (submission.problem_id, submission.id, submission.user_id, self.signature(submission.code, submission.language))
+                for submission in submissions
+            ]
+        finally:
+            db.close()
+
+    async def warm(self) -> int:
+        """
+        Index every graded submission in the database
+
+        Classifications are not stored with submissions, so warmed entries serve
+        clustering and similarity queries until they are graded again.
+
+        Returns:
+            Number of submissions indexed
+        """
+        if not NEAR_DUPLICATE_ENABLED:
+            return 0
+        try:
+            # Signatures are computed off the event loop
+            loaded = await asyncio.to_thread(self._load_submissions)
+        except Exception as e:
+            logger.error(f"Error loading submissions for the near-duplicate index: {str(e)}")
+            return 0
+
+        for problem_id, submission_id, user_id, signature in loaded:
+            if submission_id not in self._entries.get(problem_id, {}):
+                self.add(problem_id, submission_id, signature, user_id)
+        logger.info(f"Indexed {len(loaded)} graded submissions for near-duplicate lookup")
+        return len(loaded)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "enabled": NEAR_DUPLICATE_ENABLED,
+            "problems": len(self._indexes),
+            "submissions": sum(len(index) for index in self._indexes.values()),
+            "queries": self.queries,
+            "avg_query_ms": self.query_seconds / self.queries * 1000 if self.queries else 0.0,
+            "max_query_ms": self.max_query_seconds * 1000,
+            "reused_classifications": self.reused_classifications
+        }
+
+near_duplicate_index = NearDuplicateIndex()
@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from typing import Dict, List, Any, Optional, Tuple
+from dotenv import load_dotenv
+
+from app.services.llm_client_service import LLMClientService, CRITERION_PROMPT_VERSION
+from app.utils.code_fingerprint import code_fingerprint
+from app.utils.llm_cache import LLMResponseCache
+from app.utils.llm_utils import DEFAULT_MODEL
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Pointwise evaluation configuration
+PRE_CONCURRENCY = int(os.getenv("PRE_CONCURRENCY", "4"))
+# Criteria evaluated per LLM call; 1 evaluates every criterion on its own
+PRE_CRITERIA_PER_CALL = int(os.getenv("PRE_CRITERIA_PER_CALL", "1"))
+PRE_CRITERION_CACHE_ENABLED = os.getenv("PRE_CRITERION_CACHE_ENABLED", "true").lower() == "true"
+PRE_CRITERION_CACHE_MAX_ENTRIES = int(os.getenv("PRE_CRITERION_CACHE_MAX_ENTRIES", "8192"))
+PRE_CRITERION_CACHE_TTL = int(os.getenv("PRE_CRITERION_CACHE_TTL", str(7 * 24 * 3600)))
+
+class CriterionLatencyStats:
+    """Latency of criterion evaluation calls per packing size"""
+
+    def __init__(self):
+        self._sizes: Dict[int, Dict[str, float]] = {}
+
+    def record(self, criteria: int, seconds: float) -> None:
+        stats = self._sizes.setdefault(criteria, {"calls": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+        stats["calls"] += 1
+        stats["total_seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            str(criteria): {
+                "calls": int(stats["calls"]),
+                "avg_call_seconds": stats["total_seconds"] / stats["calls"],
+                "max_call_seconds": stats["max_seconds"],
+                # Cost of one criterion when packed this way, the number to compare across sizes
+                "avg_seconds_per_criterion": stats["total_seconds"] / (stats["calls"] * criteria)
+            }
+            for criteria, stats in sorted(self._sizes.items())
+        }
+
+class PointwiseEvaluator:
+    """
+    Evaluates rubric criteria one at a time or in packs, concurrently
+
+    All criteria of an approach share the problem statement and student code,
+    so consecutive criteria can be packed into one call; packs run
+    concurrently under a semaphore. Criteria a packed response leaves out are
+    evaluated on their own, and a pack whose call fails yields an error entry
+    for each of its criteria without affecting the other packs. Results are
+    reused for the same criterion text and normalized code, so an unchanged
+    criterion is not re-evaluated when another part of the rubric is edited.
+    """
+
+    def __init__(
+        self,
+        llm_client: Optional[LLMClientService] = None,
+        concurrency: int = PRE_CONCURRENCY,
+        criteria_per_call: int = PRE_CRITERIA_PER_CALL,
+        cache_enabled: bool = PRE_CRITERION_CACHE_ENABLED
+    ):
+        self.llm_client = llm_client or LLMClientService()
+        self.concurrency = max(1, concurrency)
+        self.criteria_per_call = max(1, criteria_per_call)
+        self.cache_enabled = cache_enabled
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._cache = LLMResponseCache(
+            max_entries=PRE_CRITERION_CACHE_MAX_ENTRIES,
+            ttl=PRE_CRITERION_CACHE_TTL
+        )
+        self.latency = CriterionLatencyStats()
+
+        # Metrics
+        self.criteria = 0
+        self.reused = 0
+        self.calls = 0
+        self.unpacked = 0
+        self.failures = 0
+
+    @staticmethod
+    def criterion_key(criterion: Dict[str, Any], student_code: str, language: str = "java") -> str:
+        """
+        Cache key of a criterion evaluation: criterion text and marks, normalized
+        code, prompt version and model
+        """
+        material = json.dumps(
+            [
+                criterion["description"],
+                criterion["marks"],
+                code_fingerprint(student_code, language),
+                CRITERION_PROMPT_VERSION,
+                DEFAULT_MODEL
+            ],
+            separators=(",", ":")
+        )
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    async def _evaluate_pack(
+        self,
+        problem_statement: str,
+        pack: List[Dict[str, Any]],
+        code: str
+    ) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, float]]:
+        async with self._semaphore:
+            started = time.perf_counter()
+            try:
+                if len(pack) == 1:
+                    criterion = pack[0]
+                    evaluations = {
+                        criterion["id"]: await self.llm_client.generate_criterion_evaluation(
+                            problem_statement,
+                            criterion["description"],
+                            criterion["marks"],
+                            code
+                        )
+                    }
+                else:
+                    evaluations = await self.llm_client.generate_criteria_evaluation(problem_statement, pack, code)
+            except Exception as e:
+                # A failed call must not discard the criteria other packs evaluated
+                logger.error(f"Error evaluating {len(pack)} criteria: {str(e)}", exc_info=True)
+                self.failures += 1
+                evaluations = {
+                    criterion["id"]: {
+                        "satisfied": False,
+                        "justification": "Failed to evaluate this criterion",
+                        "marks_awarded": 0,
+                        "error": str(e)
+                    }
+                    for criterion in pack
+                }
+            elapsed = time.perf_counter() - started
+        self.calls += 1
+        self.latency.record(len(pack), elapsed)
+        latencies = {criterion_id: elapsed for criterion_id in evaluations}
+
+        # Criteria the packed response left out are evaluated on their own
+        missing = [criterion for criterion in pack if criterion["id"] not in evaluations]
+        if missing:
+            self.unpacked += len(missing)
+            logger.warning(f"Packed criteria response is missing {len(missing)} of {len(pack)} criteria, evaluating them separately")
+            retried = await asyncio.gather(*(self._evaluate_pack(problem_statement, [criterion], code) for criterion in missing))
+            for retried_evaluations, retried_latencies in retried:
+                evaluations.update(retried_evaluations)
+                for criterion_id, seconds in retried_latencies.items():
+                    latencies[criterion_id] = elapsed + seconds
+        return evaluations, latencies
+
+    async def evaluate(
+        self,
+        problem_statement: str,
+        criteria: List[Dict[str, Any]],
+        code: str,
+        raw_code: Optional[str] = None,
+        language: str = "java",
+        criteria_per_call: Optional[int] = None
+    ) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, float]]:
+        """
+        Evaluate criteria against a student's code
+
+        Args:
+            problem_statement: The sanitized problem statement
+            criteria: Criteria with "id", "description" and "marks", in rubric order
+            code: The secured student code, sent to the LLM
+            raw_code: The student's raw code, used for the reuse key; defaults to code
+            language: Programming language of the code
+            criteria_per_call: Criteria packed into one call, defaults to PRE_CRITERIA_PER_CALL
+
+        Returns:
+            Evaluation results and latency in seconds, both keyed by criterion ID;
+            reused results have a latency of 0
+        """
+        pack_size = max(1, criteria_per_call or self.criteria_per_call)
+        self.criteria += len(criteria)
+
+        evaluations: Dict[str, Dict[str, Any]] = {}
+        latencies: Dict[str, float] = {}
+        keys: Dict[str, str] = {}
+        pending: List[Dict[str, Any]] = []
+        for criterion in criteria:
+            if not self.cache_enabled:
+                pending.append(criterion)
+                continue
+            key = keys[criterion["id"]] = self.criterion_key(criterion, raw_code or code, language)
+            cached = await self._cache.get(key)
+            if cached is None:
+                pending.append(criterion)
+                continue
+            self.reused += 1
+            evaluations[criterion["id"]] = json.loads(cached)
+            latencies[criterion["id"]] = 0.0
+
+        packs = [pending[i:i + pack_size] for i in range(0, len(pending), pack_size)]
+        for pack_evaluations, pack_latencies in await asyncio.gather(
+            *(self._evaluate_pack(problem_statement, pack, code) for pack in packs)
+        ):
+            evaluations.update(pack_evaluations)
+            latencies.update(pack_latencies)
+
+        # Failed evaluations are not reused
+        if self.cache_enabled:
+            for criterion in pending:
+                evaluation = evaluations.get(criterion["id"])
+                if evaluation is not None and not evaluation.get("error"):
+                    await self._cache.set(keys[criterion["id"]], json.dumps(evaluation), CRITERION_PROMPT_VERSION)
+
+        # Rubric order
+        ordered = {criterion["id"]: evaluations[criterion["id"]] for criterion in criteria if criterion["id"] in evaluations}
+        return ordered, latencies
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "concurrency": self.concurrency,
+            "criteria_per_call": self.criteria_per_call,
+            "criteria": self.criteria,
+            "reused": self.reused,
+            "reuse_rate": self.reused / self.criteria if self.criteria else 0.0,
+            "calls": self.calls,
+            "unpacked": self.unpacked,
+            "failures": self.failures,
+            "latency_by_pack_size": self.latency.get_metrics(),
+            "cache": self._cache.get_metrics()
+        }
+
+pointwise_evaluator = PointwiseEvaluator()
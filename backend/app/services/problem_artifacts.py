@@ -0,0 +1,198 @@
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional, Tuple
+from pydantic import BaseModel
+
+from app.db.database import SessionLocal
+from app.db.models import Problem
+from app.utils.rubric_parser import parse_rubric, get_approach_marks, format_approach_rubric
+from app.utils.sanitizer import sanitize_problem_statement, sanitize_rubric
+from app.utils.prompt_builder import prompt_group
+
+logger = logging.getLogger(__name__)
+
+def problem_content_hash(problem_statement: str, rubric: str) -> str:
+    """
+    Version of a problem's content, changes whenever the statement or rubric changes
+    """
+    material = f"{problem_statement}\x00{rubric}"
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()[:16]
+
+class ProblemArtifacts(BaseModel):
+    """Everything derived from a problem's statement and rubric, computed once per version"""
+    problem_id: Optional[int] = None
+    version: str
+    problem_statement: str
+    rubric: str
+    clean_problem: str
+    clean_rubric: str
+    parsed_rubric: Dict[str, Any]
+    formatted_rubrics: Dict[str, str]
+    rubric_points: Dict[str, Dict[str, int]]
+    max_scores: Dict[str, int]
+    group: str
+
+    @property
+    def max_criteria(self) -> int:
+        """Number of points of the largest approach"""
+        return max((len(points) for points in self.rubric_points.values()), default=0)
+
+def build_problem_artifacts(problem_statement: str, rubric: str, problem_id: Optional[int] = None) -> ProblemArtifacts:
+    """
+    Sanitize, parse and format a problem's statement and rubric
+
+    Each text is sanitized exactly once; everything downstream uses the
+    sanitized copies, so nothing is HTML-escaped twice.
+
+    Args:
+        problem_statement: Problem statement as stored
+        rubric: Rubric text as stored
+        problem_id: Optional problem ID
+
+    Returns:
+        The problem's artifacts
+    """
+    clean_problem = sanitize_problem_statement(problem_statement)
+    clean_rubric = sanitize_rubric(rubric)
+    parsed_rubric = parse_rubric(clean_rubric)
+
+    approaches = parsed_rubric["approaches"]
+    return ProblemArtifacts(
+        problem_id=problem_id,
+        version=problem_content_hash(problem_statement, rubric),
+        problem_statement=problem_statement,
+        rubric=rubric,
+        clean_problem=clean_problem,
+        clean_rubric=clean_rubric,
+        parsed_rubric=parsed_rubric,
+        formatted_rubrics={
+            approach: format_approach_rubric(approach, approach_rubric)
+            for approach, approach_rubric in approaches.items()
+        },
+        rubric_points={
+            approach: {str(i+1): point["marks"] for i, point in enumerate(approach_rubric["points"])}
+            for approach, approach_rubric in approaches.items()
+        },
+        max_scores={approach: get_approach_marks(parsed_rubric, approach) for approach in approaches},
+        group=prompt_group(clean_problem)
+    )
+
+class ProblemArtifactStore:
+    """
+    Bounded cache of problem artifacts keyed by problem ID and content hash
+
+    Artifacts are built when a problem is written and for every problem at
+    startup; grading looks them up and only builds them on a miss, e.g. for
+    requests that carry a problem not stored in the database.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[Optional[int], str], ProblemArtifacts]" = OrderedDict()
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+
+    def _put(self, artifacts: ProblemArtifacts) -> None:
+        key = (artifacts.problem_id, artifacts.version)
+        self._entries[key] = artifacts
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, problem_statement: str, rubric: str, problem_id: Optional[int] = None) -> ProblemArtifacts:
+        """
+        Get the artifacts for a problem version, building them on a miss
+
+        Args:
+            problem_statement: Problem statement as stored
+            rubric: Rubric text as stored
+            problem_id: Optional problem ID
+
+        Returns:
+            The problem's artifacts
+        """
+        key = (problem_id, problem_content_hash(problem_statement, rubric))
+        artifacts = self._entries.get(key)
+        if artifacts is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return artifacts
+
+        self.misses += 1
+        return self.refresh(problem_statement, rubric, problem_id)
+
+    def refresh(self, problem_statement: str, rubric: str, problem_id: Optional[int] = None) -> ProblemArtifacts:
+        """
+        Build and store the artifacts for a problem, replacing earlier versions of it
+
+        Args:
+            problem_statement: Problem statement as stored
+            rubric: Rubric text as stored
+            problem_id: Optional problem ID
+
+        Returns:
+            The problem's artifacts
+        """
+        artifacts = build_problem_artifacts(problem_statement, rubric, problem_id)
+        self.builds += 1
+        if problem_id is not None:
+            self.invalidate(problem_id)
+        self._put(artifacts)
+        return artifacts
+
+    def invalidate(self, problem_id: int) -> None:
+        """
+        Drop every cached version of a problem
+        """
+        for key in [key for key in self._entries if key[0] == problem_id]:
+            del self._entries[key]
+
+    def _load_problems(self) -> List[Tuple[int, str, str]]:
+        db = SessionLocal()
+        try:
+            return [
+                (problem.id, problem.problem_description, problem.rubric)
+                for problem in db.query(Problem).all()
+            ]
+        finally:
+            db.close()
+
+    async def warm(self) -> int:
+        """
+        Build the artifacts of every stored problem
+
+        Returns:
+            Number of problems warmed
+        """
+        try:
+            problems = await asyncio.to_thread(self._load_problems)
+        except Exception as e:
+            logger.error(f"Error loading problems to warm artifacts: {str(e)}")
+            return 0
+
+        warmed = 0
+        for problem_id, problem_statement, rubric in problems:
+            try:
+                self.refresh(problem_statement, rubric, problem_id)
+                warmed += 1
+            except Exception as e:
+                logger.error(f"Error building artifacts for problem {problem_id}: {str(e)}")
+        logger.info(f"Warmed artifacts for {warmed}/{len(problems)} problems")
+        return warmed
+
+    def get_metrics(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "builds": self.builds,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries)
+        }
+
+problem_artifact_store = ProblemArtifactStore()
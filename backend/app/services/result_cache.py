@@ -0,0 +1,160 @@
+import os
+import json
+import hashlib
+import logging
+from typing import Dict, Any, Optional
+from dotenv import load_dotenv
+
+from app.agents.rubric_extractor_agent import APPROACH_MATCH_PROMPT_VERSION
+from app.agents.approach_explanation_agent import APPROACH_EXPLANATION_PROMPT_VERSION
+from app.agents.evaluation_guidance_agent import GUIDANCE_PROMPT_VERSION
+from app.services.llm_client_service import EVALUATION_PROMPT_VERSION, FUSED_EVALUATION_PROMPT_VERSION
+from app.services.problem_artifacts import ProblemArtifacts
+from app.utils.code_fingerprint import code_fingerprint
+from app.utils.llm_cache import LLMResponseCache
+from app.utils.llm_utils import DEFAULT_MODEL
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Evaluation result cache configuration
+EVALUATION_CACHE_ENABLED = os.getenv("EVALUATION_CACHE_ENABLED", "true").lower() == "true"
+EVALUATION_CACHE_MAX_ENTRIES = int(os.getenv("EVALUATION_CACHE_MAX_ENTRIES", "4096"))
+EVALUATION_CACHE_TTL = int(os.getenv("EVALUATION_CACHE_TTL", str(30 * 24 * 3600)))
+EVALUATION_CACHE_PATH = os.getenv("EVALUATION_CACHE_PATH", "evaluation_cache.sqlite3")
+
+# Every prompt that contributes to a grade; a change to any of them invalidates stored results
+EVALUATION_PIPELINE_VERSION = "|".join([
+    APPROACH_MATCH_PROMPT_VERSION,
+    APPROACH_EXPLANATION_PROMPT_VERSION,
+    GUIDANCE_PROMPT_VERSION,
+    EVALUATION_PROMPT_VERSION,
+    FUSED_EVALUATION_PROMPT_VERSION
+])
+
+class EvaluationResultCache:
+    """
+    Whole-evaluation results keyed by problem version, rubric, prompt versions,
+    model and a fingerprint of the student code that ignores comments,
+    whitespace and identifier renaming
+
+    Resubmissions, copied templates and placeholder submissions are answered
+    without any LLM call. Results are stored in an LLMResponseCache (memory
+    plus SQLite) tagged with the pipeline version, so a prompt change can be
+    invalidated in one call.
+    """
+
+    def __init__(self, enabled: bool = EVALUATION_CACHE_ENABLED):
+        self.enabled = enabled
+        self._store = LLMResponseCache(
+            max_entries=EVALUATION_CACHE_MAX_ENTRIES,
+            ttl=EVALUATION_CACHE_TTL,
+            db_path=EVALUATION_CACHE_PATH or None
+        )
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.stored = 0
+
+    def make_key(
+        self,
+        artifacts: ProblemArtifacts,
+        student_code: str,
+        language: str = "java",
+        model_solution: Optional[str] = None,
+        problem_dir: Optional[str] = None,
+        evaluation_mode: str = "multi_agent"
+    ) -> str:
+        """
+        Build the cache key of an evaluation
+
+        Args:
+            artifacts: The problem's artifacts
+            student_code: The student's raw code
+            language: Programming language of the code
+            model_solution: Optional model solution, part of the evaluation prompt
+            problem_dir: Optional path to directory with example solutions
+            evaluation_mode: Pipeline that produced the result, results of different modes are kept apart
+
+        Returns:
+            Hex digest identifying the evaluation
+        """
+        rubric_hash = hashlib.sha256(artifacts.rubric.encode("utf-8")).hexdigest()[:16]
+        material = json.dumps(
+            [
+                artifacts.version,
+                rubric_hash,
+                EVALUATION_PIPELINE_VERSION,
+                evaluation_mode,
+                DEFAULT_MODEL,
+                language,
+                code_fingerprint(student_code, language),
+                model_solution or "",
+                problem_dir or ""
+            ],
+            separators=(",", ":")
+        )
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str, bypass: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Look up a stored evaluation result
+
+        Args:
+            key: Key from make_key
+            bypass: Skip the lookup, e.g. for regrades
+
+        Returns:
+            The stored EvaluationResponse fields or None
+        """
+        if not self.enabled:
+            return None
+        if bypass:
+            self.bypassed += 1
+            return None
+
+        value = await self._store.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return json.loads(value)
+
+    async def set(self, key: str, result: Dict[str, Any]) -> None:
+        """
+        Store an evaluation result; results with an error are never stored
+
+        Args:
+            key: Key from make_key
+            result: EvaluationResponse fields
+        """
+        if not self.enabled or result.get("error"):
+            return
+        await self._store.set(key, json.dumps(result), EVALUATION_PIPELINE_VERSION)
+        self.stored += 1
+
+    async def invalidate(self, pipeline_version: Optional[str] = None) -> None:
+        """
+        Remove stored results of one pipeline version, or all of them
+        """
+        await self._store.invalidate(template_version=pipeline_version)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "pipeline_version": EVALUATION_PIPELINE_VERSION,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "stored": self.stored,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "store": self._store.get_metrics()
+        }
+
+evaluation_result_cache = EvaluationResultCache()
@@ -0,0 +1,153 @@
+import re
+import ast
+import hashlib
+from typing import Dict, List, Optional, Set, Tuple
+
+# Bump when normalization changes so fingerprints of the old scheme are not matched
+FINGERPRINT_VERSION = "fingerprint-v2"
+
+JAVA_KEYWORDS = {
+    "abstract", "assert", "boolean", "break", "byte", "case", "catch", "char", "class", "const",
+    "continue", "default", "do", "double", "else", "enum", "extends", "final", "finally", "float",
+    "for", "goto", "if", "implements", "import", "instanceof", "int", "interface", "long", "native",
+    "new", "package", "private", "protected", "public", "return", "short", "static", "strictfp",
+    "super", "switch", "synchronized", "this", "throw", "throws", "transient", "try", "void",
+    "volatile", "while", "var", "record", "yield", "true", "false", "null"
+}
+
+# Tokens after which a name is being declared (int x, String s, List<T> xs, int[] a)
+JAVA_TYPE_KEYWORDS = {"boolean", "byte", "char", "short", "int", "long", "float", "double", "var", "void"}
+
+# Tokens that may follow a declared name: initializer, end of declaration,
+# next parameter or declarator, for-each colon, method parameters, C-style array
+_JAVA_DECLARATION_FOLLOWERS = {"=", ";", ",", ")", ":", "(", "["}
+
+# Comments first so that comment markers inside them are not tokenized; strings
+# before comments so that "//" inside a string literal is not taken for one
+_JAVA_TOKENS = re.compile(
+    r'(?P<string>"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\')'
+    r'|(?P<comment>//[^\n]*|/\*[\s\S]*?\*/)'
+    r'|(?P<name>[A-Za-z_$][\w$]*)'
+    r'|(?P<number>\d[\w.]*)'
+    r'|(?P<space>\s+)'
+    r'|(?P<symbol>.)'
+)
+
+_PYTHON_TOKENS = re.compile(
+    r'(?P<string>"""[\s\S]*?"""|\'\'\'[\s\S]*?\'\'\'|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\')'
+    r'|(?P<comment>#[^\n]*)'
+    r'|(?P<name>[A-Za-z_][\w]*)'
+    r'|(?P<number>\d[\w.]*)'
+    r'|(?P<space>\s+)'
+    r'|(?P<symbol>.)'
+)
+
+def _tokenize(code: str, pattern: "re.Pattern[str]") -> List[Tuple[str, str]]:
+    return [
+        (match.lastgroup, match.group())
+        for match in pattern.finditer(code)
+        if match.lastgroup not in ("comment", "space")
+    ]
+
+def _python_bound_names(code: str) -> Optional[Set[str]]:
+    """
+    Names the code binds itself: assignment and loop targets, parameters,
+    function and class names, exception and with/as names; None if the code
+    does not parse
+    """
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return None
+
+    bound: Set[str] = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            bound.add(node.id)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound.add(node.name)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            bound.add(node.name)
+    return bound
+
+def _java_bound_names(tokens: List[Tuple[str, str]]) -> Set[str]:
+    """
+    Names the code declares: variables, fields, parameters and methods
+    (a name after a type and before a declaration follower) and lambda parameters
+    """
+    bound: Set[str] = set()
+    for i, (kind, token) in enumerate(tokens):
+        if kind != "name" or token in JAVA_KEYWORDS or i == 0 or i + 1 >= len(tokens):
+            continue
+        previous_kind, previous = tokens[i - 1]
+        follower = tokens[i + 1][1]
+        after_type = (
+            previous in JAVA_TYPE_KEYWORDS
+            or previous == "]"
+            # Closing generic, not the arrow of a lambda
+            or (previous == ">" and tokens[i - 2][1] != "-")
+            or (previous_kind == "name" and previous[0].isupper())
+        )
+        if after_type and follower in _JAVA_DECLARATION_FOLLOWERS:
+            bound.add(token)
+        # Untyped lambda parameters: x -> ... and (a, b) -> ...
+        elif follower == "-" and i + 2 < len(tokens) and tokens[i + 2][1] == ">":
+            bound.add(token)
+        elif follower in (",", ")") and previous in ("(", ","):
+            close = i + 1
+            while close < len(tokens) and tokens[close][1] != ")":
+                close += 1
+            if close + 2 < len(tokens) and tokens[close + 1][1] == "-" and tokens[close + 2][1] == ">":
+                bound.add(token)
+    return bound
+
+def normalize_code(code: str, language: str = "java") -> List[str]:
+    """
+    Reduce code to a token sequence that ignores comments, whitespace and
+    identifier renaming
+
+    Names the code binds itself (variables, parameters, the student's own
+    functions) are replaced by placeholders numbered in order of first use.
+    Everything else is kept: keywords, builtins and library calls the code
+    only uses, type names (capitalized), member names after a dot, literals
+    and operators, so e.g. any() and all() or Math.max and Math.min still
+    differ. Python code that does not parse is not renamed at all.
+
+    Args:
+        code: Source code
+        language: "java" or "python"; other languages use the Java lexer
+
+    Returns:
+        The normalized tokens
+    """
+    if language == "python":
+        tokens = _tokenize(code, _PYTHON_TOKENS)
+        bound = _python_bound_names(code) or set()
+    else:
+        tokens = _tokenize(code, _JAVA_TOKENS)
+        bound = _java_bound_names(tokens)
+
+    normalized: List[str] = []
+    names: Dict[str, str] = {}
+    for kind, token in tokens:
+        if kind == "name" and token in bound and not token[0].isupper() and (not normalized or normalized[-1] != "."):
+            token = names.setdefault(token, f"v{len(names)}")
+        normalized.append(token)
+    return normalized
+
+def code_fingerprint(code: str, language: str = "java") -> str:
+    """
+    Hash of the normalized code: equal for submissions that differ only in
+    comments, formatting or consistent renaming of local names
+
+    Args:
+        code: Source code
+        language: "java" or "python"
+
+    Returns:
+        Hex digest
+    """
+    normalized = " ".join([FINGERPRINT_VERSION] + normalize_code(code, language))
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
@@ -0,0 +1,131 @@
+import json
+import re
+import logging
+from typing import Dict, List, Any, Iterator, Optional, Type, TypeVar
+from pydantic import BaseModel, ValidationError
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T", bound=BaseModel)
+
+_CODE_FENCE = re.compile(r"```(?:json|JSON)?\s*(.*?)\s*```", re.DOTALL)
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+_SMART_QUOTES = str.maketrans({"“": '"', "”": '"', "‘": "'", "’": "'"})
+_PYTHON_LITERALS = re.compile(r"(?<![\"\w])(True|False|None)(?![\"\w])")
+
+class StructuredOutputError(ValueError):
+    """Raised when an LLM response cannot be decoded into the expected structure"""
+
+def _balanced_object(text: str, start: int) -> str:
+    """
+    Return the JSON object starting at text[start], closing it if it was truncated
+    """
+    stack: List[str] = []
+    in_string = False
+    escape = False
+
+    for pos in range(start, len(text)):
+        ch = text[pos]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+            continue
+
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            if not stack:
+                return text[start:pos + 1]
+
+    # Truncated response (e.g. max_tokens reached): close what is still open
+    closing = '"' if in_string else ""
+    return text[start:] + closing + "".join(reversed(stack))
+
+def _candidates(text: str) -> Iterator[str]:
+    stripped = text.strip()
+    yield stripped
+
+    fenced = _CODE_FENCE.search(stripped)
+    if fenced:
+        yield fenced.group(1)
+
+    start = stripped.find("{")
+    if start != -1:
+        yield _balanced_object(stripped, start)
+
+def _repair(text: str) -> str:
+    repaired = text.translate(_SMART_QUOTES)
+    repaired = _TRAILING_COMMA.sub(r"\1", repaired)
+    repaired = _PYTHON_LITERALS.sub(
+        lambda match: {"True": "true", "False": "false", "None": "null"}[match.group(1)],
+        repaired
+    )
+    return repaired
+
+def decode_json(text: str) -> Dict[str, Any]:
+    """
+    Decode a JSON object from an LLM response, tolerating common drift:
+    surrounding prose, code fences, trailing commas, smart quotes, Python
+    literals and truncated output.
+
+    Args:
+        text: Raw response text
+
+    Returns:
+        The decoded object
+
+    Raises:
+        StructuredOutputError: If no JSON object could be recovered
+    """
+    # Fast path: well-formed responses (the norm in structured-output mode)
+    try:
+        value = json.loads(text)
+        if isinstance(value, dict):
+            return value
+    except (json.JSONDecodeError, TypeError):
+        pass
+
+    if not isinstance(text, str):
+        raise StructuredOutputError("Response is not text")
+
+    for candidate in _candidates(text):
+        for variant in (candidate, _repair(candidate)):
+            try:
+                value = json.loads(variant)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(value, dict):
+                return value
+
+    raise StructuredOutputError(f"No JSON object found in response: {text[:200]}")
+
+def decode_model(text: str, schema: Type[T], overrides: Optional[Dict[str, Any]] = None) -> T:
+    """
+    Decode an LLM response and validate it against a Pydantic model
+
+    Args:
+        text: Raw response text
+        schema: Pydantic model the response must match
+        overrides: Fields to set regardless of the response content
+
+    Returns:
+        Validated model instance
+
+    Raises:
+        StructuredOutputError: If the response cannot be decoded or does not validate
+    """
+    data = decode_json(text)
+    if overrides:
+        data.update(overrides)
+    try:
+        return schema.model_validate(data)
+    except ValidationError as e:
+        raise StructuredOutputError(f"Response does not match {schema.__name__}: {str(e)}")
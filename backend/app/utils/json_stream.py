@@ -0,0 +1,105 @@
+import json
+import logging
+from typing import Dict, List, Any, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+class IncrementalJSONParser:
+    """
+    Incremental parser for a single JSON object arriving in chunks.
+
+    Text before the first '{' (such as a ```json fence) is skipped. Each
+    top-level field is decoded as soon as its value is complete, so callers
+    can act on early fields before the rest of the object has arrived.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.fields: Dict[str, Any] = {}
+        self.complete = False
+        self._pos = 0
+        self._started = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._key: Optional[str] = None
+        self._value_start: Optional[int] = None
+
+    def feed(self, chunk: str) -> List[str]:
+        """
+        Consume the next chunk of text
+
+        Args:
+            chunk: Newly received text
+
+        Returns:
+            Names of the top-level fields completed by this chunk
+        """
+        self.buffer += chunk
+        completed = []
+
+        while self._pos < len(self.buffer) and not self.complete:
+            ch = self.buffer[self._pos]
+
+            if not self._started:
+                if ch == "{":
+                    self._started = True
+                    self._depth = 1
+                self._pos += 1
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._value_start is None:
+                        self._key = self._decode(self.buffer[self._string_start:self._pos + 1])
+                self._pos += 1
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._string_start = self._pos
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._finish_field(completed)
+                    self.complete = True
+            elif ch == ":" and self._depth == 1:
+                self._value_start = self._pos + 1
+            elif ch == "," and self._depth == 1:
+                self._finish_field(completed)
+
+            self._pos += 1
+
+        return completed
+
+    def _finish_field(self, completed: List[str]) -> None:
+        if self._key is not None and self._value_start is not None:
+            raw_value = self.buffer[self._value_start:self._pos].strip()
+            value = self._decode(raw_value)
+            if value is not None or raw_value == "null":
+                self.fields[self._key] = value
+                completed.append(self._key)
+        self._key = None
+        self._value_start = None
+
+    @staticmethod
+    def _decode(text: str) -> Any:
+        try:
+            return json.loads(text)
+        except (json.JSONDecodeError, ValueError):
+            logger.debug(f"Could not decode streamed JSON value: {text[:100]}")
+            return None
+
+    def has_fields(self, names: Iterable[str]) -> bool:
+        """
+        Check whether all of the given top-level fields have been decoded
+        """
+        return all(name in self.fields for name in names)
@@ -0,0 +1,188 @@
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Any, Optional, Iterator
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+class StageBudget:
+    """
+    Output budget for one LLM call site
+
+    Attributes:
+        max_tokens: Output tokens requested for the call
+        per_item_tokens: Extra output tokens per item (e.g. rubric point) in the response
+        max_words: Length bound given to the model for free-text fields
+    """
+
+    def __init__(self, max_tokens: int, per_item_tokens: int = 0, max_words: Optional[int] = None):
+        self.max_tokens = max_tokens
+        self.per_item_tokens = per_item_tokens
+        self.max_words = max_words
+
+    def tokens_for(self, items: int = 0) -> int:
+        """
+        Output tokens to request for a response with the given number of items
+        """
+        return self.max_tokens + self.per_item_tokens * items
+
+def _budget(stage: str, max_tokens: int, per_item_tokens: int = 0, max_words: Optional[int] = None) -> StageBudget:
+    prefix = f"LLM_BUDGET_{stage.upper()}"
+    return StageBudget(
+        max_tokens=int(os.getenv(prefix, str(max_tokens))),
+        per_item_tokens=int(os.getenv(f"{prefix}_PER_ITEM", str(per_item_tokens))),
+        max_words=int(os.getenv(f"{prefix}_WORDS", str(max_words))) if max_words is not None else None
+    )
+
+# Output budgets for every stage of an evaluation, overridable with
+# LLM_BUDGET_<STAGE>, LLM_BUDGET_<STAGE>_PER_ITEM and LLM_BUDGET_<STAGE>_WORDS
+STAGE_BUDGETS: Dict[str, StageBudget] = {
+    # One fixed phrase
+    "detection": _budget("detection", 16),
+    # A confidence score, one sentence and a few short indicators
+    "approach_match": _budget("approach_match", 120, max_words=30),
+    # Several students' solutions matched against one approach in one call
+    "approach_match_batch": _budget("approach_match_batch", 40, per_item_tokens=110, max_words=30),
+    "approach_explanation": _budget("approach_explanation", 700, max_words=150),
+    "guidance": _budget("guidance", 1200, max_words=120),
+    # Approach and totals plus one bounded justification per rubric point;
+    # narrative feedback is generated on demand by the feedback_summary stage
+    "evaluation": _budget("evaluation", 120, per_item_tokens=80, max_words=40),
+    # Evaluation plus the approach classification, in one call
+    "fused_evaluation": _budget("fused_evaluation", 180, per_item_tokens=80, max_words=40),
+    "criterion": _budget("criterion", 120, max_words=40),
+    # Several criteria packed into one call, one bounded justification each
+    "criteria": _budget("criteria", 40, per_item_tokens=100, max_words=40),
+    "feedback_summary": _budget("feedback_summary", 250),
+    # Repairs rewrite a response of any stage
+    "repair": _budget("repair", 2000)
+}
+
+def stage_budget(stage: str) -> StageBudget:
+    """
+    Get the output budget configured for a stage
+
+    Args:
+        stage: Stage name, one of STAGE_BUDGETS
+
+    Returns:
+        The stage's budget
+    """
+    return STAGE_BUDGETS[stage]
+
+class TokenUsageStats:
+    """Requested vs used output tokens and estimated vs billed prompt tokens per stage"""
+
+    def __init__(self):
+        self._stages: Dict[str, Dict[str, int]] = {}
+
+    def record(
+        self,
+        stage: str,
+        requested: int,
+        used: Optional[int],
+        estimated_prompt: Optional[int] = None,
+        billed_prompt: Optional[int] = None
+    ) -> None:
+        if used is None:
+            return
+        stats = self._stages.setdefault(
+            stage or "unlabelled",
+            {
+                "calls": 0,
+                "requested_tokens": 0,
+                "used_tokens": 0,
+                "truncated": 0,
+                "estimated_prompt_tokens": 0,
+                "billed_prompt_tokens": 0
+            }
+        )
+        stats["calls"] += 1
+        stats["requested_tokens"] += requested
+        stats["used_tokens"] += used
+        if used >= requested:
+            stats["truncated"] += 1
+        if estimated_prompt is not None and billed_prompt is not None:
+            stats["estimated_prompt_tokens"] += estimated_prompt
+            stats["billed_prompt_tokens"] += billed_prompt
+
+    def get_metrics(self) -> Dict[str, Any]:
+        metrics = {}
+        for stage, stats in self._stages.items():
+            metrics[stage] = {
+                **stats,
+                "avg_used_tokens": stats["used_tokens"] / stats["calls"],
+                "utilization": stats["used_tokens"] / stats["requested_tokens"] if stats["requested_tokens"] else 0.0,
+                "prompt_estimate_ratio": (
+                    stats["estimated_prompt_tokens"] / stats["billed_prompt_tokens"]
+                    if stats["billed_prompt_tokens"] else 0.0
+                )
+            }
+        return metrics
+
+llm_token_usage = TokenUsageStats()
+
+# Label that prompt cache hits of the calls in scope are also counted under
+_cache_attribution: ContextVar[Optional[str]] = ContextVar("llm_cache_attribution", default=None)
+
+@contextmanager
+def cache_attribution_scope(label: str) -> Iterator[None]:
+    """
+    Also count provider prompt cache hits of every LLM call made inside the
+    block under the given label, to compare hit rates between kinds of work
+    """
+    token = _cache_attribution.set(label)
+    try:
+        yield
+    finally:
+        _cache_attribution.reset(token)
+
+class PromptCacheStats:
+    """Provider prompt cache hits per prompt group (problem) and per attribution label"""
+
+    def __init__(self):
+        self._groups: Dict[str, Dict[str, int]] = {}
+        self._attributions: Dict[str, Dict[str, int]] = {}
+
+    def _add(self, table: Dict[str, Dict[str, int]], key: str, prompt_tokens: int, cached_tokens: Optional[int]) -> None:
+        stats = table.setdefault(
+            key,
+            {"requests": 0, "cache_hits": 0, "prompt_tokens": 0, "cached_tokens": 0}
+        )
+        stats["requests"] += 1
+        stats["prompt_tokens"] += prompt_tokens
+        if cached_tokens:
+            stats["cache_hits"] += 1
+            stats["cached_tokens"] += cached_tokens
+
+    def record(self, group: str, prompt_tokens: Optional[int], cached_tokens: Optional[int]) -> None:
+        if prompt_tokens is None:
+            return
+        self._add(self._groups, group or "ungrouped", prompt_tokens, cached_tokens)
+        label = _cache_attribution.get()
+        if label is not None:
+            self._add(self._attributions, label, prompt_tokens, cached_tokens)
+
+    @staticmethod
+    def _rates(table: Dict[str, Dict[str, int]]) -> Dict[str, Any]:
+        return {
+            key: {
+                **stats,
+                "hit_rate": stats["cache_hits"] / stats["requests"],
+                "cached_token_ratio": stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0
+            }
+            for key, stats in table.items()
+        }
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return self._rates(self._groups)
+
+    def get_attribution_metrics(self) -> Dict[str, Any]:
+        """
+        Cache hits per attribution label, see cache_attribution_scope
+        """
+        return self._rates(self._attributions)
+
+llm_prompt_cache = PromptCacheStats()
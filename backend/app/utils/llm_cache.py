@@ -0,0 +1,243 @@
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class LLMResponseCache:
+    """
+    Content-addressed cache for LLM responses with two tiers: a bounded
+    in-memory LRU and an optional SQLite file that survives restarts.
+    Entries are keyed on everything that determines the completion
+    (model, sampling parameters, prompt hash and prompt-template version).
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 2048,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl: float = 7 * 24 * 3600,
+        db_path: Optional[str] = None
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.db_path = db_path
+        self._memory: "OrderedDict[str, Tuple[str, float, str]]" = OrderedDict()
+        self._memory_bytes = 0
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+
+        # Metrics
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.evictions = 0
+        self.bytes_served = 0
+
+    @staticmethod
+    def make_key(
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        prompt: str,
+        template_version: str = "",
+        response_format: Optional[Dict[str, Any]] = None
+    ) -> str:
+        """
+        Build the content-addressed cache key for a request
+
+        Args:
+            model: The model the request is sent to
+            temperature: Temperature parameter for generation
+            max_tokens: Maximum tokens to generate
+            prompt: The full prompt text
+            template_version: Version of the prompt template that produced the prompt
+            response_format: Provider response format requested with the prompt
+
+        Returns:
+            Hex digest identifying the request
+        """
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        material = json.dumps(
+            [model, round(temperature, 4), max_tokens, template_version, prompt_hash, response_format],
+            separators=(",", ":")
+        )
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        if not self.db_path:
+            return None
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    template_version TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+                """
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_llm_cache_version ON llm_cache (template_version)"
+            )
+            self._db.commit()
+        return self._db
+
+    def _disk_get(self, key: str) -> Optional[Tuple[str, float, str]]:
+        with self._db_lock:
+            db = self._connect()
+            if db is None:
+                return None
+            row = db.execute(
+                "SELECT value, expires_at, template_version FROM llm_cache WHERE key = ?",
+                (key,)
+            ).fetchone()
+            if row and row[1] < time.time():
+                db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                db.commit()
+                return None
+            return row
+
+    def _disk_set(self, key: str, value: str, expires_at: float, template_version: str) -> None:
+        with self._db_lock:
+            db = self._connect()
+            if db is None:
+                return
+            db.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, template_version, expires_at) VALUES (?, ?, ?, ?)",
+                (key, value, template_version, expires_at)
+            )
+            db.commit()
+
+    def _disk_delete(self, key: Optional[str], template_version: Optional[str]) -> None:
+        with self._db_lock:
+            db = self._connect()
+            if db is None:
+                return
+            if key is not None:
+                db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            elif template_version is not None:
+                db.execute("DELETE FROM llm_cache WHERE template_version = ?", (template_version,))
+            else:
+                db.execute("DELETE FROM llm_cache")
+            db.commit()
+
+    def _memory_put(self, key: str, value: str, expires_at: float, template_version: str) -> None:
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+
+        self._memory_pop(key)
+        self._memory[key] = (value, expires_at, template_version)
+        self._memory_bytes += size
+
+        while len(self._memory) > self.max_entries or self._memory_bytes > self.max_bytes:
+            oldest = next(iter(self._memory))
+            self._memory_pop(oldest)
+            self.evictions += 1
+
+    def _memory_pop(self, key: str) -> None:
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self._memory_bytes -= len(entry[0].encode("utf-8"))
+
+    async def get(self, key: str) -> Optional[str]:
+        """
+        Look up a cached response, checking memory first and then disk
+
+        Args:
+            key: Cache key from make_key
+
+        Returns:
+            The cached response text or None on a miss
+        """
+        entry = self._memory.get(key)
+        if entry is not None:
+            if entry[1] >= time.time():
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                self.bytes_served += len(entry[0].encode("utf-8"))
+                return entry[0]
+            self._memory_pop(key)
+
+        if self.db_path:
+            try:
+                row = await asyncio.to_thread(self._disk_get, key)
+            except Exception as e:
+                logger.error(f"Error reading LLM cache: {str(e)}")
+                row = None
+            if row is not None:
+                value, expires_at, template_version = row
+                self._memory_put(key, value, expires_at, template_version)
+                self.disk_hits += 1
+                self.bytes_served += len(value.encode("utf-8"))
+                return value
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: str, template_version: str = "") -> None:
+        """
+        Store a response in both tiers
+
+        Args:
+            key: Cache key from make_key
+            value: Response text
+            template_version: Version of the prompt template, used for invalidation
+        """
+        expires_at = time.time() + self.ttl
+        self._memory_put(key, value, expires_at, template_version)
+        self.sets += 1
+
+        if self.db_path:
+            try:
+                await asyncio.to_thread(self._disk_set, key, value, expires_at, template_version)
+            except Exception as e:
+                logger.error(f"Error writing LLM cache: {str(e)}")
+
+    async def invalidate(self, key: Optional[str] = None, template_version: Optional[str] = None) -> None:
+        """
+        Remove cached responses
+
+        Args:
+            key: Remove only this entry
+            template_version: Remove every entry produced by this template version
+
+        With neither argument the whole cache is cleared.
+        """
+        if key is not None:
+            self._memory_pop(key)
+        elif template_version is not None:
+            for cached_key in [k for k, v in self._memory.items() if v[2] == template_version]:
+                self._memory_pop(cached_key)
+        else:
+            self._memory.clear()
+            self._memory_bytes = 0
+
+        if self.db_path:
+            await asyncio.to_thread(self._disk_delete, key, template_version)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "sets": self.sets,
+            "evictions": self.evictions,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "bytes_served": self.bytes_served
+        }
@@ -0,0 +1,84 @@
+import logging
+from collections import deque
+from typing import Dict, Any, Deque, Optional
+
+logger = logging.getLogger(__name__)
+
+class LatencyTracker:
+    """
+    Sliding window of recent successful request latencies per model,
+    used to decide when a request is slow enough to hedge.
+    """
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def record(self, model: str, latency: float) -> None:
+        if model not in self._samples:
+            self._samples[model] = deque(maxlen=self.window)
+        self._samples[model].append(latency)
+
+    def percentile(self, model: str, percentile: float) -> Optional[float]:
+        """
+        Get a latency percentile for the model
+
+        Args:
+            model: The model name
+            percentile: Percentile between 0 and 100
+
+        Returns:
+            Latency in seconds, or None until enough samples have been recorded
+        """
+        samples = self._samples.get(model)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return ordered[index]
+
+    def tail_mean(self, model: str, threshold: float) -> Optional[float]:
+        """
+        Mean latency of recent requests slower than the threshold
+        """
+        samples = [s for s in self._samples.get(model, ()) if s > threshold]
+        if not samples:
+            return None
+        return sum(samples) / len(samples)
+
+class HedgeStats:
+    """Counters for hedged requests"""
+
+    def __init__(self):
+        self.requests = 0
+        self.hedges = 0
+        self.skipped = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+        self.estimated_latency_saved = 0.0
+
+    def record_backup_win(self, elapsed: float, expected_primary_latency: Optional[float]) -> None:
+        """
+        Record a hedge won by the backup request
+
+        Args:
+            elapsed: Time from the primary's admission until the backup answered
+            expected_primary_latency: Mean recent latency of primary requests that were
+                slow enough to be hedged, used to estimate how long the primary would have taken
+        """
+        self.hedge_wins += 1
+        if expected_primary_latency is not None:
+            self.estimated_latency_saved += max(0.0, expected_primary_latency - elapsed)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_rate": self.hedges / self.requests if self.requests else 0.0,
+            # Slow requests not hedged because the primary was not in flight or the backup had no capacity
+            "hedges_skipped": self.skipped,
+            "backup_wins": self.hedge_wins,
+            "primary_wins_after_hedge": self.primary_wins,
+            "estimated_latency_saved": self.estimated_latency_saved
+        }
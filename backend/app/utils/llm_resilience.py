@@ -0,0 +1,245 @@
+import enum
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Statuses worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUSES = {408, 409, 425, 429}
+
+class LLMAPIError(Exception):
+    """
+    Error from an LLM request, classified for the retry policy
+
+    Attributes:
+        status: HTTP status, None for network errors and timeouts
+        retryable: Whether repeating the same request may succeed
+        fallback: Whether the request may succeed on another model
+        retry_after: Delay requested by the provider in seconds
+    """
+
+    def __init__(
+        self,
+        message: str,
+        status: Optional[int] = None,
+        retryable: bool = True,
+        fallback: bool = True,
+        retry_after: Optional[float] = None
+    ):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+        self.fallback = fallback
+        self.retry_after = retry_after
+
+    @classmethod
+    def from_response(cls, status: int, message: str, retry_after: Optional[float] = None) -> "LLMAPIError":
+        """
+        Build an error from an HTTP response status
+
+        400/401/403/422 are the caller's fault and fail fast everywhere, 404
+        (unknown model) fails fast but may succeed on the backup model, and
+        408/409/425/429/5xx are retried.
+        """
+        retryable = status in RETRYABLE_STATUSES or status >= 500
+        return cls(
+            f"LLM API error {status}: {message}",
+            status=status,
+            retryable=retryable,
+            fallback=retryable or status == 404,
+            retry_after=retry_after
+        )
+
+    @property
+    def counts_against_circuit(self) -> bool:
+        # Client errors say nothing about the health of the endpoint
+        return self.retryable
+
+class CircuitOpenError(LLMAPIError):
+    """Raised without sending a request while a model's circuit is open"""
+
+    def __init__(self, model: str, retry_after: float):
+        super().__init__(
+            f"Circuit open for model {model}",
+            retryable=False,
+            fallback=True,
+            retry_after=retry_after
+        )
+        self.model = model
+
+class DeadlineExceededError(LLMAPIError):
+    """Raised when a call runs out of its total time budget"""
+
+    def __init__(self):
+        super().__init__("LLM call deadline exceeded", retryable=False, fallback=False)
+
+def parse_retry_after(headers: Any) -> Optional[float]:
+    """
+    Read the provider's requested retry delay from response headers
+
+    Args:
+        headers: Response headers mapping
+
+    Returns:
+        Delay in seconds, or None if no usable header was sent
+    """
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return max(0.0, float(retry_after_ms) / 1000)
+        except ValueError:
+            pass
+
+    retry_after = headers.get("Retry-After")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class Deadline:
+    """Total time budget for one logical LLM call across retries and fallbacks"""
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+class RetryPolicy:
+    """Exponential backoff with full jitter that honours Retry-After"""
+
+    def __init__(self, base_delay: float = 1.0, max_delay: float = 30.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        Delay before the next attempt
+
+        Args:
+            attempt: Zero-based index of the attempt that just failed
+            retry_after: Delay requested by the provider, if any
+
+        Returns:
+            Delay in seconds
+        """
+        if retry_after is not None:
+            # Never retry before the provider asked us to, spread retries after it
+            return retry_after + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+class CircuitState(enum.Enum):
+    closed = "closed"
+    open = "open"
+    half_open = "half_open"
+
+class CircuitPermit:
+    """Permission to send one request, handed back with its outcome"""
+
+    def __init__(self, probe: bool = False):
+        self.probe = probe
+
+class CircuitBreaker:
+    """
+    Per-endpoint circuit breaker. Opens after consecutive failures, lets a
+    single probe through after the recovery timeout, and closes again when
+    the probe succeeds. Any success or failure is evidence of the endpoint's
+    health, but a neutral outcome only ends the probe when it is reported
+    with the probe's own permit.
+    """
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = CircuitState.closed
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe: Optional[CircuitPermit] = None
+
+        # Metrics
+        self.times_opened = 0
+        self.rejected = 0
+
+    def allow_request(self) -> Optional[CircuitPermit]:
+        """
+        Ask to send a request
+
+        Returns:
+            The permit to report the request's outcome with, or None if the
+            request must not be sent
+        """
+        if self.state == CircuitState.closed:
+            return CircuitPermit()
+
+        if self.state == CircuitState.open:
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                self.rejected += 1
+                return None
+            self.state = CircuitState.half_open
+            self._probe = None
+
+        # Half-open: only one probe at a time
+        if self._probe is not None:
+            self.rejected += 1
+            return None
+        self._probe = CircuitPermit(probe=True)
+        return self._probe
+
+    def retry_in(self) -> float:
+        return max(0.0, self.recovery_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        self._probe = None
+        self.state = CircuitState.closed
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        self._probe = None
+        if self.state == CircuitState.half_open or self.consecutive_failures >= self.failure_threshold:
+            if self.state != CircuitState.open:
+                self.times_opened += 1
+            self.state = CircuitState.open
+            self.opened_at = time.monotonic()
+
+    def record_neutral(self, permit: Optional[CircuitPermit]) -> None:
+        # A probe that failed for reasons unrelated to endpoint health ends without a verdict;
+        # other requests, e.g. ones sent before the circuit opened, leave the probe running
+        if permit is not None and permit is self._probe:
+            self._probe = None
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "state": self.state.value,
+            "consecutive_failures": self.consecutive_failures,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected
+        }
+
+class CircuitBreakerRegistry:
+    """One circuit breaker per model endpoint"""
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, model: str) -> CircuitBreaker:
+        if model not in self._breakers:
+            self._breakers[model] = CircuitBreaker(self.failure_threshold, self.recovery_timeout)
+        return self._breakers[model]
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {model: breaker.get_metrics() for model, breaker in self._breakers.items()}
@@ -0,0 +1,354 @@
+import asyncio
+import enum
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Any, Optional, AsyncIterator, Iterator
+
+logger = logging.getLogger(__name__)
+
+class Priority(enum.IntEnum):
+    """Priority classes for LLM calls, lower values are served first"""
+    interactive = 0
+    regrade = 1
+    background = 2
+
+# Priority of LLM calls made without an explicit one, e.g. every call of a regrade
+_default_priority: ContextVar[Priority] = ContextVar("llm_default_priority", default=Priority.interactive)
+
+def current_priority() -> Priority:
+    """Priority applied to LLM calls that do not specify one"""
+    return _default_priority.get()
+
+@contextmanager
+def priority_scope(priority: Priority) -> Iterator[None]:
+    """
+    Run every LLM call made inside the block (including from tasks it starts)
+    at the given priority unless the call specifies its own
+    """
+    token = _default_priority.set(priority)
+    try:
+        yield
+    finally:
+        _default_priority.reset(token)
+
+class ModelBudget:
+    """Rate and concurrency budget for a single model"""
+
+    def __init__(
+        self,
+        requests_per_minute: int,
+        tokens_per_minute: int,
+        min_concurrency: int = 1,
+        max_concurrency: int = 64,
+        initial_concurrency: int = 8,
+        target_latency: float = 20.0
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.initial_concurrency = initial_concurrency
+        self.target_latency = target_latency
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at a per-minute rate
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _clip(self, amount: float) -> float:
+        # A single request larger than the whole budget must still be admissible
+        return min(amount, self.capacity)
+
+    def time_until(self, amount: float) -> float:
+        """
+        Seconds until the bucket holds the given amount
+        """
+        self._refill()
+        missing = self._clip(amount) - self.tokens
+        if missing <= 0:
+            return 0.0
+        return missing / self.rate if self.rate > 0 else float("inf")
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= self._clip(amount)
+
+    def refund(self, amount: float) -> None:
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+class _Waiter:
+    def __init__(self, tokens: int, priority: Priority):
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.tokens = tokens
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+
+class SchedulerSlot:
+    """
+    Handle for one admitted LLM request. Callers fill in the outcome so the
+    limiter can adapt its concurrency window and settle the token budget.
+    """
+
+    def __init__(self, model: str, reserved_tokens: int, wait_time: float):
+        self.model = model
+        self.reserved_tokens = reserved_tokens
+        self.wait_time = wait_time
+        self.status: Optional[int] = None
+        self.total_tokens: Optional[int] = None
+
+class ModelLimiter:
+    """
+    Admission control for a single model: requests-per-minute and
+    tokens-per-minute buckets, a priority queue of waiters and an adaptive
+    concurrency window (additive increase, multiplicative decrease on 429s).
+    """
+
+    def __init__(self, model: str, budget: ModelBudget):
+        self.model = model
+        self.budget = budget
+        self.request_bucket = TokenBucket(budget.requests_per_minute)
+        self.token_bucket = TokenBucket(budget.tokens_per_minute)
+        self.window = budget.initial_concurrency
+        self.in_flight = 0
+        self._waiters: List[Any] = []
+        self._sequence = itertools.count()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+        self._successes_since_increase = 0
+        self._last_decrease = 0.0
+
+        # Metrics
+        self.admitted = 0
+        self.rate_limited = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.wait_time_by_priority: Dict[str, float] = {p.name: 0.0 for p in Priority}
+        self.admitted_by_priority: Dict[str, int] = {p.name: 0 for p in Priority}
+
+    async def acquire(self, tokens: int, priority: Priority) -> float:
+        """
+        Wait until the request may be sent
+
+        Args:
+            tokens: Estimated prompt plus completion tokens for the request
+            priority: Priority class of the request
+
+        Returns:
+            Time spent waiting in seconds
+        """
+        waiter = _Waiter(tokens, priority)
+        heapq.heappush(self._waiters, (int(priority), next(self._sequence), waiter))
+        self._dispatch()
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            # The slot may have been granted just before cancellation
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release(waiter.tokens, None, 0.0, None)
+            raise
+
+        wait_time = time.monotonic() - waiter.enqueued_at
+        self.admitted += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        self.wait_time_by_priority[priority.name] += wait_time
+        self.admitted_by_priority[priority.name] += 1
+        return wait_time
+
+    def release(
+        self,
+        reserved_tokens: int,
+        status: Optional[int],
+        latency: float,
+        total_tokens: Optional[int]
+    ) -> None:
+        """
+        Return a slot and feed the outcome into the concurrency window
+
+        Args:
+            reserved_tokens: Tokens reserved at admission
+            status: HTTP status of the response, None if no response was received
+            latency: Request latency in seconds
+            total_tokens: Tokens actually billed, if reported by the provider
+        """
+        self.in_flight = max(0, self.in_flight - 1)
+
+        if total_tokens is not None and total_tokens < reserved_tokens:
+            self.token_bucket.refund(reserved_tokens - total_tokens)
+
+        if status == 429:
+            self.rate_limited += 1
+            self._decrease_window()
+        elif status == 200:
+            if latency > self.budget.target_latency * 2:
+                self._decrease_window()
+            elif latency <= self.budget.target_latency:
+                self._successes_since_increase += 1
+                if self._successes_since_increase >= self.window:
+                    self.window = min(self.budget.max_concurrency, self.window + 1)
+                    self._successes_since_increase = 0
+
+        self._dispatch()
+
+    def _decrease_window(self) -> None:
+        # A burst of 429s from the same overload should only halve the window once
+        now = time.monotonic()
+        if now - self._last_decrease < 1.0:
+            return
+        self._last_decrease = now
+        self._successes_since_increase = 0
+        self.window = max(self.budget.min_concurrency, self.window // 2)
+        logger.warning(f"Reduced concurrency window for {self.model} to {self.window}")
+
+    def _dispatch(self) -> None:
+        while self._waiters and self.in_flight < self.window:
+            _, _, waiter = self._waiters[0]
+            if waiter.future.done():
+                heapq.heappop(self._waiters)
+                continue
+
+            delay = max(
+                self.request_bucket.time_until(1),
+                self.token_bucket.time_until(waiter.tokens)
+            )
+            if delay > 0:
+                self._schedule_wakeup(delay)
+                return
+
+            heapq.heappop(self._waiters)
+            self.request_bucket.consume(1)
+            self.token_bucket.consume(waiter.tokens)
+            self.in_flight += 1
+            waiter.future.set_result(None)
+
+    def _schedule_wakeup(self, delay: float) -> None:
+        if self._wakeup is not None and not self._wakeup.cancelled():
+            return
+
+        def wakeup():
+            self._wakeup = None
+            self._dispatch()
+
+        self._wakeup = asyncio.get_running_loop().call_later(delay, wakeup)
+
+    def has_capacity(self, tokens: int) -> bool:
+        """
+        Whether a request would be admitted right away, without queueing
+        """
+        return (
+            sum(self.queue_depth().values()) == 0
+            and self.in_flight < self.window
+            and self.request_bucket.time_until(1) == 0
+            and self.token_bucket.time_until(tokens) == 0
+        )
+
+    def queue_depth(self) -> Dict[str, int]:
+        depth = {p.name: 0 for p in Priority}
+        for priority, _, waiter in self._waiters:
+            if not waiter.future.done():
+                depth[Priority(priority).name] += 1
+        return depth
+
+    def get_metrics(self) -> Dict[str, Any]:
+        depth = self.queue_depth()
+        return {
+            "queue_depth": sum(depth.values()),
+            "queue_depth_by_priority": depth,
+            "in_flight": self.in_flight,
+            "concurrency_window": self.window,
+            "admitted": self.admitted,
+            "rate_limited": self.rate_limited,
+            "avg_wait_time": self.total_wait_time / self.admitted if self.admitted else 0.0,
+            "max_wait_time": self.max_wait_time,
+            "avg_wait_time_by_priority": {
+                name: self.wait_time_by_priority[name] / count if count else 0.0
+                for name, count in self.admitted_by_priority.items()
+            },
+            "available_requests": int(self.request_bucket.tokens),
+            "available_tokens": int(self.token_bucket.tokens)
+        }
+
+class LLMScheduler:
+    """
+    Central scheduler placed in front of every LLM request. Keeps one
+    ModelLimiter per model so budgets are enforced per model.
+    """
+
+    def __init__(self, budgets: Dict[str, ModelBudget], default_budget: ModelBudget):
+        self.budgets = budgets
+        self.default_budget = default_budget
+        self._limiters: Dict[str, ModelLimiter] = {}
+
+    def limiter(self, model: str) -> ModelLimiter:
+        if model not in self._limiters:
+            budget = self.budgets.get(model, self.default_budget)
+            self._limiters[model] = ModelLimiter(model, budget)
+        return self._limiters[model]
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        model: str,
+        estimated_tokens: int,
+        priority: Optional[Priority] = None
+    ) -> AsyncIterator[SchedulerSlot]:
+        """
+        Reserve capacity for one request to the given model
+
+        Args:
+            model: The model the request is sent to
+            estimated_tokens: Estimated prompt plus completion tokens
+            priority: Priority class of the request, defaults to the current priority scope
+
+        Yields:
+            SchedulerSlot that the caller updates with the response status and usage
+        """
+        if priority is None:
+            priority = current_priority()
+        limiter = self.limiter(model)
+        wait_time = await limiter.acquire(estimated_tokens, priority)
+        slot = SchedulerSlot(model, estimated_tokens, wait_time)
+        started = time.monotonic()
+        try:
+            yield slot
+        finally:
+            limiter.release(
+                estimated_tokens,
+                slot.status,
+                time.monotonic() - started,
+                slot.total_tokens
+            )
+
+    def has_capacity(self, model: str, estimated_tokens: int) -> bool:
+        """
+        Whether a request to the model would be admitted without waiting
+        """
+        return self.limiter(model).has_capacity(estimated_tokens)
+
+    def is_idle(self) -> bool:
+        """
+        Whether no request of any model is waiting for admission
+        """
+        return all(sum(limiter.queue_depth().values()) == 0 for limiter in self._limiters.values())
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """
+        Get queue depth, wait time and window metrics for every model
+        """
+        return {model: limiter.get_metrics() for model, limiter in self._limiters.items()}
@@ -0,0 +1,238 @@
+import os
+import logging
+import time
+from typing import Dict, Any, Optional, Callable, Iterable, AsyncIterator, Tuple, Type, Union
+from pydantic import BaseModel, ValidationError
+from dotenv import load_dotenv
+
+from app.utils.llm_utils import (
+    DEFAULT_MODEL,
+    TEMPERATURE,
+    MAX_TOKENS,
+    query_llm,
+    structured_response_format,
+    repair_structured_output,
+    structured_output_stats
+)
+from app.utils.llm_scheduler import Priority
+from app.utils.json_stream import IncrementalJSONParser
+from app.utils.json_decoder import StructuredOutputError
+from app.utils.prompt_builder import PromptParts
+
+# Load environment variables
+load_dotenv()
+
+LLM_STREAMING_ENABLED = os.getenv("LLM_STREAMING_ENABLED", "true").lower() == "true"
+
+logger = logging.getLogger(__name__)
+
+class StreamingStats:
+    """Latency metrics for streamed LLM calls"""
+
+    def __init__(self):
+        self.streams = 0
+        self.early_cutoffs = 0
+        self._first_token_total = 0.0
+        self._first_token_count = 0
+        self._first_field_total = 0.0
+        self._first_field_count = 0
+        self._useful_total = 0.0
+        self._useful_count = 0
+        self._total_time = 0.0
+
+    def record(
+        self,
+        total_time: float,
+        first_token: Optional[float],
+        first_field: Optional[float],
+        useful: Optional[float],
+        cut_off: bool
+    ) -> None:
+        self.streams += 1
+        self._total_time += total_time
+        if cut_off:
+            self.early_cutoffs += 1
+        if first_token is not None:
+            self._first_token_total += first_token
+            self._first_token_count += 1
+        if first_field is not None:
+            self._first_field_total += first_field
+            self._first_field_count += 1
+        if useful is not None:
+            self._useful_total += useful
+            self._useful_count += 1
+
+    def get_metrics(self) -> Dict[str, Any]:
+        def average(total: float, count: int) -> float:
+            return total / count if count else 0.0
+
+        return {
+            "streams": self.streams,
+            "early_cutoffs": self.early_cutoffs,
+            "avg_total_time": average(self._total_time, self.streams),
+            "avg_time_to_first_token": average(self._first_token_total, self._first_token_count),
+            "avg_time_to_first_field": average(self._first_field_total, self._first_field_count),
+            "avg_time_to_useful_response": average(self._useful_total, self._useful_count)
+        }
+
+streaming_stats = StreamingStats()
+
+async def query_llm_until(
+    prompt: Union[str, PromptParts],
+    is_complete: Callable[[str], bool],
+    model: str = DEFAULT_MODEL,
+    temperature: float = TEMPERATURE,
+    max_tokens: int = MAX_TOKENS,
+    priority: Optional[Priority] = None,
+    cache: bool = False,
+    template_version: str = "",
+    stage: str = "",
+    coalesce_key: Optional[str] = None
+) -> str:
+    """
+    Stream a completion and stop reading as soon as the caller has enough
+
+    The call goes through query_llm, so it is retried, hedged and bounded by
+    the call deadline like any other; only a response read to the end is cached.
+
+    Args:
+        prompt: The prompt to send to the LLM, optionally split into prefix and suffix
+        is_complete: Predicate on the accumulated text; reading stops once it returns True
+        model: The model to use
+        temperature: Temperature parameter for generation
+        max_tokens: Maximum tokens to generate
+        priority: Scheduling priority class of the request
+        cache: Whether the response may be served from and stored in the response cache
+        template_version: Version of the prompt template, part of the cache key
+        stage: Evaluation stage the call belongs to, used for token usage reporting
+        coalesce_key: Names the predicate, so identical concurrent calls with the
+            same predicate share one stream; calls without one are not coalesced
+
+    Returns:
+        The text received until the predicate was satisfied or the stream ended
+    """
+    async def read(deltas: AsyncIterator[str]) -> Tuple[str, bool]:
+        text = ""
+        started = time.monotonic()
+        first_token = None
+        useful = None
+        cut_off = False
+        async for delta in deltas:
+            if first_token is None:
+                first_token = time.monotonic() - started
+            text += delta
+            if is_complete(text):
+                useful = time.monotonic() - started
+                cut_off = True
+                break
+
+        total_time = time.monotonic() - started
+        streaming_stats.record(total_time, first_token, None, useful or total_time, cut_off)
+        return text, not cut_off
+
+    return await query_llm(
+        prompt, model=model, temperature=temperature, max_tokens=max_tokens,
+        priority=priority, cache=cache, template_version=template_version, stage=stage,
+        stream_reader=read if LLM_STREAMING_ENABLED else None,
+        stream_key=f"until:{coalesce_key}" if coalesce_key is not None else None
+    )
+
+async def query_llm_fields(
+    prompt: Union[str, PromptParts],
+    required_fields: Iterable[str],
+    model: str = DEFAULT_MODEL,
+    temperature: float = TEMPERATURE,
+    max_tokens: int = MAX_TOKENS,
+    priority: Optional[Priority] = None,
+    cache: bool = False,
+    template_version: str = "",
+    schema: Optional[Type[BaseModel]] = None,
+    overrides: Optional[Dict[str, Any]] = None,
+    stage: str = "",
+    coalesce: bool = True
+) -> Dict[str, Any]:
+    """
+    Stream a JSON completion and return as soon as the required fields are decoded
+
+    The call goes through query_llm, so it is retried, hedged, coalesced and
+    bounded by the call deadline like any other; only a response read to the
+    end is cached. With a schema, the provider is asked for output matching
+    it, and the fields are validated against it; a response that is missing
+    required fields or does not validate gets a single repair call.
+
+    Args:
+        prompt: The prompt to send to the LLM, optionally split into prefix and suffix;
+            it should ask for a single JSON object
+        required_fields: Top-level fields the caller needs
+        model: The model to use
+        temperature: Temperature parameter for generation
+        max_tokens: Maximum tokens to generate
+        priority: Scheduling priority class of the request
+        cache: Whether the response may be served from and stored in the response cache
+        template_version: Version of the prompt template, part of the cache key
+        schema: Optional Pydantic model the response must match
+        overrides: Fields to set regardless of the response content (requires schema)
+        stage: Evaluation stage the call belongs to, used for token usage reporting
+        coalesce: Whether identical concurrent requests share a single upstream call
+
+    Returns:
+        Dictionary of the top-level fields decoded so far
+
+    Raises:
+        StructuredOutputError: If a schema was given and the response could not be repaired
+    """
+    required = list(required_fields)
+    response_format = structured_response_format(schema) if schema is not None else None
+
+    def finish(fields: Dict[str, Any], raw: str) -> Dict[str, Any]:
+        if schema is None:
+            return fields
+        if not all(name in fields for name in required):
+            raise StructuredOutputError(f"Response is missing required fields: {raw[:200]}")
+        try:
+            result = schema.model_validate({**fields, **(overrides or {})}).model_dump()
+        except ValidationError as e:
+            raise StructuredOutputError(f"Response does not match {schema.__name__}: {str(e)}")
+        structured_output_stats["decoded"] += 1
+        return result
+
+    async def decode(fields: Dict[str, Any], raw: str) -> Dict[str, Any]:
+        try:
+            return finish(fields, raw)
+        except StructuredOutputError as e:
+            logger.warning(f"Could not decode {schema.__name__} response, attempting repair: {str(e)}")
+            repaired = await repair_structured_output(
+                raw, schema, str(e), model=model, priority=priority, overrides=overrides
+            )
+            return repaired.model_dump()
+
+    async def read(deltas: AsyncIterator[str]) -> Tuple[str, bool]:
+        parser = IncrementalJSONParser()
+        started = time.monotonic()
+        first_token = None
+        first_field = None
+        useful = None
+        async for delta in deltas:
+            if first_token is None:
+                first_token = time.monotonic() - started
+            completed = parser.feed(delta)
+            if completed and first_field is None:
+                first_field = time.monotonic() - started
+            if parser.has_fields(required):
+                useful = time.monotonic() - started
+                break
+
+        total_time = time.monotonic() - started
+        streaming_stats.record(total_time, first_token, first_field, useful, not parser.complete)
+        return parser.buffer, parser.complete
+
+    response = await query_llm(
+        prompt, model=model, temperature=temperature, max_tokens=max_tokens,
+        priority=priority, cache=cache, template_version=template_version,
+        coalesce=coalesce, response_format=response_format, stage=stage,
+        stream_reader=read if LLM_STREAMING_ENABLED else None,
+        stream_key="fields:" + ",".join(required)
+    )
+    parser = IncrementalJSONParser()
+    parser.feed(response)
+    return await decode(parser.fields, response)
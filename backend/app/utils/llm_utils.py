@@ -2,11 +2,30 @@ import os
 import json
 import logging
 import re
+import time
 import aiohttp
 import asyncio
-from typing import Dict, List, Any, Optional, Union
+from typing import Dict, List, Any, Optional, Union, Type, TypeVar, Tuple, Callable, Awaitable, AsyncIterator
+from pydantic import BaseModel
 from dotenv import load_dotenv
 
+from app.utils.llm_scheduler import LLMScheduler, ModelBudget, Priority, current_priority
+from app.utils.llm_cache import LLMResponseCache
+from app.utils.single_flight import SingleFlight
+from app.utils.llm_hedging import LatencyTracker, HedgeStats
+from app.utils.json_decoder import decode_model, StructuredOutputError
+from app.utils.llm_budgets import stage_budget, llm_token_usage, llm_prompt_cache
+from app.utils.prompt_builder import estimate_tokens, PromptParts, prompt_key_text
+from app.utils.llm_resilience import (
+    LLMAPIError,
+    CircuitOpenError,
+    DeadlineExceededError,
+    Deadline,
+    RetryPolicy,
+    CircuitBreakerRegistry,
+    parse_retry_after
+)
+
 # Load environment variables
 load_dotenv()
 
@@ -19,98 +38,786 @@ TEMPERATURE = float(os.getenv("TEMPERATURE", "0.2"))
 MAX_TOKENS = int(os.getenv("MAX_TOKENS", "4000"))
 REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "60"))
 
+# Context window sizes and the prompt size we are willing to pay for
+DEFAULT_MODEL_CONTEXT_TOKENS = int(os.getenv("DEFAULT_MODEL_CONTEXT_TOKENS", "128000"))
+BACKUP_MODEL_CONTEXT_TOKENS = int(os.getenv("BACKUP_MODEL_CONTEXT_TOKENS", "128000"))
+LLM_PROMPT_TOKEN_BUDGET = int(os.getenv("LLM_PROMPT_TOKEN_BUDGET", "24000"))
+
+# HTTP client configuration
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "100"))
+LLM_POOL_SIZE_PER_HOST = int(os.getenv("LLM_POOL_SIZE_PER_HOST", "50"))
+LLM_DNS_CACHE_TTL = int(os.getenv("LLM_DNS_CACHE_TTL", "300"))
+LLM_KEEPALIVE_TIMEOUT = float(os.getenv("LLM_KEEPALIVE_TIMEOUT", "60"))
+
+# Rate and token budgets per model
+DEFAULT_MODEL_RPM = int(os.getenv("DEFAULT_MODEL_RPM", "500"))
+DEFAULT_MODEL_TPM = int(os.getenv("DEFAULT_MODEL_TPM", "200000"))
+BACKUP_MODEL_RPM = int(os.getenv("BACKUP_MODEL_RPM", "500"))
+BACKUP_MODEL_TPM = int(os.getenv("BACKUP_MODEL_TPM", "200000"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "64"))
+LLM_INITIAL_CONCURRENCY = int(os.getenv("LLM_INITIAL_CONCURRENCY", "16"))
+LLM_TARGET_LATENCY = float(os.getenv("LLM_TARGET_LATENCY", "20"))
+
+# Response cache configuration
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "2048"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3")
+
+# Hedging configuration
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "true").lower() == "true"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_WINDOW = int(os.getenv("LLM_HEDGE_WINDOW", "200"))
+
+# Resilience configuration
+LLM_CALL_DEADLINE = float(os.getenv("LLM_CALL_DEADLINE", "180"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "30"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RECOVERY = float(os.getenv("LLM_BREAKER_RECOVERY", "30"))
+
+# Structured output mode: "json_schema", "json_object" or "off"
+LLM_STRUCTURED_OUTPUT = os.getenv("LLM_STRUCTURED_OUTPUT", "json_schema").lower()
+
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T", bound=BaseModel)
+
+def _model_budget(requests_per_minute: int, tokens_per_minute: int) -> ModelBudget:
+    return ModelBudget(
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute,
+        max_concurrency=LLM_MAX_CONCURRENCY,
+        initial_concurrency=LLM_INITIAL_CONCURRENCY,
+        target_latency=LLM_TARGET_LATENCY
+    )
+
+# Central scheduler enforcing per-model budgets for every LLM request.
+# The backup budget is registered first so a shared model name keeps the primary budget.
+llm_scheduler = LLMScheduler(
+    budgets={
+        BACKUP_MODEL: _model_budget(BACKUP_MODEL_RPM, BACKUP_MODEL_TPM),
+        DEFAULT_MODEL: _model_budget(DEFAULT_MODEL_RPM, DEFAULT_MODEL_TPM)
+    },
+    default_budget=_model_budget(DEFAULT_MODEL_RPM, DEFAULT_MODEL_TPM)
+)
+
+# Response cache shared by all call sites that opt in
+llm_cache = LLMResponseCache(
+    max_entries=LLM_CACHE_MAX_ENTRIES,
+    max_bytes=LLM_CACHE_MAX_BYTES,
+    ttl=LLM_CACHE_TTL,
+    db_path=LLM_CACHE_PATH or None
+)
+
+# Coalesces identical requests that are in flight at the same time
+llm_single_flight = SingleFlight()
+
+# Recent latencies per model and hedging counters
+llm_latency_tracker = LatencyTracker(window=LLM_HEDGE_WINDOW, min_samples=LLM_HEDGE_MIN_SAMPLES)
+llm_hedge_stats = HedgeStats()
+
+# Retry policy and per-model circuit breakers
+llm_retry_policy = RetryPolicy(base_delay=LLM_RETRY_BASE_DELAY, max_delay=LLM_RETRY_MAX_DELAY)
+llm_circuit_breakers = CircuitBreakerRegistry(
+    failure_threshold=LLM_BREAKER_FAILURES,
+    recovery_timeout=LLM_BREAKER_RECOVERY
+)
+
+# Outcome counters for structured responses
+structured_output_stats = {"decoded": 0, "repaired": 0, "failed": 0}
+
+# Reads a streamed response's text deltas, stopping whenever it has enough,
+# and returns the text read and whether that is the whole response
+StreamReader = Callable[[AsyncIterator[str]], Awaitable[Tuple[str, bool]]]
+
+# Shared HTTP session, created once per application lifespan
+_session: Optional[aiohttp.ClientSession] = None
+
+async def init_llm_session() -> aiohttp.ClientSession:
+    """
+    Create the shared HTTP session used for all LLM traffic
+    
+    The session keeps connections alive between calls, bounds the number of
+    connections per host and caches DNS lookups, so each request only pays
+    for TCP/TLS setup when the pool has no idle connection.
+    
+    Returns:
+        The shared aiohttp session
+    """
+    global _session
+    
+    if _session is not None and not _session.closed:
+        return _session
+    
+    connector = aiohttp.TCPConnector(
+        limit=LLM_POOL_SIZE,
+        limit_per_host=LLM_POOL_SIZE_PER_HOST,
+        ttl_dns_cache=LLM_DNS_CACHE_TTL,
+        keepalive_timeout=LLM_KEEPALIVE_TIMEOUT
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=REQUEST_TIMEOUT,
+        connect=LLM_CONNECT_TIMEOUT
+    )
+    _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    logger.info(
+        f"Initialized LLM HTTP session (pool={LLM_POOL_SIZE}, per_host={LLM_POOL_SIZE_PER_HOST})"
+    )
+    return _session
+
+async def close_llm_session() -> None:
+    """
+    Close the shared HTTP session and release pooled connections
+    """
+    global _session
+    
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logger.info("Closed LLM HTTP session")
+    _session = None
+
+async def get_llm_session() -> aiohttp.ClientSession:
+    """
+    Get the shared HTTP session, creating it on first use
+    
+    The FastAPI lifespan creates the session at startup; lazy creation keeps
+    scripts and workers that never run the lifespan working.
+    
+    Returns:
+        The shared aiohttp session
+    """
+    if _session is None or _session.closed:
+        return await init_llm_session()
+    return _session
+
+def prompt_token_budget(model: str = DEFAULT_MODEL, max_tokens: int = MAX_TOKENS) -> int:
+    """
+    Largest prompt, in estimated tokens, that can be sent to a model
+    
+    The budget must also fit the backup model, since hedging and fallback can
+    send the same prompt there, and keeps a margin for estimation error.
+    
+    Args:
+        model: The model the prompt is for
+        max_tokens: Output tokens requested with the prompt
+        
+    Returns:
+        Prompt budget in estimated tokens
+    """
+    context = DEFAULT_MODEL_CONTEXT_TOKENS if model == DEFAULT_MODEL else BACKUP_MODEL_CONTEXT_TOKENS
+    context = min(context, BACKUP_MODEL_CONTEXT_TOKENS)
+    return min(LLM_PROMPT_TOKEN_BUDGET, int((context - max_tokens) * 0.9))
+
+class LLMRequest:
+    """
+    Model-independent parameters of a single completion request
+    """
+    
+    def __init__(
+        self,
+        prompt: Union[str, PromptParts],
+        temperature: float = TEMPERATURE,
+        max_tokens: int = MAX_TOKENS,
+        response_format: Optional[Dict[str, Any]] = None,
+        stage: str = ""
+    ):
+        self.prompt = prompt
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.response_format = response_format
+        self.stage = stage
+        self.group = prompt.group if isinstance(prompt, PromptParts) else ""
+        self.prompt_tokens = estimate_tokens(prompt.text() if isinstance(prompt, PromptParts) else prompt)
+    
+    def messages(self) -> List[Dict[str, str]]:
+        if isinstance(self.prompt, PromptParts):
+            return self.prompt.messages()
+        return [{"role": "user", "content": self.prompt}]
+    
+    def payload(self, model: str, stream: bool = False) -> Dict[str, Any]:
+        """
+        Build the chat completion request body for a model
+        """
+        payload = {
+            "model": model,
+            "messages": self.messages(),
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens
+        }
+        if self.response_format:
+            payload["response_format"] = self.response_format
+        if stream:
+            payload["stream"] = True
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+    
+    def estimated_tokens(self) -> int:
+        """
+        Rough prompt plus completion token count used for budget reservations
+        """
+        return self.prompt_tokens + self.max_tokens
+
 async def query_llm(
-    prompt: str, 
+    prompt: Union[str, PromptParts], 
     model: str = DEFAULT_MODEL,
     temperature: float = TEMPERATURE,
     max_tokens: int = MAX_TOKENS,
-    retry_count: int = 2
+    retry_count: int = 2,
+    priority: Optional[Priority] = None,
+    cache: bool = False,
+    template_version: str = "",
+    coalesce: bool = True,
+    response_format: Optional[Dict[str, Any]] = None,
+    stage: str = "",
+    stream_reader: Optional[StreamReader] = None,
+    stream_key: Optional[str] = None
 ) -> str:
     """
     Query the LLM API
     
     Args:
-        prompt: The prompt to send to the LLM
+        prompt: The prompt to send to the LLM, optionally split into a static
+            prefix and a per-submission suffix
         model: The model to use
         temperature: Temperature parameter for generation
         max_tokens: Maximum tokens to generate
         retry_count: Number of retry attempts
+        priority: Scheduling priority class of the request, defaults to the current priority scope
+        cache: Whether the response may be served from and stored in the response cache.
+            Only deterministic stages should opt in.
+        template_version: Version of the prompt template, part of the cache key
+        coalesce: Whether identical concurrent requests share a single upstream call
+        response_format: Optional provider response format (JSON mode or JSON schema)
+        stage: Evaluation stage the call belongs to, used for token usage reporting
+        stream_reader: Streams the response into this reader, which may stop
+            reading early; a response it did not read to the end is not cached
+        stream_key: Identifies what the stream reader reads, so concurrent
+            calls with equivalent readers are coalesced; without one, streamed
+            calls are not coalesced
+        
+    Returns:
+        The LLM response text, or with a stream reader the text it read
+    """
+    if priority is None:
+        priority = current_priority()
+    request = LLMRequest(prompt, temperature, max_tokens, response_format, stage)
+    request_key = llm_cache.make_key(
+        model, temperature, max_tokens, prompt_key_text(prompt), template_version, response_format
+    )
+    use_cache = cache and LLM_CACHE_ENABLED
+    
+    if use_cache:
+        cached_response = await llm_cache.get(request_key)
+        if cached_response is not None:
+            return cached_response
+    
+    async def fetch() -> str:
+        response, complete = await _query_llm_hedged(request, model, retry_count, priority, stream_reader)
+        # A response cut off by the stream reader only suits that reader, never cache it
+        if use_cache and complete:
+            await llm_cache.set(request_key, response, template_version)
+        return response
+    
+    if stream_reader is not None:
+        if not coalesce or stream_key is None:
+            return await fetch()
+        return await llm_single_flight.do(f"{request_key}:stream:{stream_key}", fetch)
+    if coalesce:
+        return await llm_single_flight.do(request_key, fetch)
+    return await fetch()
+
+async def cache_llm_response(
+    prompt: Union[str, PromptParts],
+    response: str,
+    model: str = DEFAULT_MODEL,
+    temperature: float = TEMPERATURE,
+    max_tokens: int = MAX_TOKENS,
+    template_version: str = "",
+    response_format: Optional[Dict[str, Any]] = None
+) -> None:
+    """
+    Store a response obtained another way, e.g. one student's share of a
+    batched response, under the key query_llm uses for this request, so a
+    later cached query_llm call with the same arguments is served from it
+    
+    Args:
+        prompt: The prompt query_llm would be called with
+        response: The response text to serve for it
+        model, temperature, max_tokens, template_version, response_format:
+            The query_llm arguments that are part of the cache key
+    """
+    if not LLM_CACHE_ENABLED:
+        return
+    request_key = llm_cache.make_key(
+        model, temperature, max_tokens, prompt_key_text(prompt), template_version, response_format
+    )
+    await llm_cache.set(request_key, response, template_version)
+
+async def _query_llm_hedged(
+    request: LLMRequest,
+    model: str,
+    retry_count: int,
+    priority: Priority,
+    stream_reader: Optional[StreamReader] = None
+) -> Tuple[str, bool]:
+    """
+    Query the primary model and hedge to the backup model when it is slow
+    
+    If the primary has not answered by the configured percentile of its recent
+    latencies, the same request is sent to the backup model and whichever
+    answers first wins; the other request is cancelled. The delay counts from
+    the primary's admission by the scheduler, like the latency samples, and
+    no hedge is sent while the primary is queued or backing off, when the
+    backup is the same model, or when the backup model has no free capacity,
+    since a hedge would then only add load to a saturated limiter.
+    
+    Args:
+        request: The request to send
+        model: The model to use
+        retry_count: Number of retry attempts
+        priority: Scheduling priority class of the request
+        stream_reader: Optional reader the response is streamed into
         
     Returns:
-        The LLM response text
+        The LLM response text and whether it is complete
     """
     if not LLM_API_KEY:
         raise ValueError("LLM_API_KEY environment variable is not set")
+    
+    deadline = Deadline(LLM_CALL_DEADLINE)
+    
+    hedge_delay = None
+    if LLM_HEDGE_ENABLED and model == DEFAULT_MODEL and BACKUP_MODEL != model:
+        llm_hedge_stats.requests += 1
+        hedge_delay = llm_latency_tracker.percentile(model, LLM_HEDGE_PERCENTILE)
+    
+    if hedge_delay is None:
+        return await _query_llm_with_fallback(request, model, retry_count, priority, deadline, stream_reader)
+    
+    in_flight = asyncio.Event()
+    primary = asyncio.ensure_future(
+        _query_llm_with_fallback(request, model, retry_count, priority, deadline, stream_reader, in_flight)
+    )
+    admission = asyncio.ensure_future(in_flight.wait())
+    backup = None
+    
+    try:
+        # Time spent queued for the scheduler is not model latency, start the hedge delay at admission
+        await asyncio.wait({primary, admission}, return_when=asyncio.FIRST_COMPLETED)
+        started = time.monotonic()
+        if not primary.done():
+            await asyncio.wait({primary}, timeout=hedge_delay)
+        if primary.done():
+            return primary.result()
+        
+        if not in_flight.is_set() or not llm_scheduler.has_capacity(BACKUP_MODEL, request.estimated_tokens()):
+            llm_hedge_stats.skipped += 1
+            return await primary
+        
+        logger.info(f"Primary model slower than {hedge_delay:.1f}s, hedging to {BACKUP_MODEL}")
+        llm_hedge_stats.hedges += 1
+        backup = asyncio.ensure_future(
+            _query_model(request, BACKUP_MODEL, 1, priority, deadline, stream_reader)
+        )
+        
+        pending = {primary, backup}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.cancelled():
+                    error = asyncio.CancelledError()
+                    continue
+                if task.exception() is not None:
+                    error = task.exception()
+                    continue
+                
+                if task is backup:
+                    llm_hedge_stats.record_backup_win(
+                        time.monotonic() - started,
+                        llm_latency_tracker.tail_mean(model, hedge_delay)
+                    )
+                else:
+                    llm_hedge_stats.primary_wins += 1
+                return task.result()
         
+        raise error
+    finally:
+        # Cancel whichever request lost (or both, if the caller was cancelled)
+        for task in (primary, admission, backup):
+            if task is not None and not task.done():
+                task.cancel()
+
+async def _query_llm_with_fallback(
+    request: LLMRequest,
+    model: str,
+    retry_count: int,
+    priority: Priority,
+    deadline: Deadline,
+    stream_reader: Optional[StreamReader] = None,
+    in_flight: Optional[asyncio.Event] = None
+) -> Tuple[str, bool]:
+    """
+    Query a model with retries, falling back to the backup model when the
+    primary is unavailable
+    
+    Args:
+        request: The request to send
+        model: The model to use
+        retry_count: Number of retry attempts
+        priority: Scheduling priority class of the request
+        deadline: Total time budget for the call
+        stream_reader: Optional reader the response is streamed into
+        in_flight: Optional event set while a request to the model is admitted and in flight
+        
+    Returns:
+        The LLM response text and whether it is complete
+    """
+    try:
+        return await _query_model(request, model, retry_count, priority, deadline, stream_reader, in_flight)
+    except LLMAPIError as e:
+        if model != DEFAULT_MODEL or not e.fallback or deadline.expired():
+            raise
+        logger.info(f"Trying backup model {BACKUP_MODEL}")
+        return await _query_model(request, BACKUP_MODEL, 1, priority, deadline, stream_reader)
+
+async def _query_model(
+    request: LLMRequest,
+    model: str,
+    retry_count: int,
+    priority: Priority,
+    deadline: Deadline,
+    stream_reader: Optional[StreamReader] = None,
+    in_flight: Optional[asyncio.Event] = None
+) -> Tuple[str, bool]:
+    """
+    Query a single model, retrying retryable errors with jittered backoff
+    
+    Non-retryable errors fail immediately, Retry-After is honoured, and no
+    request is sent while the model's circuit breaker is open.
+    
+    Args:
+        request: The request to send
+        model: The model to use
+        retry_count: Number of retry attempts
+        priority: Scheduling priority class of the request
+        deadline: Total time budget for the call
+        stream_reader: Optional reader the response is streamed into
+        in_flight: Optional event set while a request is admitted and in flight
+        
+    Returns:
+        The LLM response text and whether it is complete
+    """
+    breaker = llm_circuit_breakers.get(model)
+    
+    for attempt in range(retry_count + 1):
+        permit = breaker.allow_request()
+        if permit is None:
+            raise CircuitOpenError(model, breaker.retry_in())
+        
+        remaining = deadline.remaining()
+        if remaining <= 0:
+            breaker.record_neutral(permit)
+            raise DeadlineExceededError()
+        
+        try:
+            # The outer timeout bounds queueing plus the request by the call deadline
+            response = await asyncio.wait_for(
+                _send_request(request, model, priority, deadline, stream_reader, in_flight),
+                timeout=remaining
+            )
+            breaker.record_success()
+            return response
+        except asyncio.TimeoutError:
+            breaker.record_neutral(permit)
+            raise DeadlineExceededError()
+        except LLMAPIError as e:
+            error = e
+        except aiohttp.ClientError as e:
+            error = LLMAPIError(f"LLM request failed: {type(e).__name__}: {str(e)}")
+        except (KeyError, IndexError, ValueError) as e:
+            error = LLMAPIError(f"Malformed LLM response: {str(e)}")
+        except BaseException:
+            # A cancelled request (such as a losing hedge) must still end a half-open probe
+            breaker.record_neutral(permit)
+            raise
+        finally:
+            # Between attempts the request is backing off or queued again, not in flight
+            if in_flight is not None:
+                in_flight.clear()
+        
+        if error.counts_against_circuit:
+            breaker.record_failure()
+        else:
+            breaker.record_neutral(permit)
+        logger.error(f"Error querying LLM {model} (attempt {attempt + 1}): {str(error)}")
+        
+        if not error.retryable or attempt == retry_count:
+            raise error
+        
+        delay = llm_retry_policy.backoff(attempt, error.retry_after)
+        if delay >= deadline.remaining():
+            raise error
+        await asyncio.sleep(delay)
+    
+    # If we somehow get here, raise an error
+    raise RuntimeError("Failed to query LLM after multiple attempts")
+
+async def _stream_deltas(response: aiohttp.ClientResponse, usage: Dict[str, Any]) -> AsyncIterator[str]:
+    """
+    Yield the text deltas of a server-sent event stream, collecting its usage
+    """
+    async for raw_line in response.content:
+        line = raw_line.decode("utf-8").strip()
+        if not line.startswith("data:"):
+            continue
+        
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return
+        
+        event = json.loads(data)
+        if event.get("usage"):
+            usage.update(event["usage"])
+        
+        choices = event.get("choices") or []
+        if choices:
+            delta = choices[0].get("delta", {}).get("content")
+            if delta:
+                yield delta
+
+async def _send_request(
+    request: LLMRequest,
+    model: str,
+    priority: Priority,
+    deadline: Deadline,
+    stream_reader: Optional[StreamReader] = None,
+    in_flight: Optional[asyncio.Event] = None
+) -> Tuple[str, bool]:
+    """
+    Send a single chat completion request through the scheduler
+    
+    Args:
+        request: The request to send
+        model: The model to use
+        priority: Scheduling priority class of the request
+        deadline: Total time budget for the call
+        stream_reader: Optional reader the response is streamed into as
+            server-sent events
+        in_flight: Optional event set from admission until the request ends
+        
+    Returns:
+        The LLM response text and whether it is complete
+    """
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {LLM_API_KEY}"
     }
     
-    payload = {
-        "model": model,
-        "messages": [{"role": "user", "content": prompt}],
-        "temperature": temperature,
-        "max_tokens": max_tokens
-    }
-    
-    for attempt in range(retry_count + 1):
+    # Wait for the scheduler to admit the request under the model's budget
+    async with llm_scheduler.slot(model, request.estimated_tokens(), priority) as slot:
+        request_started = time.monotonic()
+        if in_flight is not None:
+            in_flight.set()
+        timeout = aiohttp.ClientTimeout(
+            total=min(deadline.remaining(), REQUEST_TIMEOUT),
+            connect=LLM_CONNECT_TIMEOUT
+        )
+        session = await get_llm_session()
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    LLM_API_URL,
-                    headers=headers,
-                    json=payload,
-                    timeout=REQUEST_TIMEOUT
-                ) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        logger.error(f"LLM API error: {response.status} - {error_text}")
-                        
-                        # If this is the last attempt and we're using the primary model, try backup
-                        if attempt == retry_count and model == DEFAULT_MODEL:
-                            logger.info(f"Trying backup model {BACKUP_MODEL}")
-                            return await query_llm(
-                                prompt, 
-                                model=BACKUP_MODEL,
-                                temperature=temperature,
-                                max_tokens=max_tokens,
-                                retry_count=1
-                            )
-                            
-                        # If this is the last attempt, raise the error
-                        if attempt == retry_count:
-                            response.raise_for_status()
-                        
-                        # Wait before retrying
-                        await asyncio.sleep(2 ** attempt)  # Exponential backoff
-                        continue
-                    
-                    result = await response.json()
-                    return result["choices"][0]["message"]["content"]
-                    
-        except Exception as e:
-            logger.error(f"Error querying LLM: {str(e)}", exc_info=True)
-            
-            if attempt == retry_count:
-                if model == DEFAULT_MODEL:
-                    logger.info(f"Trying backup model {BACKUP_MODEL}")
-                    return await query_llm(
-                        prompt, 
-                        model=BACKUP_MODEL,
-                        temperature=temperature,
-                        max_tokens=max_tokens,
-                        retry_count=1
+            async with session.post(
+                LLM_API_URL,
+                headers=headers,
+                json=request.payload(model, stream=stream_reader is not None),
+                timeout=timeout
+            ) as response:
+                slot.status = response.status
+                if response.status != 200:
+                    error_text = await response.text()
+                    raise LLMAPIError.from_response(
+                        response.status,
+                        error_text[:500],
+                        retry_after=parse_retry_after(response.headers)
                     )
+                
+                if stream_reader is None:
+                    result = await response.json()
+                    usage = result.get("usage", {})
+                    content = result["choices"][0]["message"]["content"]
+                    complete = True
                 else:
-                    raise
-            
-            await asyncio.sleep(2 ** attempt)  # Exponential backoff
+                    usage = {}
+                    deltas = _stream_deltas(response, usage)
+                    try:
+                        content, complete = await stream_reader(deltas)
+                    finally:
+                        await deltas.aclose()
+                        # Drop the connection instead of draining a response we no longer need
+                        response.close()
+                    # Streams cut off early never receive usage, estimate what was generated
+                    usage.setdefault("completion_tokens", len(content) // 4)
+        except asyncio.TimeoutError:
+            # A slow endpoint is retryable, unlike running out of the call deadline
+            raise LLMAPIError(f"LLM request to {model} timed out")
+        
+        slot.total_tokens = usage.get("total_tokens")
+        llm_token_usage.record(
+            request.stage,
+            request.max_tokens,
+            usage.get("completion_tokens"),
+            estimated_prompt=request.prompt_tokens,
+            billed_prompt=usage.get("prompt_tokens")
+        )
+        llm_prompt_cache.record(
+            request.group,
+            usage.get("prompt_tokens"),
+            (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+        )
+        # Streams cut off early would make the hedging delay too short
+        if complete:
+            llm_latency_tracker.record(model, time.monotonic() - request_started)
+        return content, complete
+
+def structured_response_format(schema: Type[BaseModel]) -> Optional[Dict[str, Any]]:
+    """
+    Build the provider response format requesting output that matches a model
     
-    # If we somehow get here, raise an error
-    raise RuntimeError("Failed to query LLM after multiple attempts")
+    Args:
+        schema: Pydantic model describing the expected response
+        
+    Returns:
+        The response_format request field, or None when structured output is disabled
+    """
+    if LLM_STRUCTURED_OUTPUT == "json_schema":
+        return {
+            "type": "json_schema",
+            "json_schema": {
+                "name": schema.__name__,
+                "schema": schema.model_json_schema(),
+                "strict": False
+            }
+        }
+    if LLM_STRUCTURED_OUTPUT == "json_object":
+        return {"type": "json_object"}
+    return None
+
+async def query_llm_structured(
+    prompt: Union[str, PromptParts],
+    schema: Type[T],
+    model: str = DEFAULT_MODEL,
+    temperature: float = TEMPERATURE,
+    max_tokens: int = MAX_TOKENS,
+    priority: Optional[Priority] = None,
+    cache: bool = False,
+    template_version: str = "",
+    overrides: Optional[Dict[str, Any]] = None,
+    stage: str = ""
+) -> T:
+    """
+    Query the LLM for a response matching a Pydantic model
+    
+    The provider is asked for JSON output matching the model's schema. The
+    response is decoded with the tolerant decoder and validated; if that fails,
+    a single repair call asks the LLM to fix its own output.
+    
+    Args:
+        prompt: The prompt to send to the LLM, optionally split into prefix and suffix
+        schema: Pydantic model the response must match
+        model: The model to use
+        temperature: Temperature parameter for generation
+        max_tokens: Maximum tokens to generate
+        priority: Scheduling priority class of the request
+        cache: Whether the response may be served from and stored in the response cache
+        template_version: Version of the prompt template, part of the cache key
+        overrides: Fields to set regardless of the response content
+        stage: Evaluation stage the call belongs to, used for token usage reporting
+        
+    Returns:
+        Validated model instance
+        
+    Raises:
+        StructuredOutputError: If the response could not be decoded even after repair
+    """
+    response_format = structured_response_format(schema)
+    
+    try:
+        response = await query_llm(
+            prompt, model=model, temperature=temperature, max_tokens=max_tokens,
+            priority=priority, cache=cache, template_version=template_version,
+            response_format=response_format, stage=stage
+        )
+    except LLMAPIError as e:
+        if response_format is None or e.status != 400:
+            raise
+        # Some providers/models do not support structured output, fall back to plain JSON
+        logger.warning(f"Structured output rejected by {model}, retrying without it: {str(e)}")
+        response = await query_llm(
+            prompt, model=model, temperature=temperature, max_tokens=max_tokens,
+            priority=priority, cache=cache, template_version=template_version, stage=stage
+        )
+    
+    try:
+        result = decode_model(response, schema, overrides)
+        structured_output_stats["decoded"] += 1
+        return result
+    except StructuredOutputError as e:
+        logger.warning(f"Could not decode {schema.__name__} response, attempting repair: {str(e)}")
+        return await repair_structured_output(response, schema, str(e), model=model, priority=priority, overrides=overrides)
+
+async def repair_structured_output(
+    response: str,
+    schema: Type[T],
+    error: str,
+    model: str = DEFAULT_MODEL,
+    priority: Optional[Priority] = None,
+    overrides: Optional[Dict[str, Any]] = None
+) -> T:
+    """
+    Ask the LLM once to turn a malformed response into valid JSON for the schema
+    
+    Args:
+        response: The malformed response text
+        schema: Pydantic model the response must match
+        error: Description of the decoding or validation error
+        model: The model to use
+        priority: Scheduling priority class of the request
+        overrides: Fields to set regardless of the response content
+        
+    Returns:
+        Validated model instance
+        
+    Raises:
+        StructuredOutputError: If the repaired response is still invalid
+    """
+    repair_prompt = (
+        "Rewrite the following text as a single valid JSON object matching this JSON schema. "
+        "Keep the original content, fix only the formatting, and return only the JSON object.\n\n"
+        f"SCHEMA:\n{json.dumps(schema.model_json_schema(), separators=(',', ':'))}\n\n"
+        f"ERROR:\n{error[:500]}\n\n"
+        f"TEXT:\n{response}"
+    )
+    
+    repaired = await query_llm(
+        repair_prompt,
+        model=model,
+        temperature=0.0,
+        max_tokens=stage_budget("repair").max_tokens,
+        priority=priority,
+        response_format=structured_response_format(schema),
+        stage="repair"
+    )
+    
+    try:
+        result = decode_model(repaired, schema, overrides)
+        structured_output_stats["repaired"] += 1
+        return result
+    except StructuredOutputError:
+        structured_output_stats["failed"] += 1
+        raise
 
 async def query_multiple_llms(
     prompt: str,
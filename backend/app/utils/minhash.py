@@ -0,0 +1,145 @@
+import random
+import hashlib
+from typing import Dict, List, Set, Tuple, Hashable, Iterable, Optional
+
+from app.utils.code_fingerprint import normalize_code
+
+# Mersenne prime larger than every shingle hash, for the universal hash family
+_PRIME = (1 << 61) - 1
+_MASK = (1 << 61) - 1
+
+Signature = Tuple[int, ...]
+
+def code_shingles(code: str, language: str = "java", size: int = 4) -> Set[int]:
+    """
+    Hashed token shingles of normalized code
+
+    Code is normalized first (see normalize_code), so comments, formatting and
+    renamed local names do not change the shingles.
+
+    Args:
+        code: Source code
+        language: "java" or "python"
+        size: Tokens per shingle
+
+    Returns:
+        Set of 61-bit shingle hashes
+    """
+    tokens = normalize_code(code, language)
+    if len(tokens) < size:
+        windows: Iterable[List[str]] = [tokens] if tokens else []
+    else:
+        windows = (tokens[i:i + size] for i in range(len(tokens) - size + 1))
+    return {
+        int.from_bytes(hashlib.blake2b("\x00".join(window).encode("utf-8"), digest_size=8).digest(), "big") & _MASK
+        for window in windows
+    }
+
+class MinHasher:
+    """Computes MinHash signatures with a fixed family of random hash functions"""
+
+    def __init__(self, num_perm: int = 64, seed: int = 1):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self._params = [(rng.randrange(1, _PRIME), rng.randrange(0, _PRIME)) for _ in range(num_perm)]
+
+    def signature(self, shingles: Set[int]) -> Signature:
+        """
+        MinHash signature of a shingle set; empty sets get an all-max signature
+        """
+        if not shingles:
+            return tuple([_PRIME] * self.num_perm)
+        return tuple(min((a * x + b) % _PRIME for x in shingles) for a, b in self._params)
+
+def signature_similarity(first: Signature, second: Signature) -> float:
+    """
+    Estimated Jaccard similarity of the shingle sets behind two signatures
+    """
+    return sum(1 for a, b in zip(first, second) if a == b) / len(first)
+
+class LSHIndex:
+    """
+    Locality-sensitive hashing index over MinHash signatures
+
+    Signatures are split into bands; items sharing any band are candidates
+    and are ranked by estimated similarity. With b bands of r rows, pairs of
+    similarity s become candidates with probability 1 - (1 - s^r)^b.
+    Items can be added and removed one at a time.
+    """
+
+    def __init__(self, num_perm: int = 64, bands: int = 16):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.bands = bands
+        self.rows = num_perm // bands
+        self._buckets: List[Dict[Signature, Set[Hashable]]] = [{} for _ in range(bands)]
+        self._signatures: Dict[Hashable, Signature] = {}
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._signatures
+
+    def _bands(self, signature: Signature) -> Iterable[Tuple[int, Signature]]:
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows]
+
+    def add(self, key: Hashable, signature: Signature) -> None:
+        """
+        Index a signature under a key, replacing any signature already stored for it
+        """
+        if key in self._signatures:
+            self.remove(key)
+        self._signatures[key] = signature
+        for band, rows in self._bands(signature):
+            self._buckets[band].setdefault(rows, set()).add(key)
+
+    def remove(self, key: Hashable) -> None:
+        signature = self._signatures.pop(key, None)
+        if signature is None:
+            return
+        for band, rows in self._bands(signature):
+            bucket = self._buckets[band].get(rows)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band][rows]
+
+    def signature(self, key: Hashable) -> Optional[Signature]:
+        return self._signatures.get(key)
+
+    def keys(self) -> List[Hashable]:
+        return list(self._signatures)
+
+    def query(
+        self,
+        signature: Signature,
+        threshold: float = 0.0,
+        limit: int = 10,
+        exclude: Optional[Hashable] = None
+    ) -> List[Tuple[Hashable, float]]:
+        """
+        Find indexed items similar to a signature
+
+        Args:
+            signature: Signature to look up
+            threshold: Minimum estimated similarity
+            limit: Maximum number of neighbors
+            exclude: Key to leave out, e.g. the item itself
+
+        Returns:
+            (key, similarity) pairs, most similar first
+        """
+        candidates: Set[Hashable] = set()
+        for band, rows in self._bands(signature):
+            candidates.update(self._buckets[band].get(rows, ()))
+        candidates.discard(exclude)
+
+        neighbors = []
+        for key in candidates:
+            similarity = signature_similarity(signature, self._signatures[key])
+            if similarity >= threshold:
+                neighbors.append((key, similarity))
+        neighbors.sort(key=lambda neighbor: neighbor[1], reverse=True)
+        return neighbors[:limit]
@@ -0,0 +1,270 @@
+import re
+import hashlib
+import logging
+from typing import Dict, List, Any, Union
+
+logger = logging.getLogger(__name__)
+
+# Words, short digit groups, single punctuation marks and whitespace runs,
+# roughly the pieces a BPE tokenizer splits text into
+_TOKEN_PIECES = re.compile(r"[A-Za-z]+|\d{1,3}|\s+|[^\sA-Za-z\d]")
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens in a text without a tokenizer
+
+    The estimate errs on the high side for code and prose so prompts built
+    against it stay within the real limit.
+
+    Args:
+        text: Text to estimate
+
+    Returns:
+        Estimated token count
+    """
+    if not text:
+        return 0
+
+    count = 0
+    for match in _TOKEN_PIECES.finditer(text):
+        piece = match.group()
+        if piece[0].isalpha():
+            # Common words are one token, long identifiers split every few characters
+            count += 1 + (len(piece) - 1) // 6
+        elif piece[0].isspace():
+            # A single space merges into the next word, other runs cost about one token
+            if piece != " ":
+                count += 1
+        else:
+            count += 1
+    return count
+
+def truncate_to_tokens(text: str, max_tokens: int, keep: str = "head") -> str:
+    """
+    Shorten a text to an estimated token count, cutting at line boundaries
+
+    Args:
+        text: Text to shorten
+        max_tokens: Target size in estimated tokens
+        keep: "head" keeps the beginning, "middle" keeps the beginning and the end
+
+    Returns:
+        The shortened text with a marker where content was removed
+    """
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+
+    ratio = max_tokens / tokens
+    while True:
+        limit = int(len(text) * ratio)
+        if keep == "middle":
+            head = text[:limit // 2]
+            tail = text[len(text) - limit // 2:]
+            head = head[:head.rfind("\n") + 1] or head
+            tail = tail[tail.find("\n") + 1:] if "\n" in tail else tail
+            removed = text.count("\n") - head.count("\n") - tail.count("\n")
+            shortened = f"{head}[... {removed} lines omitted ...]\n{tail}"
+        else:
+            head = text[:limit]
+            head = head[:head.rfind("\n") + 1] or head
+            removed = text.count("\n") - head.count("\n")
+            shortened = f"{head}[... {removed} lines omitted ...]\n"
+
+        if estimate_tokens(shortened) <= max_tokens or ratio < 0.01:
+            return shortened
+        ratio *= 0.9
+
+class PromptParts:
+    """
+    A prompt split into a static prefix, shared by every submission for a
+    problem, and the submission-specific suffix
+
+    The prefix is sent first, as the system message, so providers can serve
+    it from their prompt cache for every student on the same problem.
+    """
+
+    def __init__(self, prefix: str, suffix: str, group: str = ""):
+        self.prefix = prefix
+        self.suffix = suffix
+        self.group = group
+
+    def text(self) -> str:
+        return f"{self.prefix}\n\n{self.suffix}" if self.prefix else self.suffix
+
+    def messages(self) -> List[Dict[str, str]]:
+        messages = []
+        if self.prefix:
+            messages.append({"role": "system", "content": self.prefix})
+        messages.append({"role": "user", "content": self.suffix})
+        return messages
+
+def prompt_group(problem_statement: str) -> str:
+    """
+    Label for prompts that share a static prefix, derived from the problem text
+    """
+    return hashlib.sha256(problem_statement.encode("utf-8")).hexdigest()[:12]
+
+def prompt_key_text(prompt: Union[str, PromptParts]) -> str:
+    """
+    Text identifying a prompt for cache keys, distinguishing the prefix/suffix split
+    """
+    if isinstance(prompt, PromptParts):
+        return f"{prompt.prefix}\x00{prompt.suffix}"
+    return prompt
+
+class PromptSection:
+    """A named part of a prompt with a trimming priority"""
+
+    def __init__(self, name: str, text: str, priority: int, required: bool, keep: str, min_tokens: int, static: bool):
+        self.name = name
+        self.text = text
+        self.priority = priority
+        self.required = required
+        self.keep = keep
+        self.min_tokens = min_tokens
+        self.static = static
+        self.tokens = estimate_tokens(text)
+
+class PromptBudgetStats:
+    """Counts of prompts that had to be trimmed to fit their budget"""
+
+    def __init__(self):
+        self.prompts = 0
+        self.trimmed_prompts = 0
+        self.tokens_removed = 0
+        self.sections_trimmed: Dict[str, int] = {}
+        self.sections_dropped: Dict[str, int] = {}
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "prompts": self.prompts,
+            "trimmed_prompts": self.trimmed_prompts,
+            "tokens_removed": self.tokens_removed,
+            "sections_trimmed": dict(self.sections_trimmed),
+            "sections_dropped": dict(self.sections_dropped)
+        }
+
+prompt_budget_stats = PromptBudgetStats()
+
+class PromptBuilder:
+    """
+    Assembles a prompt from prioritized sections within a token budget
+
+    Sections keep the order in which they are added and are separated by a
+    blank line. When the estimated size exceeds the budget, optional sections
+    are trimmed or dropped starting with the highest priority number (least
+    important); required sections are only shortened as a last resort, so an
+    oversized input never fails the call.
+    """
+
+    def __init__(self, token_budget: int):
+        self.token_budget = token_budget
+        self.sections: List[PromptSection] = []
+        self.trimmed: List[str] = []
+        self.dropped: List[str] = []
+        self.estimated_tokens = 0
+
+    def add(
+        self,
+        name: str,
+        text: str,
+        priority: int = 0,
+        required: bool = False,
+        keep: str = "head",
+        min_tokens: int = 50,
+        static: bool = False
+    ) -> "PromptBuilder":
+        """
+        Add a section to the prompt
+
+        Args:
+            name: Section name used in metrics and logs
+            text: Section text
+            priority: Trimming priority, larger numbers are trimmed first
+            required: Whether the section may only be shortened as a last resort
+            keep: Which part of the text to keep when trimming, "head" or "middle"
+            min_tokens: Drop the section instead of trimming it below this size
+            static: Whether the section is the same for every submission to a problem
+
+        Returns:
+            The builder, for chaining
+        """
+        if text:
+            self.sections.append(PromptSection(name, text, priority, required, keep, min_tokens, static))
+        return self
+
+    def _shrink(self, section: PromptSection, overflow: int, allow_drop: bool) -> int:
+        target = section.tokens - overflow
+        if allow_drop and target < section.min_tokens:
+            self.dropped.append(section.name)
+            prompt_budget_stats.sections_dropped[section.name] = prompt_budget_stats.sections_dropped.get(section.name, 0) + 1
+            removed = section.tokens
+            section.text = ""
+            section.tokens = 0
+            return removed
+
+        section.text = truncate_to_tokens(section.text, max(target, 0), section.keep)
+        removed = section.tokens - estimate_tokens(section.text)
+        section.tokens -= removed
+        self.trimmed.append(section.name)
+        prompt_budget_stats.sections_trimmed[section.name] = prompt_budget_stats.sections_trimmed.get(section.name, 0) + 1
+        return removed
+
+    def build(self) -> str:
+        """
+        Assemble the prompt, trimming sections as needed to fit the budget
+
+        Returns:
+            The prompt text
+        """
+        self._fit()
+        return "\n\n".join(section.text for section in self.sections if section.text)
+
+    def build_parts(self, group: str = "") -> PromptParts:
+        """
+        Assemble the prompt as a static prefix followed by the per-submission suffix
+
+        Args:
+            group: Label of the prompts sharing the prefix, used in cache statistics
+
+        Returns:
+            The prompt split into prefix and suffix
+        """
+        self._fit()
+        prefix = "\n\n".join(section.text for section in self.sections if section.static and section.text)
+        suffix = "\n\n".join(section.text for section in self.sections if not section.static and section.text)
+        return PromptParts(prefix, suffix, group)
+
+    def _fit(self) -> None:
+        prompt_budget_stats.prompts += 1
+        total = sum(section.tokens for section in self.sections)
+        overflow = total - self.token_budget
+
+        if overflow > 0:
+            prompt_budget_stats.trimmed_prompts += 1
+
+            # Least important first; later sections before earlier ones at equal priority
+            optional = [section for section in self.sections if not section.required]
+            for section in sorted(optional, key=lambda s: (-s.priority, -self.sections.index(s))):
+                if overflow <= 0:
+                    break
+                overflow -= self._shrink(section, overflow, allow_drop=True)
+
+            # Last resort: shorten the largest required sections
+            required = [section for section in self.sections if section.required]
+            for section in sorted(required, key=lambda s: -s.tokens):
+                if overflow <= 0:
+                    break
+                overflow -= self._shrink(section, overflow, allow_drop=False)
+
+            removed = total - sum(section.tokens for section in self.sections)
+            prompt_budget_stats.tokens_removed += removed
+            logger.info(
+                f"Prompt of ~{total} tokens exceeded budget of {self.token_budget}: "
+                f"trimmed {self.trimmed}, dropped {self.dropped}"
+            )
+
+        self.estimated_tokens = sum(section.tokens for section in self.sections)
@@ -186,6 +186,25 @@ def format_rubric_for_llm(parsed_rubric: Dict[str, Any], approach: Optional[str]
     return "\n".join(result)
 
 
+def format_approach_rubric(approach: str, approach_rubric: Dict[str, Any]) -> str:
+    """
+    Format the rubric of a single approach for the evaluation prompt
+    
+    Args:
+        approach: The approach key, e.g. "Solution 1"
+        approach_rubric: The parsed approach (name and points)
+        
+    Returns:
+        Formatted rubric text
+    """
+    result = [f"# {approach}: {approach_rubric['name']}"]
+    
+    for i, point in enumerate(approach_rubric["points"]):
+        result.append(f"{i+1}. {point['description']} [{point['marks']} marks]")
+    
+    return "\n".join(result)
+
+
 def get_complete_rubric(db: Session, problem_id: int) -> Optional[ParsedRubric]:
     """
     Get a complete rubric with best approach and total marks identified
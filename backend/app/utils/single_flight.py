@@ -0,0 +1,62 @@
+import asyncio
+import logging
+from typing import Dict, Any, Callable, Awaitable, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key: the first caller starts the
+    work and every caller that arrives while it is in flight awaits the same
+    result (or the same exception).
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[str, asyncio.Task] = {}
+
+        # Metrics
+        self.calls = 0
+        self.executions = 0
+        self.deduplicated = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run fn once per key among concurrent callers
+
+        Args:
+            key: Identity of the work, callers with equal keys share one execution
+            fn: Coroutine factory performing the work
+
+        Returns:
+            The shared result of fn
+        """
+        self.calls += 1
+        task = self._in_flight.get(key)
+
+        if task is None:
+            self.executions += 1
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            self.deduplicated += 1
+
+        # Shield so one cancelled caller does not cancel the work shared by the others
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # Mark the exception as retrieved in case every caller was cancelled
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug(f"Coalesced call failed: {task.exception()}")
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "executions": self.executions,
+            "deduplicated": self.deduplicated,
+            "in_flight": len(self._in_flight)
+        }
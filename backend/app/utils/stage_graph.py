@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Any, Callable, Awaitable, Iterable
+
+logger = logging.getLogger(__name__)
+
+class Stage:
+    """A named step of a pipeline and the stages whose results it needs"""
+
+    def __init__(self, name: str, fn: Callable[..., Awaitable[Any]], depends_on: List[str]):
+        self.name = name
+        self.fn = fn
+        self.depends_on = depends_on
+
+class StageTimingStats:
+    """Run counts, failures and durations per pipeline stage"""
+
+    def __init__(self):
+        self._stages: Dict[str, Dict[str, float]] = {}
+
+    def record(self, name: str, status: str, duration: float) -> None:
+        stats = self._stages.setdefault(
+            name,
+            {"runs": 0, "failed": 0, "cancelled": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+        )
+        stats["runs"] += 1
+        if status != "ok":
+            stats[status] += 1
+        stats["total_seconds"] += duration
+        stats["max_seconds"] = max(stats["max_seconds"], duration)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            name: {**stats, "avg_seconds": stats["total_seconds"] / stats["runs"]}
+            for name, stats in self._stages.items()
+        }
+
+stage_timing_stats = StageTimingStats()
+
+class StageGraph:
+    """
+    Runs the stages of a pipeline as a dependency graph
+
+    Every stage starts as soon as the stages it depends on have finished and
+    receives their results as keyword arguments, so independent stages run
+    concurrently. When a stage fails, every stage still running or waiting is
+    cancelled and the failure is raised to the caller.
+    """
+
+    def __init__(self, name: str = "pipeline"):
+        self.name = name
+        self.stages: Dict[str, Stage] = {}
+        self.timings: Dict[str, Dict[str, Any]] = {}
+
+    def add(self, name: str, fn: Callable[..., Awaitable[Any]], depends_on: Iterable[str] = ()) -> "StageGraph":
+        """
+        Add a stage to the graph
+
+        Args:
+            name: Stage name, also the keyword its result is passed to dependents under
+            fn: Coroutine function called with the results of its dependencies
+            depends_on: Names of stages that must finish first; they must already be added
+
+        Returns:
+            The graph, for chaining
+        """
+        if name in self.stages:
+            raise ValueError(f"Stage '{name}' is already defined")
+        depends_on = list(depends_on)
+        for dependency in depends_on:
+            # Requiring dependencies to exist keeps the graph acyclic
+            if dependency not in self.stages:
+                raise ValueError(f"Stage '{name}' depends on unknown stage '{dependency}'")
+        self.stages[name] = Stage(name, fn, depends_on)
+        return self
+
+    async def _run_stage(self, stage: Stage, tasks: Dict[str, asyncio.Task], started: float) -> Any:
+        dependencies = {dependency: await tasks[dependency] for dependency in stage.depends_on}
+
+        start = time.monotonic()
+        status = "ok"
+        try:
+            return await stage.fn(**dependencies)
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        except Exception:
+            status = "failed"
+            raise
+        finally:
+            end = time.monotonic()
+            self.timings[stage.name] = {
+                "status": status,
+                "start": round(start - started, 4),
+                "end": round(end - started, 4),
+                "duration": round(end - start, 4)
+            }
+            stage_timing_stats.record(stage.name, status, end - start)
+
+    async def run(self) -> Dict[str, Any]:
+        """
+        Run every stage of the graph
+
+        Returns:
+            The result of each stage by name
+        """
+        started = time.monotonic()
+        tasks: Dict[str, asyncio.Task] = {}
+        for name, stage in self.stages.items():
+            tasks[name] = asyncio.ensure_future(self._run_stage(stage, tasks, started))
+
+        try:
+            done, pending = await asyncio.wait(tasks.values(), return_when=asyncio.FIRST_EXCEPTION)
+            failed = next((task for task in done if not task.cancelled() and task.exception() is not None), None)
+            if failed is not None:
+                raise failed.exception()
+        finally:
+            # Cancel whatever is left after a failure, or when the caller itself was cancelled
+            for task in tasks.values():
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            logger.info(f"{self.name} stage timings: {self.timings}")
+
+        return {name: task.result() for name, task in tasks.items()}
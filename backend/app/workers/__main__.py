@@ -0,0 +1,10 @@
+# Evaluation worker: python -m app.workers
+# Runs queued evaluations when EVALUATION_DISPATCH=queue; start as many as needed, on any node.
+import asyncio
+import logging
+
+from app.workers.evaluation_worker import main
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    asyncio.run(main())
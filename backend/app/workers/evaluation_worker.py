@@ -0,0 +1,282 @@
+import os
+import json
+import signal
+import socket
+import asyncio
+import logging
+from typing import Dict, Any, Set, Optional
+from dotenv import load_dotenv
+
+from app.db.database import SessionLocal
+from app.db.models import WorkerStatus
+from app.services.evaluation_jobs import EvaluationJobQueue, ClaimedJob, evaluation_job_queue, process_evaluation
+from app.services.problem_artifacts import problem_artifact_store
+from app.services.near_duplicate_service import near_duplicate_index
+from app.utils.llm_budgets import llm_prompt_cache, cache_attribution_scope
+from app.utils.llm_utils import init_llm_session, close_llm_session
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Worker configuration
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "4"))
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "2"))
+WORKER_HEARTBEAT_INTERVAL = float(os.getenv("WORKER_HEARTBEAT_INTERVAL", "15"))
+WORKER_RECOVERY_INTERVAL = float(os.getenv("WORKER_RECOVERY_INTERVAL", "60"))
+# Problem-affinity batching: after claiming a job, keep claiming jobs of the
+# same problem for up to this many jobs or seconds; 1 job disables batching
+WORKER_BATCH_MAX_SIZE = int(os.getenv("WORKER_BATCH_MAX_SIZE", "8"))
+WORKER_BATCH_MAX_DELAY = float(os.getenv("WORKER_BATCH_MAX_DELAY", "5"))
+WORKER_STATUS_INTERVAL = float(os.getenv("WORKER_STATUS_INTERVAL", "30"))
+
+class AffinityBatch:
+    """Jobs of one problem claimed back to back by a worker"""
+
+    def __init__(self, problem_id: int, started_at: float):
+        self.problem_id = problem_id
+        self.started_at = started_at
+        self.size = 1
+
+class AffinityBatchStats:
+    """Problem-affinity batch sizes and the provider prompt cache hits they produce"""
+
+    def __init__(self):
+        self.batches = 0
+        self.jobs = 0
+        self.max_size = 0
+        self.sizes: Dict[int, int] = {}
+        self.closed: Dict[str, int] = {}
+
+    def record(self, batch: AffinityBatch, reason: str) -> None:
+        self.batches += 1
+        self.jobs += batch.size
+        self.max_size = max(self.max_size, batch.size)
+        self.sizes[batch.size] = self.sizes.get(batch.size, 0) + 1
+        self.closed[reason] = self.closed.get(reason, 0) + 1
+
+    def get_metrics(self) -> Dict[str, Any]:
+        # Calls of a batch's first job warm the provider cache for the rest
+        attribution = llm_prompt_cache.get_attribution_metrics()
+        first = attribution.get("batch_first", {})
+        followup = attribution.get("batch_followup", {})
+        return {
+            "batches": self.batches,
+            "jobs": self.jobs,
+            "avg_size": self.jobs / self.batches if self.batches else 0.0,
+            "max_size": self.max_size,
+            "sizes": {str(size): count for size, count in sorted(self.sizes.items())},
+            "closed": dict(self.closed),
+            "prompt_cache": {
+                "first_job": first,
+                "followup_jobs": followup,
+                "hit_rate_improvement": followup.get("hit_rate", 0.0) - first.get("hit_rate", 0.0),
+                "cached_token_ratio_improvement": (
+                    followup.get("cached_token_ratio", 0.0) - first.get("cached_token_ratio", 0.0)
+                )
+            }
+        }
+
+class EvaluationWorker:
+    """
+    Claims evaluation jobs from the queue and runs them, up to a fixed number
+    at a time, each with its own database session
+
+    On stop, no new jobs are claimed and running ones are allowed to finish;
+    jobs interrupted by a crash are requeued by whichever worker next runs
+    recovery, once their heartbeat is stale.
+
+    Jobs are claimed in problem-affinity batches: after a claim, the worker
+    keeps claiming jobs of the same problem while there are any, for at most
+    batch_max_size jobs and batch_max_delay seconds, so their prompts hit
+    the provider cache and the problem caches of this process. Other
+    problems' jobs wait at most batch_max_delay longer than they would have.
+    Metrics are written to the worker_status table for the API to serve.
+    """
+
+    def __init__(
+        self,
+        queue: EvaluationJobQueue = evaluation_job_queue,
+        concurrency: int = WORKER_CONCURRENCY,
+        worker_id: Optional[str] = None,
+        batch_max_size: int = WORKER_BATCH_MAX_SIZE,
+        batch_max_delay: float = WORKER_BATCH_MAX_DELAY
+    ):
+        self.queue = queue
+        self.concurrency = max(1, concurrency)
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.batch_max_size = max(1, batch_max_size)
+        self.batch_max_delay = max(0.0, batch_max_delay)
+        self._running: Set[asyncio.Task] = set()
+        self._stopping = asyncio.Event()
+        self._batch: Optional[AffinityBatch] = None
+        self.batch_stats = AffinityBatchStats()
+        self.completed = 0
+        self.failed = 0
+
+    def stop(self) -> None:
+        if not self._stopping.is_set():
+            logger.info(f"Worker {self.worker_id} stopping, waiting for {len(self._running)} running jobs")
+            self._stopping.set()
+
+    async def _sleep(self, seconds: float) -> None:
+        # Returns early when the worker is stopped
+        try:
+            await asyncio.wait_for(self._stopping.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _heartbeat(self, job: ClaimedJob) -> None:
+        while True:
+            await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+            try:
+                if not await asyncio.to_thread(self.queue.heartbeat, job.job_id, self.worker_id):
+                    logger.warning(f"Job {job.job_id} was taken over by another worker")
+                    return
+            except Exception as e:
+                logger.error(f"Error heartbeating job {job.job_id}: {str(e)}")
+
+    async def _run_job(self, job: ClaimedJob, followup: bool = False) -> None:
+        logger.info(f"Running job {job.job_id} for submission {job.submission_id} (attempt {job.attempts}/{job.max_attempts})")
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        db = SessionLocal()
+        try:
+            with cache_attribution_scope("batch_followup" if followup else "batch_first"):
+                await process_evaluation(
+                    job.submission_id,
+                    job.problem_id,
+                    job.code,
+                    job.language,
+                    db,
+                    regrade=job.regrade,
+                    user_id=job.user_id,
+                    evaluation_mode=job.evaluation_mode,
+                    retryable=True
+                )
+        except Exception as e:
+            self.failed += 1
+            await asyncio.to_thread(self.queue.fail, job.job_id, self.worker_id, str(e))
+        else:
+            self.completed += 1
+            await asyncio.to_thread(self.queue.complete, job.job_id, self.worker_id)
+        finally:
+            heartbeat.cancel()
+            db.close()
+
+    def _close_batch(self, reason: str) -> None:
+        if self._batch is not None:
+            self.batch_stats.record(self._batch, reason)
+            self._batch = None
+
+    def _claim(self, now: float) -> Optional[ClaimedJob]:
+        """
+        Claim the next job of the open batch's problem, or else any job,
+        which opens a new batch
+        """
+        batch = self._batch
+        if batch is not None:
+            if batch.size >= self.batch_max_size:
+                self._close_batch("full")
+            elif now - batch.started_at >= self.batch_max_delay:
+                self._close_batch("expired")
+            else:
+                job = self.queue.claim(self.worker_id, problem_id=batch.problem_id)
+                if job is not None:
+                    batch.size += 1
+                    return job
+                self._close_batch("drained")
+
+        job = self.queue.claim(self.worker_id)
+        if job is not None and self.batch_max_size > 1:
+            self._batch = AffinityBatch(job.problem_id, now)
+        return job
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "concurrency": self.concurrency,
+            "running": len(self._running),
+            "completed": self.completed,
+            "failed": self.failed,
+            "batch_max_size": self.batch_max_size,
+            "batch_max_delay_seconds": self.batch_max_delay,
+            "batching": self.batch_stats.get_metrics()
+        }
+
+    def _write_status(self) -> None:
+        db = SessionLocal()
+        try:
+            db.merge(WorkerStatus(worker_id=self.worker_id, metrics=json.dumps(self.get_metrics())))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def _report(self) -> None:
+        try:
+            await asyncio.to_thread(self._write_status)
+        except Exception as e:
+            logger.error(f"Error writing worker status: {str(e)}")
+
+    async def _recover(self) -> None:
+        try:
+            await asyncio.to_thread(self.queue.recover)
+        except Exception as e:
+            logger.error(f"Error recovering evaluation jobs: {str(e)}")
+
+    async def run(self) -> None:
+        """
+        Claim and run jobs until stopped
+        """
+        await init_llm_session()
+        await problem_artifact_store.warm()
+        warm_near_duplicates = asyncio.create_task(near_duplicate_index.warm())
+        logger.info(f"Worker {self.worker_id} started with concurrency {self.concurrency}")
+
+        loop = asyncio.get_running_loop()
+        next_recovery = loop.time()
+        next_report = loop.time()
+        try:
+            while not self._stopping.is_set():
+                if loop.time() >= next_recovery:
+                    await self._recover()
+                    next_recovery = loop.time() + WORKER_RECOVERY_INTERVAL
+                if loop.time() >= next_report:
+                    await self._report()
+                    next_report = loop.time() + WORKER_STATUS_INTERVAL
+
+                if len(self._running) >= self.concurrency:
+                    await asyncio.wait(self._running, timeout=WORKER_POLL_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+
+                try:
+                    batch = self._batch
+                    job = await asyncio.to_thread(self._claim, loop.time())
+                except Exception as e:
+                    logger.error(f"Error claiming evaluation job: {str(e)}")
+                    job = None
+                if job is None:
+                    await self._sleep(WORKER_POLL_INTERVAL)
+                    continue
+
+                followup = batch is not None and self._batch is batch
+                task = asyncio.create_task(self._run_job(job, followup=followup))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+        finally:
+            if self._running:
+                await asyncio.gather(*self._running, return_exceptions=True)
+            self._close_batch("stopped")
+            await self._report()
+            warm_near_duplicates.cancel()
+            await close_llm_session()
+            logger.info(f"Worker {self.worker_id} stopped")
+
+async def main() -> None:
+    worker = EvaluationWorker()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+    await worker.run()
@@ -0,0 +1,196 @@
+# Description: Benchmarks the fused evaluation mode against the multi-agent mode.
+# Every selected submission is graded by both modes, sequentially so that the latency
+# and token usage of each call can be attributed to its mode. The report compares
+# score agreement, approach agreement, latency and token cost.
+#
+# Usage: python benchmark_evaluation_modes.py [--problem-id 1 --problem-id 2] [--limit 20] [--output report.json]
+import sys
+import os
+import json
+import time
+import asyncio
+import argparse
+import statistics
+from typing import Dict, List, Any, Optional
+
+# Add the current directory to the system path
+sys.path.append(os.getcwd())
+
+# Measure cold calls: without this, the second mode could be served by the LLM response cache
+if "--warm-cache" not in sys.argv:
+    os.environ["LLM_CACHE_ENABLED"] = "false"
+
+from app.db.database import SessionLocal
+from app.db.models import Problem, Submission, EvaluationStatus
+from app.services.evaluation_service import EvaluationService, EvaluationRequest, EVALUATION_MODES
+from app.utils.llm_budgets import llm_token_usage
+from app.utils.llm_utils import init_llm_session, close_llm_session
+from app.utils.sanitizer import secure_student_code
+
+def _token_totals() -> Dict[str, int]:
+    totals = {"calls": 0, "prompt_tokens": 0, "output_tokens": 0}
+    for stats in llm_token_usage.get_metrics().values():
+        totals["calls"] += stats["calls"]
+        totals["prompt_tokens"] += stats["billed_prompt_tokens"]
+        totals["output_tokens"] += stats["used_tokens"]
+    return totals
+
+def _load_submissions(problem_ids: List[int], limit: int) -> List[Dict[str, Any]]:
+    db = SessionLocal()
+    try:
+        problems = db.query(Problem)
+        if problem_ids:
+            problems = problems.filter(Problem.id.in_(problem_ids))
+
+        selected = []
+        for problem in problems.all():
+            submissions = db.query(Submission).filter(
+                Submission.problem_id == problem.id,
+                Submission.evaluation_status == EvaluationStatus.completed
+            ).order_by(Submission.id.desc()).limit(limit).all()
+            for submission in submissions:
+                selected.append({
+                    "problem_id": problem.id,
+                    "problem_statement": problem.problem_description,
+                    "rubric": problem.rubric,
+                    "submission_id": submission.id,
+                    "code": submission.code,
+                    "language": submission.language
+                })
+        return selected
+    finally:
+        db.close()
+
+async def _run_mode(service: EvaluationService, request: EvaluationRequest, mode: str) -> Dict[str, Any]:
+    """
+    Grade one submission in one mode, bypassing the result cache and the near-duplicate index
+    """
+    artifacts = service.artifact_store.get(request.problem_statement, request.rubric, problem_id=request.problem_id)
+    code = secure_student_code(request.student_code)
+
+    tokens_before = _token_totals()
+    started = time.perf_counter()
+    if mode == "fused":
+        approach, evaluation = await service._evaluate_fused(request, artifacts, code)
+    else:
+        approach, evaluation = await service._evaluate_multi_agent(request, artifacts, code)
+    elapsed = time.perf_counter() - started
+    tokens_after = _token_totals()
+
+    response = service._build_response(artifacts, approach, evaluation)
+    return {
+        "approach": approach,
+        "score": response.score,
+        "max_score": response.max_score,
+        "points": {point_id: item.points_awarded for point_id, item in response.feedback.items()},
+        "error": evaluation.get("error"),
+        "seconds": elapsed,
+        **{key: tokens_after[key] - tokens_before[key] for key in tokens_before}
+    }
+
+def _summarize(results: List[Dict[str, Any]], modes: List[str]) -> Dict[str, Any]:
+    summary: Dict[str, Any] = {"submissions": len(results), "modes": {}}
+    for mode in modes:
+        runs = [result[mode] for result in results]
+        seconds = sorted(run["seconds"] for run in runs)
+        summary["modes"][mode] = {
+            "errors": sum(1 for run in runs if run["error"]),
+            "avg_seconds": statistics.mean(seconds) if seconds else 0.0,
+            "p50_seconds": seconds[len(seconds) // 2] if seconds else 0.0,
+            "p95_seconds": seconds[min(len(seconds) - 1, int(len(seconds) * 0.95))] if seconds else 0.0,
+            "avg_calls": statistics.mean(run["calls"] for run in runs) if runs else 0.0,
+            "avg_prompt_tokens": statistics.mean(run["prompt_tokens"] for run in runs) if runs else 0.0,
+            "avg_output_tokens": statistics.mean(run["output_tokens"] for run in runs) if runs else 0.0
+        }
+
+    if len(modes) == 2:
+        first, second = modes
+        # Only submissions graded without error by both modes are compared
+        pairs = [(result[first], result[second]) for result in results if not result[first]["error"] and not result[second]["error"]]
+        same_approach = [(a, b) for a, b in pairs if a["approach"] == b["approach"]]
+        criteria = [
+            a["points"].get(point_id) == points
+            for a, b in same_approach
+            for point_id, points in b["points"].items()
+        ]
+        differences = [abs(a["score"] - b["score"]) for a, b in pairs]
+        summary["agreement"] = {
+            "compared": len(pairs),
+            "approach_agreement": len(same_approach) / len(pairs) if pairs else 0.0,
+            "exact_score_agreement": sum(1 for d in differences if d == 0) / len(pairs) if pairs else 0.0,
+            "within_one_point": sum(1 for d in differences if d <= 1) / len(pairs) if pairs else 0.0,
+            "mean_abs_score_difference": statistics.mean(differences) if differences else 0.0,
+            "criterion_agreement": sum(criteria) / len(criteria) if criteria else 0.0
+        }
+    return summary
+
+def _print_summary(summary: Dict[str, Any]) -> None:
+    print(f"\nSubmissions: {summary['submissions']}")
+    print(f"{'mode':<12} {'errors':>6} {'avg s':>8} {'p50 s':>8} {'p95 s':>8} {'calls':>6} {'prompt tok':>11} {'output tok':>11}")
+    for mode, stats in summary["modes"].items():
+        print(
+            f"{mode:<12} {stats['errors']:>6} {stats['avg_seconds']:>8.2f} {stats['p50_seconds']:>8.2f} "
+            f"{stats['p95_seconds']:>8.2f} {stats['avg_calls']:>6.1f} {stats['avg_prompt_tokens']:>11.0f} "
+            f"{stats['avg_output_tokens']:>11.0f}"
+        )
+    if "agreement" in summary:
+        print("\nAgreement:")
+        for key, value in summary["agreement"].items():
+            print(f"  {key}: {value:.3f}" if isinstance(value, float) else f"  {key}: {value}")
+
+async def run_benchmark(
+    problem_ids: List[int],
+    limit: int,
+    modes: List[str],
+    output: Optional[str] = None
+) -> Dict[str, Any]:
+    submissions = _load_submissions(problem_ids, limit)
+    print(f"Benchmarking {len(submissions)} submissions in modes: {', '.join(modes)}")
+
+    service = EvaluationService()
+    await init_llm_session()
+    try:
+        # Guidance is precomputed per problem in production, so it is not charged to the multi-agent mode
+        if "multi_agent" in modes:
+            for problem_id in sorted({submission["problem_id"] for submission in submissions}):
+                await service.guidance_store.precompute(problem_id)
+
+        results = []
+        for i, submission in enumerate(submissions):
+            request = EvaluationRequest(
+                problem_statement=submission["problem_statement"],
+                rubric=submission["rubric"],
+                student_code=submission["code"],
+                language=submission["language"],
+                problem_id=submission["problem_id"]
+            )
+            result = {"problem_id": submission["problem_id"], "submission_id": submission["submission_id"]}
+            for mode in modes:
+                result[mode] = await _run_mode(service, request, mode)
+            results.append(result)
+            print(
+                f"[{i + 1}/{len(submissions)}] submission {submission['submission_id']}: "
+                + ", ".join(f"{mode} {result[mode]['score']}/{result[mode]['max_score']} ({result[mode]['seconds']:.1f}s)" for mode in modes)
+            )
+    finally:
+        await close_llm_session()
+
+    summary = _summarize(results, modes)
+    _print_summary(summary)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump({"summary": summary, "results": results}, f, indent=2)
+        print(f"\nReport written to {output}")
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the fused and multi-agent evaluation modes on graded submissions")
+    parser.add_argument("--problem-id", type=int, action="append", default=[], help="Problem to benchmark, repeatable; all problems by default")
+    parser.add_argument("--limit", type=int, default=20, help="Most recent graded submissions per problem")
+    parser.add_argument("--mode", action="append", choices=EVALUATION_MODES, help="Mode to run, repeatable; both by default")
+    parser.add_argument("--output", help="Write the full report as JSON to this path")
+    parser.add_argument("--warm-cache", action="store_true", help="Keep the LLM response cache enabled")
+    args = parser.parse_args()
+
+    asyncio.run(run_benchmark(args.problem_id, args.limit, args.mode or list(EVALUATION_MODES), args.output))
@@ -1,23 +1,47 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
+import asyncio
 from dotenv import load_dotenv
 import os
 
 from app.api.config import api_router
 from app.db.database import engine
 from app.db import models
+from app.utils.llm_utils import init_llm_session, close_llm_session
+from app.services.problem_artifacts import problem_artifact_store
+from app.services.near_duplicate_service import near_duplicate_index
+from app.services.evaluation_executor import evaluation_executor
 
 # Load environment variables
 load_dotenv()
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Application lifespan: create shared resources at startup and release them on shutdown
+    """
+    await init_llm_session()
+    # Parse and format every problem's rubric before the first submission arrives
+    await problem_artifact_store.warm()
+    # Index graded submissions without delaying startup
+    warm_near_duplicates = asyncio.create_task(near_duplicate_index.warm())
+    try:
+        yield
+    finally:
+        warm_near_duplicates.cancel()
+        # Let running evaluations finish while the LLM session is still open
+        await evaluation_executor.shutdown()
+        await close_llm_session()
 
 # Initialize FastAPI app
 app = FastAPI(
     title="Code Evaluation System",
     description="API for automated code evaluation using LLMs",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Configure CORS
@@ -0,0 +1,151 @@
+import os
+import json
+import tempfile
+from typing import Any, Dict, List, Optional
+
+import pytest
+
+# Configuration read at import time by the app modules
+_tmp = tempfile.mkdtemp(prefix="code-evaluator-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_tmp, 'test.db')}")
+os.environ.setdefault("LLM_API_KEY", "test-key")
+os.environ.setdefault("LLM_CACHE_PATH", "")
+os.environ.setdefault("LLM_HEDGE_ENABLED", "false")
+os.environ.setdefault("LLM_RETRY_BASE_DELAY", "0")
+os.environ.setdefault("LLM_RETRY_MAX_DELAY", "0")
+
+def sse(*deltas: str, usage: Optional[Dict[str, Any]] = None) -> List[bytes]:
+    """Server-sent event lines of a streamed chat completion"""
+    lines = [
+        f"data: {json.dumps({'choices': [{'delta': {'content': delta}}]})}\n".encode("utf-8")
+        for delta in deltas
+    ]
+    if usage is not None:
+        lines.append(f"data: {json.dumps({'choices': [], 'usage': usage})}\n".encode("utf-8"))
+    lines.append(b"data: [DONE]\n")
+    return lines
+
+class FakeContent:
+    def __init__(self, lines: List[bytes]):
+        self.lines = lines
+        self.read = 0
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for line in self.lines:
+            self.read += 1
+            yield line
+
+class FakeResponse:
+    """An aiohttp response with a fixed status and body or event stream"""
+
+    def __init__(
+        self,
+        status: int = 200,
+        body: Optional[Dict[str, Any]] = None,
+        lines: Optional[List[bytes]] = None,
+        headers: Optional[Dict[str, str]] = None
+    ):
+        self.status = status
+        self.body = body or {}
+        self.content = FakeContent(lines or [])
+        self.headers = headers or {}
+        self.closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def text(self) -> str:
+        return json.dumps(self.body)
+
+    async def json(self) -> Dict[str, Any]:
+        return self.body
+
+    def close(self) -> None:
+        self.closed = True
+
+def completion(content: str, usage: Optional[Dict[str, Any]] = None) -> FakeResponse:
+    """A non-streamed chat completion response"""
+    return FakeResponse(body={"choices": [{"message": {"content": content}}], "usage": usage or {}})
+
+class FakeSession:
+    """Serves queued responses in order and records the request payloads"""
+
+    def __init__(self):
+        self.responses: List[FakeResponse] = []
+        self.payloads: List[Dict[str, Any]] = []
+
+    def post(self, url: str, headers=None, json=None, timeout=None) -> FakeResponse:
+        self.payloads.append(json)
+        return self.responses.pop(0)
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    """
+    Replace the LLM HTTP session, response cache, coalescing and circuit
+    breakers with fresh instances; queue responses on the returned session
+    """
+    from app.utils import llm_utils
+    from app.utils.llm_cache import LLMResponseCache
+    from app.utils.llm_resilience import CircuitBreakerRegistry
+    from app.utils.single_flight import SingleFlight
+
+    session = FakeSession()
+
+    async def get_llm_session():
+        return session
+
+    monkeypatch.setattr(llm_utils, "get_llm_session", get_llm_session)
+    monkeypatch.setattr(llm_utils, "llm_cache", LLMResponseCache())
+    monkeypatch.setattr(llm_utils, "llm_single_flight", SingleFlight())
+    monkeypatch.setattr(llm_utils, "llm_circuit_breakers", CircuitBreakerRegistry(failure_threshold=5, recovery_timeout=30))
+    return session
+
+@pytest.fixture
+def db():
+    """A session on freshly created tables, dropped again afterwards"""
+    from app.db.models import Base
+    from app.db.database import SessionLocal, engine
+
+    Base.metadata.create_all(bind=engine)
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+        Base.metadata.drop_all(bind=engine)
+
+@pytest.fixture
+def graded_submission(db):
+    """A completed submission with two graded criteria; returns its ID"""
+    from app.db.models import User, Problem, Submission, EvaluationDetail, EvaluationStatus
+
+    user = User(email="student@example.com", hashed_password="x")
+    problem = Problem(
+        title="Two Sum",
+        problem_description="Find two numbers that add up to a target.",
+        rubric="Solution 1: Hash map\n1. Uses a hash map (2 marks)\n2. Returns the indices (1 mark)"
+    )
+    db.add_all([user, problem])
+    db.flush()
+    submission = Submission(
+        user_id=user.id,
+        problem_id=problem.id,
+        code="class Solution {}",
+        language="java",
+        total_score=2,
+        evaluation_status=EvaluationStatus.completed
+    )
+    db.add(submission)
+    db.flush()
+    db.add_all([
+        EvaluationDetail(submission_id=submission.id, criterion_index=1, max_score=2, score_obtained=2, feedback="Uses a map"),
+        EvaluationDetail(submission_id=submission.id, criterion_index=2, max_score=1, score_obtained=0, feedback="Wrong indices")
+    ])
+    db.commit()
+    return submission.id
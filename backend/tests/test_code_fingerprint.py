@@ -0,0 +1,72 @@
+from app.utils.code_fingerprint import code_fingerprint, normalize_code
+
+
+def test_python_builtins_are_not_renamed():
+    uses_any = "def check(xs):\n    return any(x > 0 for x in xs)\n"
+    uses_all = "def check(xs):\n    return all(x > 0 for x in xs)\n"
+
+    assert code_fingerprint(uses_any, "python") != code_fingerprint(uses_all, "python")
+
+
+def test_python_renamed_variables_share_a_fingerprint():
+    original = "def total(nums):\n    s = 0\n    for n in nums:\n        s += n\n    return s\n"
+    renamed = "def add_up(values):  # sum them\n    acc = 0\n    for v in values:\n        acc += v\n    return acc\n"
+
+    assert code_fingerprint(original, "python") == code_fingerprint(renamed, "python")
+
+
+def test_python_unbound_and_imported_names_are_kept():
+    tokens = normalize_code("import math\nresult = math.sqrt(helper(x))\n", "python")
+
+    assert "math" in tokens
+    assert "helper" in tokens
+    assert "x" in tokens
+    assert "result" not in tokens
+
+
+def test_python_that_does_not_parse_is_not_renamed():
+    tokens = normalize_code("def broken(:\n    return value", "python")
+
+    assert "broken" in tokens
+    assert "value" in tokens
+
+
+def test_java_library_calls_are_not_renamed():
+    uses_max = "int best(int a, int b) { return Math.max(a, b); }"
+    uses_min = "int best(int a, int b) { return Math.min(a, b); }"
+    calls_sum = "int best(int[] xs) { return sum(xs); }"
+    calls_count = "int best(int[] xs) { return count(xs); }"
+
+    assert code_fingerprint(uses_max) != code_fingerprint(uses_min)
+    assert code_fingerprint(calls_sum) != code_fingerprint(calls_count)
+
+
+def test_java_declarations_are_renamed():
+    original = """
+    public int maxSum(int[] nums) {
+        int best = 0;
+        for (int x : nums) { best = Math.max(best, x); }
+        List<Integer> seen = new ArrayList<>();
+        nums.forEach(y -> seen.add(y));
+        return best;
+    }
+    """
+    renamed = """
+    // different names, same solution
+    public int solve(int[] arr) {
+        int res = 0;
+        for (int v : arr) { res = Math.max(res, v); }
+        List<Integer> out = new ArrayList<>();
+        arr.forEach(e -> out.add(e));
+        return res;
+    }
+    """
+
+    assert code_fingerprint(original) == code_fingerprint(renamed)
+
+
+def test_java_lambda_body_calls_are_kept():
+    tokens = normalize_code("items.forEach(item -> print(item));")
+
+    assert "print" in tokens
+    assert "item" not in tokens
@@ -0,0 +1,156 @@
+import asyncio
+
+import pytest
+
+from app.services import evaluation_executor as executor_module
+from app.services.evaluation_executor import EvaluationExecutor, EvaluationTask, ExecutorSaturated
+
+
+class FakeEvaluations:
+    """Stands in for process_evaluation; each evaluation runs until released"""
+
+    def __init__(self):
+        self.started = []
+        self.gates = {}
+
+    async def __call__(self, submission_id, problem_id, code, language, db, regrade=False, user_id=None, evaluation_mode=None):
+        self.started.append((submission_id, regrade))
+        gate = self.gates[len(self.started) - 1] = asyncio.Event()
+        await gate.wait()
+
+    async def release(self, index):
+        self.gates[index].set()
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+
+@pytest.fixture
+def evaluations(monkeypatch):
+    fake = FakeEvaluations()
+    monkeypatch.setattr(executor_module, "process_evaluation", fake)
+    return fake
+
+
+def task(submission_id, user_id=1, regrade=False, evaluation_mode=None):
+    return EvaluationTask(
+        submission_id=submission_id,
+        problem_id=1,
+        code="class Solution {}",
+        language="java",
+        user_id=user_id,
+        regrade=regrade,
+        evaluation_mode=evaluation_mode
+    )
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def test_resubmitting_a_waiting_submission_updates_it(evaluations):
+    executor = EvaluationExecutor(max_in_flight=1, max_in_flight_per_user=1)
+    executor.submit(task(1))
+    assert executor.submit(task(2)) == 1
+    assert executor.submit(task(2, regrade=True, evaluation_mode="fused")) == 1
+    assert executor.queue_length == 1
+
+    await settle()
+    await evaluations.release(0)
+    assert evaluations.started == [(1, False), (2, True)]
+    await evaluations.release(1)
+
+
+async def test_a_running_submission_is_not_evaluated_twice_at_once(evaluations):
+    executor = EvaluationExecutor(max_in_flight=4, max_in_flight_per_user=4)
+    executor.submit(task(1))
+    await settle()
+
+    # A plain resubmission is served by the running evaluation
+    assert executor.submit(task(1)) == 0
+    # Regrades while it runs collapse into one follow-up
+    assert executor.submit(task(1, regrade=True)) == 0
+    assert executor.submit(task(1, regrade=True)) == 0
+    await settle()
+    assert evaluations.started == [(1, False)]
+    assert executor.get_metrics()["follow_ups"] == 1
+
+    await evaluations.release(0)
+    assert evaluations.started == [(1, False), (1, True)]
+    await evaluations.release(1)
+    assert executor.in_flight == 0
+    assert executor.get_metrics()["follow_ups"] == 0
+
+
+async def test_submissions_beyond_the_queue_are_refused(evaluations):
+    executor = EvaluationExecutor(max_in_flight=1, max_queued=1, max_queued_per_user=5)
+    executor.submit(task(1, user_id=1))
+    executor.submit(task(2, user_id=2))
+
+    with pytest.raises(ExecutorSaturated) as refused:
+        executor.submit(task(3, user_id=3))
+    assert not refused.value.per_user
+    assert refused.value.retry_after >= 1
+
+    await settle()
+    await evaluations.release(0)
+    await evaluations.release(1)
+
+
+
+async def test_the_queue_limit_holds_while_per_user_limits_leave_slots_free(evaluations):
+    executor = EvaluationExecutor(max_in_flight=4, max_queued=1, max_in_flight_per_user=1, max_queued_per_user=5)
+    executor.submit(task(1, user_id=1))
+    assert executor.submit(task(2, user_id=1)) == 1
+
+    with pytest.raises(ExecutorSaturated) as refused:
+        executor.submit(task(3, user_id=1))
+    assert not refused.value.per_user
+    # Another user's evaluation starts right away, so it is not refused
+    assert executor.submit(task(4, user_id=2)) == 0
+
+    await settle()
+    for index in range(3):
+        await evaluations.release(index)
+
+async def test_a_user_flooding_the_executor_only_delays_themselves(evaluations):
+    executor = EvaluationExecutor(max_in_flight=1, max_in_flight_per_user=1)
+    for submission_id in (1, 2, 3):
+        executor.submit(task(submission_id, user_id=1))
+    assert executor.submit(task(4, user_id=2)) == 1
+    assert executor.position(2) == 2
+
+    await settle()
+    for index in range(4):
+        await evaluations.release(index)
+    assert [submission_id for submission_id, _ in evaluations.started] == [1, 4, 2, 3]
+
+
+async def test_regrades_yield_to_first_evaluations(evaluations):
+    executor = EvaluationExecutor(max_in_flight=1, max_in_flight_per_user=1)
+    executor.submit(task(1, user_id=1))
+    executor.submit(task(2, user_id=2, regrade=True))
+    executor.submit(task(3, user_id=3, regrade=True))
+    executor.submit(task(4, user_id=4))
+    executor.submit(task(5, user_id=5))
+
+    await settle()
+    for index in range(5):
+        await evaluations.release(index)
+    # Regrades share one flow at half weight
+    assert [submission_id for submission_id, _ in evaluations.started] == [1, 4, 5, 2, 3]
+
+
+async def test_a_user_may_only_hold_a_share_of_the_queue(evaluations):
+    executor = EvaluationExecutor(max_in_flight=1, max_queued=10, max_in_flight_per_user=1, max_queued_per_user=2)
+    for submission_id in (1, 2, 3):
+        executor.submit(task(submission_id, user_id=1))
+
+    with pytest.raises(ExecutorSaturated) as refused:
+        executor.submit(task(4, user_id=1))
+    assert refused.value.per_user
+    assert executor.submit(task(5, user_id=2)) == 1
+
+    await settle()
+    for index in range(4):
+        await evaluations.release(index)
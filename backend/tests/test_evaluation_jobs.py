@@ -0,0 +1,110 @@
+import datetime
+
+from app.db.models import User, Problem, Submission, EvaluationJob, JobStatus
+from app.services.evaluation_jobs import EvaluationJobQueue
+
+
+def add_submissions(db, emails):
+    problem = Problem(title="Two Sum", problem_description="Find two numbers.", rubric="Solution 1: Hash map")
+    db.add(problem)
+    db.flush()
+    submissions = []
+    for email in emails:
+        user = User(email=email, hashed_password="x")
+        db.add(user)
+        db.flush()
+        submission = Submission(user_id=user.id, problem_id=problem.id, code="class Solution {}", language="java")
+        db.add(submission)
+        db.flush()
+        submissions.append(submission)
+    db.commit()
+    return submissions
+
+
+def jobs_of(db, submission_id):
+    db.expire_all()
+    return db.query(EvaluationJob).filter(EvaluationJob.submission_id == submission_id).order_by(EvaluationJob.id).all()
+
+
+def test_enqueue_updates_a_waiting_job(db):
+    queue = EvaluationJobQueue()
+    submission, = add_submissions(db, ["a@example.com"])
+
+    queue.enqueue(db, submission.id, user_id=submission.user_id)
+    queue.enqueue(db, submission.id, user_id=submission.user_id, regrade=True)
+
+    jobs = jobs_of(db, submission.id)
+    assert len(jobs) == 1
+    assert jobs[0].regrade
+
+
+def test_enqueue_while_running_only_queues_a_regrade(db):
+    queue = EvaluationJobQueue()
+    submission, = add_submissions(db, ["a@example.com"])
+    queue.enqueue(db, submission.id, user_id=submission.user_id)
+    claimed = queue.claim("worker-1")
+
+    running = queue.enqueue(db, submission.id, user_id=submission.user_id)
+    assert running.id == claimed.job_id
+    assert len(jobs_of(db, submission.id)) == 1
+
+    queue.enqueue(db, submission.id, user_id=submission.user_id, regrade=True)
+    queue.enqueue(db, submission.id, user_id=submission.user_id, regrade=True)
+    statuses = [job.status for job in jobs_of(db, submission.id)]
+    assert statuses == [JobStatus.running, JobStatus.queued]
+
+
+def test_follow_up_waits_for_the_running_job(db):
+    queue = EvaluationJobQueue(max_running_per_user=0)
+    submission, = add_submissions(db, ["a@example.com"])
+    queue.enqueue(db, submission.id, user_id=submission.user_id)
+    first = queue.claim("worker-1")
+    queue.enqueue(db, submission.id, user_id=submission.user_id, regrade=True)
+
+    assert queue.claim("worker-2") is None
+
+    queue.complete(first.job_id, "worker-1")
+    follow_up = queue.claim("worker-2")
+    assert follow_up is not None
+    assert follow_up.regrade
+    assert follow_up.job_id != first.job_id
+
+
+def test_claim_prefers_users_with_fewer_running_jobs(db):
+    queue = EvaluationJobQueue(max_running_per_user=2)
+    busy_first, busy_second, other = add_submissions(db, ["busy@example.com", "busy2@example.com", "other@example.com"])
+    busy_second.user_id = busy_first.user_id
+    db.commit()
+    for submission in (busy_first, busy_second, other):
+        queue.enqueue(db, submission.id, user_id=submission.user_id)
+
+    assert queue.claim("worker-1").submission_id == busy_first.id
+    assert queue.claim("worker-2").submission_id == other.id
+    assert queue.claim("worker-3").submission_id == busy_second.id
+
+
+def test_claim_skips_users_at_their_running_limit(db):
+    queue = EvaluationJobQueue(max_running_per_user=1)
+    first, second = add_submissions(db, ["a@example.com", "b@example.com"])
+    second.user_id = first.user_id
+    db.commit()
+    for submission in (first, second):
+        queue.enqueue(db, submission.id, user_id=submission.user_id)
+
+    claimed = queue.claim("worker-1")
+    assert queue.claim("worker-2") is None
+
+    queue.complete(claimed.job_id, "worker-1")
+    assert queue.claim("worker-2").submission_id == second.id
+
+
+def test_recover_leaves_pending_submissions_to_in_process_dispatch(db):
+    submission, = add_submissions(db, ["a@example.com"])
+    submission.submission_time = datetime.datetime(2000, 1, 1)
+    db.commit()
+
+    # The default background dispatch grades in the API process, which may still be running it
+    queue = EvaluationJobQueue()
+    assert not queue.requeue_orphans
+    assert queue.recover()["orphaned_submissions"] == 0
+    assert jobs_of(db, submission.id) == []
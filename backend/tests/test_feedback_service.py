@@ -0,0 +1,86 @@
+import asyncio
+
+from app.db.database import SessionLocal
+from app.db.models import Submission, EvaluationDetail, SubmissionFeedback
+from app.services.feedback_service import FeedbackService
+
+
+def stored_feedback(submission_id):
+    db = SessionLocal()
+    try:
+        stored = db.query(SubmissionFeedback).filter(SubmissionFeedback.submission_id == submission_id).first()
+        return stored.feedback if stored else None
+    finally:
+        db.close()
+
+
+def regrade(submission_id, score):
+    db = SessionLocal()
+    try:
+        db.query(Submission).filter(Submission.id == submission_id).update({"total_score": score})
+        db.query(EvaluationDetail).filter(
+            EvaluationDetail.submission_id == submission_id,
+            EvaluationDetail.criterion_index == 2
+        ).update({"score_obtained": 1, "feedback": "Returns the indices"})
+        db.commit()
+    finally:
+        db.close()
+
+
+async def test_feedback_is_generated_once_and_stored(graded_submission, monkeypatch):
+    service = FeedbackService()
+    calls = []
+
+    async def generate_feedback_summary(problem, evaluation, total_score, max_score):
+        calls.append((total_score, max_score))
+        return "Good use of a hash map."
+
+    monkeypatch.setattr(service.llm_client, "generate_feedback_summary", generate_feedback_summary)
+
+    assert await service.get_feedback(graded_submission) == "Good use of a hash map."
+    assert await service.get_feedback(graded_submission) == "Good use of a hash map."
+    assert calls == [(2, 3)]
+    assert stored_feedback(graded_submission) == "Good use of a hash map."
+
+
+async def test_feedback_for_a_regraded_submission_is_discarded(graded_submission, monkeypatch):
+    service = FeedbackService()
+    summaries = iter(["Feedback for the old grade.", "Feedback for the new grade."])
+
+    async def generate_feedback_summary(problem, evaluation, total_score, max_score):
+        if total_score == 2:
+            # The submission is regraded while its old grade is summarized
+            regrade(graded_submission, 3)
+        return next(summaries)
+
+    monkeypatch.setattr(service.llm_client, "generate_feedback_summary", generate_feedback_summary)
+
+    assert await service.get_feedback(graded_submission) is None
+    assert stored_feedback(graded_submission) is None
+    assert service.get_metrics()["stale_discarded"] == 1
+
+    assert await service.get_feedback(graded_submission) == "Feedback for the new grade."
+    assert stored_feedback(graded_submission) == "Feedback for the new grade."
+
+
+async def test_requested_feedback_is_generated_in_the_background(graded_submission, monkeypatch):
+    service = FeedbackService()
+    release = asyncio.Event()
+    calls = []
+
+    async def generate_feedback_summary(problem, evaluation, total_score, max_score):
+        calls.append(total_score)
+        await release.wait()
+        return "Good use of a hash map."
+
+    monkeypatch.setattr(service.llm_client, "generate_feedback_summary", generate_feedback_summary)
+
+    # Neither request waits for the LLM, and both share one generation
+    assert await service.request_feedback(graded_submission) == (None, "generating")
+    assert await service.request_feedback(graded_submission) == (None, "generating")
+
+    release.set()
+    await asyncio.gather(*service._generating.values())
+
+    assert calls == [2]
+    assert await service.request_feedback(graded_submission) == ("Good use of a hash map.", "completed")
@@ -0,0 +1,68 @@
+import json
+
+import pytest
+from pydantic import BaseModel
+
+from app.utils.json_decoder import StructuredOutputError, decode_json, decode_model
+from app.utils.llm_utils import query_llm_structured
+from tests.conftest import completion
+
+
+class Verdict(BaseModel):
+    approach: str
+    confidence: float
+
+
+@pytest.mark.parametrize("text", [
+    '{"approach": "dp", "confidence": 0.8}',
+    'Here is my answer:\n```json\n{"approach": "dp", "confidence": 0.8}\n```',
+    'Sure! {"approach": "dp", "confidence": 0.8} Hope this helps.',
+    '{"approach": "dp", "confidence": 0.8,}',
+    '{“approach”: “dp”, “confidence”: 0.8}',
+])
+def test_common_drift_is_tolerated(text):
+    assert decode_json(text) == {"approach": "dp", "confidence": 0.8}
+
+
+def test_python_literals_are_converted():
+    assert decode_json('{"correct": True, "issues": None}') == {"correct": True, "issues": None}
+
+
+def test_truncated_output_is_closed():
+    assert decode_json('{"approach": "dp", "indicators": ["memo", "tab') == {
+        "approach": "dp",
+        "indicators": ["memo", "tab"]
+    }
+
+
+def test_text_without_an_object_is_rejected():
+    with pytest.raises(StructuredOutputError):
+        decode_json("I cannot evaluate this code.")
+
+
+def test_decode_model_applies_overrides_and_validates():
+    verdict = decode_model('{"approach": "wrong name", "confidence": 0.4}', Verdict, overrides={"approach": "dp"})
+    assert verdict == Verdict(approach="dp", confidence=0.4)
+
+    with pytest.raises(StructuredOutputError):
+        decode_model('{"approach": "dp"}', Verdict)
+
+
+async def test_an_undecodable_response_is_repaired_once(fake_llm):
+    fake_llm.responses += [
+        completion("The approach is dp with confidence high"),
+        completion(json.dumps({"approach": "dp", "confidence": 0.9}))
+    ]
+
+    verdict = await query_llm_structured("Classify this solution", Verdict)
+
+    assert verdict == Verdict(approach="dp", confidence=0.9)
+    assert len(fake_llm.payloads) == 2
+    assert "The approach is dp with confidence high" in json.dumps(fake_llm.payloads[1])
+
+
+async def test_a_response_still_invalid_after_repair_raises(fake_llm):
+    fake_llm.responses += [completion("no json here"), completion("still no json")]
+
+    with pytest.raises(StructuredOutputError):
+        await query_llm_structured("Classify this solution", Verdict)
@@ -0,0 +1,70 @@
+from app.utils.llm_cache import LLMResponseCache
+
+
+def key(prompt, **kwargs):
+    return LLMResponseCache.make_key("model", 0.1, 100, prompt, **kwargs)
+
+
+def test_keys_cover_everything_that_shapes_the_completion():
+    assert key("prompt") == key("prompt")
+    assert key("prompt") != key("other prompt")
+    assert key("prompt") != key("prompt", template_version="v2")
+    assert key("prompt") != key("prompt", response_format={"type": "json_object"})
+    assert key("prompt") != LLMResponseCache.make_key("model", 0.2, 100, "prompt")
+
+
+async def test_memory_tier_evicts_least_recently_used():
+    cache = LLMResponseCache(max_entries=2)
+    await cache.set("a", "A")
+    await cache.set("b", "B")
+    assert await cache.get("a") == "A"
+
+    await cache.set("c", "C")
+
+    assert await cache.get("b") is None
+    assert await cache.get("a") == "A"
+    assert await cache.get("c") == "C"
+    assert cache.get_metrics()["evictions"] == 1
+
+
+async def test_memory_tier_is_bounded_in_bytes():
+    cache = LLMResponseCache(max_bytes=10)
+    await cache.set("big", "x" * 11)
+    await cache.set("a", "12345")
+    await cache.set("b", "123456")
+
+    assert await cache.get("big") is None
+    assert await cache.get("a") is None
+    assert await cache.get("b") == "123456"
+
+
+async def test_expired_entries_are_misses():
+    cache = LLMResponseCache(ttl=-1)
+    await cache.set("a", "A")
+
+    assert await cache.get("a") is None
+
+
+async def test_disk_tier_survives_a_restart(tmp_path):
+    path = str(tmp_path / "llm_cache.db")
+    await LLMResponseCache(db_path=path).set("a", "A", template_version="v1")
+
+    restarted = LLMResponseCache(db_path=path)
+    assert await restarted.get("a") == "A"
+    assert await restarted.get("a") == "A"
+    metrics = restarted.get_metrics()
+    assert (metrics["disk_hits"], metrics["memory_hits"]) == (1, 1)
+
+
+async def test_invalidating_a_template_version_clears_both_tiers(tmp_path):
+    path = str(tmp_path / "llm_cache.db")
+    cache = LLMResponseCache(db_path=path)
+    await cache.set("old", "A", template_version="v1")
+    await cache.set("new", "B", template_version="v2")
+
+    await cache.invalidate(template_version="v1")
+
+    restarted = LLMResponseCache(db_path=path)
+    assert await cache.get("old") is None
+    assert await restarted.get("old") is None
+    assert await restarted.get("new") == "B"
@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+
+from app.utils import llm_utils
+from app.utils.llm_hedging import HedgeStats, LatencyTracker
+from app.utils.llm_scheduler import LLMScheduler, ModelBudget
+from tests.conftest import FakeResponse, completion
+
+HEDGE_DELAY = 0.05
+
+
+class DelayedResponse(FakeResponse):
+    """A completion whose body arrives after a delay"""
+
+    def __init__(self, content, delay):
+        super().__init__(body=completion(content).body)
+        self.delay = delay
+
+    async def json(self):
+        await asyncio.sleep(self.delay)
+        return self.body
+
+
+@pytest.fixture
+def hedging(monkeypatch, fake_llm):
+    """
+    Enable hedging to a distinct backup model, with enough latency samples
+    for a hedge delay of HEDGE_DELAY; the primary answers after primary_delay
+    """
+    tracker = LatencyTracker(min_samples=1)
+    tracker.record(llm_utils.DEFAULT_MODEL, HEDGE_DELAY)
+    scheduler = LLMScheduler(budgets={}, default_budget=ModelBudget(1000, 1000000, initial_concurrency=1))
+    monkeypatch.setattr(llm_utils, "LLM_HEDGE_ENABLED", True)
+    monkeypatch.setattr(llm_utils, "BACKUP_MODEL", "backup-model")
+    monkeypatch.setattr(llm_utils, "llm_latency_tracker", tracker)
+    monkeypatch.setattr(llm_utils, "llm_hedge_stats", HedgeStats())
+    monkeypatch.setattr(llm_utils, "llm_scheduler", scheduler)
+    fake_llm.primary_delay = 0.5
+
+    def post(url, **kwargs):
+        payload = kwargs["json"]
+        fake_llm.payloads.append(payload)
+        if payload["model"] == llm_utils.DEFAULT_MODEL:
+            return DelayedResponse("primary", fake_llm.primary_delay)
+        return completion("backup")
+
+    fake_llm.post = post
+    return scheduler
+
+
+def models(fake_llm):
+    return [payload["model"] for payload in fake_llm.payloads]
+
+
+async def test_a_slow_primary_is_hedged_to_the_backup(fake_llm, hedging):
+    assert await llm_utils.query_llm("prompt", coalesce=False) == "backup"
+
+    assert models(fake_llm) == [llm_utils.DEFAULT_MODEL, "backup-model"]
+    assert llm_utils.llm_hedge_stats.hedges == 1
+    assert llm_utils.llm_hedge_stats.hedge_wins == 1
+
+
+async def test_time_queued_for_admission_does_not_count_towards_the_hedge_delay(fake_llm, hedging):
+    fake_llm.primary_delay = 0.0
+
+    async def occupy_primary():
+        async with hedging.slot(llm_utils.DEFAULT_MODEL, 1):
+            await asyncio.sleep(HEDGE_DELAY * 4)
+
+    holder = asyncio.create_task(occupy_primary())
+    await asyncio.sleep(0)
+
+    assert await llm_utils.query_llm("prompt", coalesce=False) == "primary"
+    await holder
+
+    assert models(fake_llm) == [llm_utils.DEFAULT_MODEL]
+    assert llm_utils.llm_hedge_stats.hedges == 0
+
+
+async def test_no_hedge_is_sent_when_the_backup_has_no_capacity(fake_llm, hedging):
+    release = asyncio.Event()
+
+    async def occupy_backup():
+        async with hedging.slot("backup-model", 1):
+            await release.wait()
+
+    holder = asyncio.create_task(occupy_backup())
+    await asyncio.sleep(0)
+
+    assert await llm_utils.query_llm("prompt", coalesce=False) == "primary"
+    release.set()
+    await holder
+
+    assert models(fake_llm) == [llm_utils.DEFAULT_MODEL]
+    assert llm_utils.llm_hedge_stats.hedges == 0
+    assert llm_utils.llm_hedge_stats.skipped == 1
+
+
+async def test_no_hedge_is_sent_when_the_backup_is_the_same_model(monkeypatch, fake_llm, hedging):
+    monkeypatch.setattr(llm_utils, "BACKUP_MODEL", llm_utils.DEFAULT_MODEL)
+
+    assert await llm_utils.query_llm("prompt", coalesce=False) == "primary"
+
+    assert models(fake_llm) == [llm_utils.DEFAULT_MODEL]
+    assert llm_utils.llm_hedge_stats.requests == 0
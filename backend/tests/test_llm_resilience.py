@@ -0,0 +1,104 @@
+import time
+import asyncio
+
+import pytest
+
+from app.utils import llm_utils
+from app.utils.llm_resilience import CircuitBreaker, CircuitState, RetryPolicy, CircuitOpenError
+from tests.conftest import FakeResponse, completion
+
+def open_breaker(breaker: CircuitBreaker) -> None:
+    """Open a breaker whose recovery timeout has already passed"""
+    breaker.state = CircuitState.open
+    breaker.opened_at = time.monotonic() - breaker.recovery_timeout - 1
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, recovery_timeout=30)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.allow_request()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitState.open
+    assert not breaker.allow_request()
+    assert breaker.retry_in() > 0
+
+def test_half_open_breaker_lets_one_probe_through():
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=30)
+    open_breaker(breaker)
+
+    assert breaker.allow_request()
+    assert breaker.state == CircuitState.half_open
+    assert not breaker.allow_request()
+
+    breaker.record_success()
+    assert breaker.state == CircuitState.closed
+    assert breaker.allow_request()
+
+def test_failed_probe_reopens_the_breaker():
+    breaker = CircuitBreaker(failure_threshold=5, recovery_timeout=30)
+    open_breaker(breaker)
+    assert breaker.allow_request()
+
+    breaker.record_failure()
+    assert breaker.state == CircuitState.open
+    assert not breaker.allow_request()
+
+def test_neutral_outcome_ends_the_probe():
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=30)
+    open_breaker(breaker)
+    probe = breaker.allow_request()
+    assert probe
+
+    breaker.record_neutral(probe)
+    assert breaker.state == CircuitState.half_open
+    assert breaker.allow_request()
+
+def test_neutral_outcome_of_an_earlier_request_keeps_the_probe():
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=30)
+    earlier = breaker.allow_request()
+    open_breaker(breaker)
+    assert breaker.allow_request()
+
+    # A request sent before the breaker opened is cancelled while the probe runs
+    breaker.record_neutral(earlier)
+    assert not breaker.allow_request()
+
+def test_backoff_honours_retry_after():
+    policy = RetryPolicy(base_delay=1, max_delay=8)
+    assert 10 <= policy.backoff(0, retry_after=10) <= 11
+    assert all(0 <= policy.backoff(5) <= 8 for _ in range(100))
+
+class HangingResponse(FakeResponse):
+    """A response whose headers never arrive"""
+
+    async def __aenter__(self):
+        await asyncio.Event().wait()
+
+async def test_cancelled_probe_releases_the_breaker(fake_llm):
+    breaker = llm_utils.llm_circuit_breakers.get(llm_utils.DEFAULT_MODEL)
+    open_breaker(breaker)
+    fake_llm.responses.append(HangingResponse())
+
+    probe = asyncio.create_task(llm_utils.query_llm("prompt", coalesce=False))
+    await asyncio.sleep(0.01)
+    assert breaker.state == CircuitState.half_open
+    assert not breaker.allow_request()
+
+    probe.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await probe
+
+    # The next request becomes the probe and closes the breaker
+    fake_llm.responses.append(completion("ok"))
+    assert await llm_utils.query_llm("prompt", coalesce=False) == "ok"
+    assert breaker.state == CircuitState.closed
+
+async def test_open_breaker_rejects_without_sending(fake_llm):
+    breaker = llm_utils.llm_circuit_breakers.get(llm_utils.DEFAULT_MODEL)
+    breaker.state = CircuitState.open
+    breaker.opened_at = time.monotonic()
+
+    with pytest.raises(CircuitOpenError):
+        await llm_utils.query_llm("prompt", coalesce=False)
+    assert fake_llm.payloads == []
@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+from app.utils.llm_scheduler import (
+    LLMScheduler,
+    ModelBudget,
+    Priority,
+    TokenBucket,
+    current_priority,
+    priority_scope
+)
+
+
+def scheduler(concurrency=1, tokens_per_minute=1_000_000):
+    budget = ModelBudget(
+        requests_per_minute=1000,
+        tokens_per_minute=tokens_per_minute,
+        min_concurrency=1,
+        max_concurrency=4,
+        initial_concurrency=concurrency
+    )
+    return LLMScheduler({}, budget)
+
+
+def test_token_bucket_waits_for_missing_tokens():
+    bucket = TokenBucket(60)
+    bucket.consume(60)
+
+    assert bucket.time_until(30) == pytest.approx(30, abs=0.1)
+    bucket.refund(100)
+    assert bucket.tokens == pytest.approx(60)
+    # A request larger than the whole budget waits for a full bucket, not forever
+    assert bucket.time_until(600) == 0.0
+
+
+def test_priority_scope_sets_the_default_priority():
+    assert current_priority() == Priority.interactive
+    with priority_scope(Priority.background):
+        assert current_priority() == Priority.background
+    assert current_priority() == Priority.interactive
+
+
+async def test_higher_priority_waiters_are_admitted_first():
+    llm_scheduler = scheduler(concurrency=1)
+    admitted = []
+    release = asyncio.Event()
+
+    async def request(name, priority):
+        async with llm_scheduler.slot("model", 10, priority) as slot:
+            admitted.append(name)
+            slot.status = 200
+            if name == "first":
+                await release.wait()
+
+    first = asyncio.create_task(request("first", Priority.interactive))
+    await asyncio.sleep(0)
+    waiting = [
+        asyncio.create_task(request("background", Priority.background)),
+        asyncio.create_task(request("regrade", Priority.regrade)),
+        asyncio.create_task(request("interactive", Priority.interactive))
+    ]
+    await asyncio.sleep(0)
+    assert llm_scheduler.limiter("model").queue_depth() == {"interactive": 1, "regrade": 1, "background": 1}
+    assert not llm_scheduler.is_idle()
+
+    release.set()
+    await asyncio.gather(first, *waiting)
+    assert admitted == ["first", "interactive", "regrade", "background"]
+    assert llm_scheduler.is_idle()
+
+
+async def test_rate_limited_responses_halve_the_window_and_successes_grow_it():
+    limiter = scheduler(concurrency=4).limiter("model")
+
+    await limiter.acquire(10, Priority.interactive)
+    limiter.release(10, 429, 1.0, None)
+    assert limiter.window == 2
+
+    for _ in range(2):
+        await limiter.acquire(10, Priority.interactive)
+        limiter.release(10, 200, 1.0, None)
+    assert limiter.window == 3
+
+
+async def test_unused_reserved_tokens_are_refunded():
+    limiter = scheduler(tokens_per_minute=1000).limiter("model")
+
+    await limiter.acquire(800, Priority.interactive)
+    limiter.release(800, 200, 1.0, total_tokens=100)
+
+    assert limiter.token_bucket.tokens == pytest.approx(900, abs=1)
+
+
+async def test_a_cancelled_waiter_does_not_take_a_slot():
+    llm_scheduler = scheduler(concurrency=1)
+    limiter = llm_scheduler.limiter("model")
+    await limiter.acquire(10, Priority.interactive)
+
+    waiter = asyncio.create_task(limiter.acquire(10, Priority.interactive))
+    await asyncio.sleep(0)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+
+    limiter.release(10, 200, 1.0, None)
+    assert limiter.in_flight == 0
+    assert llm_scheduler.is_idle()
@@ -0,0 +1,75 @@
+import json
+import asyncio
+
+from app.utils import llm_utils
+from app.utils.json_stream import IncrementalJSONParser
+from app.utils.llm_streaming import query_llm_fields, query_llm_until
+from tests.conftest import FakeResponse, completion, sse
+
+RESPONSE = {"confidence": 0.9, "explanation": "Uses two pointers", "key_indicators": ["left", "right"]}
+
+def test_parser_decodes_fields_as_they_complete():
+    parser = IncrementalJSONParser()
+    assert parser.feed('```json\n{"confidence": 0.') == []
+    assert parser.feed('9, "explanation": "a, b"') == ["confidence"]
+    assert parser.feed(', "key_indicators": ["x"]}') == ["explanation", "key_indicators"]
+    assert parser.complete
+    assert parser.fields == {"confidence": 0.9, "explanation": "a, b", "key_indicators": ["x"]}
+
+def test_parser_handles_nested_values_and_escapes():
+    parser = IncrementalJSONParser()
+    parser.feed('{"a": {"b": [1, {"c": "}"}]}, "d": "say \\"hi\\""}')
+    assert parser.fields == {"a": {"b": [1, {"c": "}"}]}, "d": 'say "hi"'}
+
+async def test_fields_stop_early_without_caching_the_cut_off_response(fake_llm):
+    text = json.dumps(RESPONSE)
+    cut = text.index('"key_indicators"')
+    fake_llm.responses.append(FakeResponse(lines=sse(text[:cut], text[cut:])))
+
+    result = await query_llm_fields("prompt", ["confidence", "explanation"], cache=True, template_version="v1")
+
+    assert result == {"confidence": 0.9, "explanation": "Uses two pointers"}
+    assert fake_llm.payloads[0]["stream"] is True
+    assert llm_utils.llm_cache.sets == 0
+
+    # A later non-streamed call for the same prompt gets the whole response
+    fake_llm.responses.append(completion(text))
+    whole = await llm_utils.query_llm("prompt", cache=True, template_version="v1")
+    assert json.loads(whole) == RESPONSE
+
+async def test_fields_cache_a_complete_response(fake_llm):
+    fake_llm.responses.append(FakeResponse(lines=sse(json.dumps(RESPONSE))))
+
+    result = await query_llm_fields("prompt", ["confidence"], cache=True, template_version="v1")
+    assert result == RESPONSE
+
+    cached = await query_llm_fields("prompt", ["confidence"], cache=True, template_version="v1")
+    assert cached == RESPONSE
+    assert len(fake_llm.payloads) == 1
+
+async def test_streamed_calls_are_retried(fake_llm):
+    fake_llm.responses.append(FakeResponse(status=503, body={"error": "overloaded"}))
+    fake_llm.responses.append(FakeResponse(lines=sse(json.dumps(RESPONSE))))
+
+    result = await query_llm_fields("prompt", ["confidence"])
+
+    assert result["confidence"] == 0.9
+    assert len(fake_llm.payloads) == 2
+
+async def test_until_stops_reading_and_coalesces(fake_llm):
+    response = FakeResponse(lines=sse("SECURE", "_CODE", "NOPE", "more", "text"))
+    fake_llm.responses.append(response)
+
+    def diverged(text: str) -> bool:
+        return not "SECURE_CODE_CHECK".startswith(text)
+
+    texts = await asyncio.gather(
+        query_llm_until("prompt", diverged, cache=True, coalesce_key="detection"),
+        query_llm_until("prompt", diverged, cache=True, coalesce_key="detection")
+    )
+
+    assert texts == ["SECURE_CODENOPE", "SECURE_CODENOPE"]
+    assert len(fake_llm.payloads) == 1
+    assert response.closed
+    assert response.content.read == 3
+    assert llm_utils.llm_cache.sets == 0
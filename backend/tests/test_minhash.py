@@ -0,0 +1,82 @@
+import pytest
+
+from app.utils.minhash import LSHIndex, MinHasher, code_shingles, signature_similarity
+
+TWO_SUM = """
+public int[] twoSum(int[] nums, int target) {
+    Map<Integer, Integer> seen = new HashMap<>();
+    for (int i = 0; i < nums.length; i++) {
+        int need = target - nums[i];
+        if (seen.containsKey(need)) {
+            return new int[] { seen.get(need), i };
+        }
+        seen.put(nums[i], i);
+    }
+    return new int[0];
+}
+"""
+
+TWO_SUM_RENAMED = """
+// hash map solution
+public int[] twoSum(int[] arr, int goal) {
+    Map<Integer, Integer> index = new HashMap<>();
+    for (int j = 0; j < arr.length; j++) {
+        int rest = goal - arr[j];
+        if (index.containsKey(rest)) { return new int[] { index.get(rest), j }; }
+        index.put(arr[j], j);
+    }
+    return new int[0];
+}
+"""
+
+BRUTE_FORCE = """
+public int[] twoSum(int[] nums, int target) {
+    for (int i = 0; i < nums.length; i++) {
+        for (int k = i + 1; k < nums.length; k++) {
+            if (nums[i] + nums[k] == target) {
+                return new int[] { i, k };
+            }
+        }
+    }
+    return null;
+}
+"""
+
+hasher = MinHasher(num_perm=64)
+
+
+def signature(code):
+    return hasher.signature(code_shingles(code))
+
+
+def test_renaming_and_comments_do_not_change_the_shingles():
+    assert code_shingles(TWO_SUM) == code_shingles(TWO_SUM_RENAMED)
+
+
+def test_similarity_estimates_follow_the_code():
+    assert signature_similarity(signature(TWO_SUM), signature(TWO_SUM_RENAMED)) == 1.0
+    assert signature_similarity(signature(TWO_SUM), signature(BRUTE_FORCE)) < 0.5
+
+
+def test_signatures_are_deterministic_for_a_seed():
+    assert MinHasher(num_perm=64, seed=7).signature({1, 2, 3}) == MinHasher(num_perm=64, seed=7).signature({1, 2, 3})
+
+
+def test_index_finds_near_duplicates_and_supports_removal():
+    index = LSHIndex(num_perm=64, bands=16)
+    index.add("original", signature(TWO_SUM))
+    index.add("brute", signature(BRUTE_FORCE))
+
+    neighbors = index.query(signature(TWO_SUM_RENAMED), threshold=0.8)
+    assert neighbors == [("original", 1.0)]
+    assert index.query(signature(TWO_SUM), threshold=0.8, exclude="original") == []
+
+    index.remove("original")
+    assert "original" not in index
+    assert len(index) == 1
+    assert index.query(signature(TWO_SUM_RENAMED), threshold=0.8) == []
+
+
+def test_bands_must_divide_the_signature():
+    with pytest.raises(ValueError):
+        LSHIndex(num_perm=64, bands=10)
@@ -0,0 +1,95 @@
+from app.services.pointwise_service import PointwiseEvaluator
+
+CRITERIA = [
+    {"id": "1", "description": "Uses a hash map", "marks": 2},
+    {"id": "2", "description": "Returns the indices", "marks": 1},
+    {"id": "3", "description": "Handles no solution", "marks": 1}
+]
+CODE = "class Solution { int[] twoSum(int[] nums, int target) { Map<Integer, Integer> seen = new HashMap<>(); return null; } }"
+
+
+def satisfied(criterion):
+    return {"satisfied": True, "justification": f"Meets {criterion['description']}", "marks_awarded": criterion["marks"]}
+
+
+class FakeLLMClient:
+    """Stands in for LLMClientService, recording which criteria each call evaluated"""
+
+    def __init__(self):
+        self.calls = []
+        self.leave_out = set()
+        self.failing = set()
+
+    async def generate_criterion_evaluation(self, problem_statement, description, marks, student_code):
+        criterion = next(criterion for criterion in CRITERIA if criterion["description"] == description)
+        self.calls.append([criterion["id"]])
+        if criterion["id"] in self.failing:
+            raise RuntimeError("Circuit open")
+        return satisfied(criterion)
+
+    async def generate_criteria_evaluation(self, problem_statement, criteria, student_code):
+        self.calls.append([criterion["id"] for criterion in criteria])
+        if any(criterion["id"] in self.failing for criterion in criteria):
+            raise RuntimeError("Circuit open")
+        return {
+            criterion["id"]: satisfied(criterion)
+            for criterion in criteria
+            if criterion["id"] not in self.leave_out
+        }
+
+
+async def test_criteria_are_packed_into_calls():
+    llm_client = FakeLLMClient()
+    evaluator = PointwiseEvaluator(llm_client=llm_client, criteria_per_call=2)
+
+    evaluations, latencies = await evaluator.evaluate("Find two numbers.", CRITERIA, CODE)
+
+    assert sorted(llm_client.calls) == [["1", "2"], ["3"]]
+    assert list(evaluations) == ["1", "2", "3"]
+    assert set(latencies) == {"1", "2", "3"}
+    assert evaluator.get_metrics()["calls"] == 2
+
+
+async def test_criteria_left_out_of_a_packed_response_are_evaluated_alone():
+    llm_client = FakeLLMClient()
+    llm_client.leave_out = {"2"}
+    evaluator = PointwiseEvaluator(llm_client=llm_client, criteria_per_call=3)
+
+    evaluations, _ = await evaluator.evaluate("Find two numbers.", CRITERIA, CODE)
+
+    assert llm_client.calls == [["1", "2", "3"], ["2"]]
+    assert evaluations["2"] == satisfied(CRITERIA[1])
+    assert evaluator.get_metrics()["unpacked"] == 1
+
+
+async def test_a_failed_pack_does_not_discard_the_other_packs():
+    llm_client = FakeLLMClient()
+    llm_client.failing = {"3"}
+    evaluator = PointwiseEvaluator(llm_client=llm_client, criteria_per_call=2)
+
+    evaluations, _ = await evaluator.evaluate("Find two numbers.", CRITERIA, CODE)
+
+    assert evaluations["1"] == satisfied(CRITERIA[0])
+    assert evaluations["2"] == satisfied(CRITERIA[1])
+    assert evaluations["3"]["error"] == "Circuit open"
+    assert evaluations["3"]["marks_awarded"] == 0
+    assert evaluator.get_metrics()["failures"] == 1
+
+
+async def test_evaluations_are_reused_by_criterion_and_code_fingerprint():
+    llm_client = FakeLLMClient()
+    llm_client.failing = {"3"}
+    evaluator = PointwiseEvaluator(llm_client=llm_client, criteria_per_call=1)
+    await evaluator.evaluate("Find two numbers.", CRITERIA, CODE)
+
+    # Renamed variables keep the fingerprint; an edited criterion and a failed one are evaluated again
+    llm_client.calls = []
+    llm_client.failing = set()
+    renamed = CODE.replace("seen", "visited")
+    edited = [CRITERIA[0], {"id": "2", "description": "Returns the indices", "marks": 2}, CRITERIA[2]]
+    evaluations, latencies = await evaluator.evaluate("Find two numbers.", edited, renamed)
+
+    assert sorted(llm_client.calls) == [["2"], ["3"]]
+    assert latencies["1"] == 0.0
+    assert evaluations["3"] == satisfied(CRITERIA[2])
+    assert evaluator.get_metrics()["reused"] == 1
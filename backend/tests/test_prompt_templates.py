@@ -0,0 +1,45 @@
+import pytest
+
+# Importing the modules that define prompts registers their templates
+import app.agents.evaluation_guidance_agent
+import app.agents.rubric_extractor_agent
+import app.services.approach_batcher
+import app.services.llm_client_service
+import app.utils.security
+from app.utils.prompt_templates import PromptTemplate, compact_json, compact_text, template_savings_report
+
+
+def test_compaction_dedents_and_collapses_blank_lines():
+    text = """
+        HEADER:
+        {{"a": 1}}
+
+
+
+            indented line
+        """
+
+    assert compact_text(text) == 'HEADER:\n{{"a": 1}}\n\n    indented line'
+
+
+def test_compact_json_has_no_padding():
+    assert compact_json({"a": [1, 2], "b": "é"}) == '{"a":[1,2],"b":"é"}'
+
+
+def test_substituted_student_code_is_inserted_verbatim():
+    template = PromptTemplate("test_student_code", """
+        STUDENT CODE:
+        ```
+        {code}
+        ```
+        """)
+    code = "class Solution {\n\n\n    int f()   {  \n        return 1;\n    }\n}"
+
+    assert template.render(code=code) == f"STUDENT CODE:\n```\n{code}\n```"
+
+
+@pytest.mark.parametrize("report", template_savings_report(), ids=lambda report: report["template"])
+def test_every_registered_template_saves_tokens(report):
+    assert report["compact_tokens"] < report["source_tokens"]
+    assert report["saved_tokens"] > 0
+    assert 0 < report["saved_ratio"] < 1
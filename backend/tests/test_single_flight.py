@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from app.utils.single_flight import SingleFlight
+
+
+class Work:
+    """Counts executions; each runs until released"""
+
+    def __init__(self, result="done", error=None):
+        self.result = result
+        self.error = error
+        self.executions = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.executions += 1
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+async def test_concurrent_callers_share_one_execution():
+    flight = SingleFlight()
+    work = Work()
+
+    callers = [asyncio.create_task(flight.do("key", work)) for _ in range(3)]
+    await asyncio.sleep(0)
+    work.release.set()
+
+    assert await asyncio.gather(*callers) == ["done"] * 3
+    assert work.executions == 1
+    assert flight.get_metrics() == {"calls": 3, "executions": 1, "deduplicated": 2, "in_flight": 0}
+
+
+async def test_different_keys_and_later_calls_run_again():
+    flight = SingleFlight()
+    work = Work()
+    work.release.set()
+
+    await asyncio.gather(flight.do("a", work), flight.do("b", work))
+    await flight.do("a", work)
+
+    assert work.executions == 3
+
+
+async def test_every_caller_gets_the_exception():
+    flight = SingleFlight()
+    work = Work(error=ValueError("upstream failed"))
+
+    callers = [asyncio.create_task(flight.do("key", work)) for _ in range(2)]
+    await asyncio.sleep(0)
+    work.release.set()
+
+    results = await asyncio.gather(*callers, return_exceptions=True)
+    assert [type(result) for result in results] == [ValueError, ValueError]
+    assert work.executions == 1
+
+
+async def test_a_cancelled_caller_does_not_cancel_the_shared_work():
+    flight = SingleFlight()
+    work = Work()
+
+    first = asyncio.create_task(flight.do("key", work))
+    second = asyncio.create_task(flight.do("key", work))
+    await asyncio.sleep(0)
+    first.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await first
+
+    work.release.set()
+    assert await second == "done"
+    assert work.executions == 1
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+from app.utils.stage_graph import StageGraph
+
+
+async def test_stages_receive_their_dependencies_and_independent_stages_overlap():
+    running = set()
+    overlapped = []
+
+    async def independent(name, value):
+        running.add(name)
+        await asyncio.sleep(0)
+        overlapped.append(len(running) == 2)
+        await asyncio.sleep(0)
+        running.discard(name)
+        return value
+
+    async def combine(left, right):
+        return left + right
+
+    results = await (
+        StageGraph("test")
+        .add("left", lambda: independent("left", 1))
+        .add("right", lambda: independent("right", 2))
+        .add("total", combine, depends_on=["left", "right"])
+        .run()
+    )
+
+    assert results == {"left": 1, "right": 2, "total": 3}
+    assert all(overlapped)
+
+
+def test_unknown_and_duplicate_stages_are_rejected():
+    async def stage():
+        return None
+
+    graph = StageGraph().add("a", stage)
+    with pytest.raises(ValueError):
+        graph.add("a", stage)
+    with pytest.raises(ValueError):
+        graph.add("b", stage, depends_on=["missing"])
+
+
+async def test_a_failed_stage_cancels_the_rest_and_is_raised():
+    cancelled = asyncio.Event()
+    dependent_ran = []
+
+    async def fails():
+        await asyncio.sleep(0)
+        raise RuntimeError("stage failed")
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def dependent(fails):
+        dependent_ran.append(fails)
+
+    graph = StageGraph("test").add("fails", fails).add("slow", slow).add("dependent", dependent, depends_on=["fails"])
+
+    with pytest.raises(RuntimeError, match="stage failed"):
+        await graph.run()
+
+    assert cancelled.is_set()
+    assert dependent_ran == []
+    assert graph.timings["fails"]["status"] == "failed"
+    assert graph.timings["slow"]["status"] == "cancelled"